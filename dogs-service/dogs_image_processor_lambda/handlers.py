@@ -1,14 +1,18 @@
 import re
 
 from functools import lru_cache
+from typing import Optional
 
 from pydantic import BaseModel
-from dogs_common.models import ImageStatus, UpdateImageRequestPayload
+from dogs_common.models import DeleteDogTask, ImageHashDb, ImageStatus, UpdateImageRequestPayload
 from dogs_common.observability import logger
 from dogs_common.config import AppConfig
 from dogs_common.db import get_dogs_db_client
+from dogs_common.keys import image_sk
 from dogs_common.s3 import get_s3_client
+from dogs_common.tasks import delete_dog_images
 from aws_lambda_powertools.utilities.data_classes.s3_event import S3EventRecord
+from hashing import ImageHashes, compute_image_hashes, hamming_distance
 
 class Ids(BaseModel):
     user_id: str
@@ -27,12 +31,25 @@ class DogsImageProcessor:
         object_key = record.s3.get_object.key
         size = record.s3.get_object.size
         logger.info(f"Processing S3 object from bucket", bucket=bucket_name, key=object_key, size=size)
+
+        if record.event_name.startswith("ObjectRemoved"):
+            # Removals are issued by us (rejects, dog deletion) and the DB is already up to date
+            return {"bucket": bucket_name, "key": object_key, "status": ImageStatus.DELETED, "reason": "Object removed"}
         
-        if size > self.app_config.image_upload_max_size:
-            return self._image_rejected(bucket_name, object_key, reason=f"File size exceeds limit: {size}/{self.app_config.image_upload_max_size}")
+        max_size = self.app_config.image_upload_max_size
+        if record.event_name == "ObjectCreated:CompleteMultipartUpload":
+            max_size = self.app_config.image_multipart_upload_max_size
+
+        if size > max_size:
+            return self._image_rejected(bucket_name, object_key, reason=f"File size exceeds limit: {size}/{max_size}")
         
         return self._image_uploaded(bucket_name, object_key)
     
+    def process_delete_dog_task(self, task: DeleteDogTask) -> dict:
+        logger.info(f"Deleting dog images", user_id=task.user_id, dog_id=task.dog_id)
+        images_count = delete_dog_images(self.db, self.s3, task.user_id, task.dog_id)
+        return {"task": task.task, "user_id": task.user_id, "dog_id": task.dog_id, "images_count": images_count}
+
     def _image_rejected(self, bucket_name: str, object_key: str, reason: str) -> dict:
         logger.info(f"Image rejected", bucket=bucket_name, key=object_key)
         ids = self._parse_s3_key(object_key)
@@ -53,6 +70,8 @@ class DogsImageProcessor:
         if not ids:
             self.s3.delete_object(s3_key=object_key)
             return {"bucket": bucket_name, "key": object_key, "status": ImageStatus.DELETED, "reason": "Failed to parse S3 key"}
+        if self.app_config.image_dedup_enabled:
+            return self._image_deduplicated(bucket_name, object_key, ids)
         update_payload = UpdateImageRequestPayload(
             s3_key=object_key,
             status=ImageStatus.UPLOADED,
@@ -60,6 +79,63 @@ class DogsImageProcessor:
         self.db.update_image(ids.user_id, ids.dog_id, ids.image_id, update_payload)
         return {"bucket": bucket_name, "key": object_key, "status": ImageStatus.UPLOADED}
 
+    def _image_deduplicated(self, bucket_name: str, object_key: str, ids: Ids) -> dict:
+        hashes = compute_image_hashes(self.s3.get_object_body(object_key))
+        own_sk = image_sk(ids.dog_id, ids.image_id)
+
+        original = self._find_original(ids.user_id, hashes, object_key)
+        if original is None and not self.db.create_image_hash(ids.user_id, hashes.content_hash, hashes.phash, object_key, own_sk):
+            # A concurrent upload of the same content registered the hash first
+            original = self.db.get_image_hash(ids.user_id, hashes.content_hash)
+
+        content_hash = hashes.content_hash
+        if original is not None and original.s3_key != object_key and not self.db.add_image_hash_ref(ids.user_id, original.content_hash, own_sk):
+            # The original was deleted meanwhile: the upload keeps its own object, without a hash to share it
+            logger.info(f"Original image was deleted, keeping the duplicate", key=object_key, original_key=original.s3_key)
+            original, content_hash = None, None
+
+        if original is None or original.s3_key == object_key:
+            update_payload = UpdateImageRequestPayload(
+                s3_key=object_key,
+                status=ImageStatus.UPLOADED,
+                clear_ttl=True,
+                content_hash=content_hash,
+                phash=hashes.phash)
+            self.db.update_image(ids.user_id, ids.dog_id, ids.image_id, update_payload)
+            return {"bucket": bucket_name, "key": object_key, "status": ImageStatus.UPLOADED}
+
+        logger.info(f"Image is a duplicate", key=object_key, original_key=original.s3_key)
+        self.s3.delete_object(s3_key=object_key)
+        update_payload = UpdateImageRequestPayload(
+            s3_key=original.s3_key,
+            status=ImageStatus.UPLOADED,
+            clear_ttl=True,
+            content_hash=original.content_hash,
+            phash=hashes.phash,
+            duplicate_of=original.image_sk)
+        self.db.update_image(ids.user_id, ids.dog_id, ids.image_id, update_payload)
+        return {"bucket": bucket_name, "key": object_key, "status": ImageStatus.UPLOADED, "duplicate_of": original.s3_key}
+
+    def _find_original(self, user_id: str, hashes: ImageHashes, object_key: str) -> Optional[ImageHashDb]:
+        exact = self.db.get_image_hash(user_id, hashes.content_hash)
+        if exact is not None:
+            return exact
+        max_distance = self.app_config.image_phash_max_distance
+        if hashes.phash is None or max_distance == 0:
+            return None
+
+        # Near duplicates: closest perceptual hash within the configured Hamming distance, among the
+        # hashes sharing a band with this one. A candidate whose hash was deleted meanwhile is skipped
+        candidates = self.db.query_similar_image_hashes(user_id, hashes.phash, self.app_config.image_phash_max_candidates)
+        distances = sorted((hamming_distance(hashes.phash, phash), content_hash) for content_hash, phash in candidates.items())
+        for distance, content_hash in distances:
+            if distance > max_distance:
+                break
+            candidate = self.db.get_image_hash(user_id, content_hash)
+            if candidate is not None and candidate.s3_key != object_key:
+                return candidate
+        return None
+
     def _parse_s3_key(self, s3_key: str) -> Ids:
         # Expected format: users/{user_id}/dogs/{dog_id}/images/{image_id}.{extension}
         # TODO This is bad: Need to pass them in presigned url metadata headers instead
@@ -0,0 +1,48 @@
+import hashlib
+import tempfile
+
+from PIL import Image, UnidentifiedImageError
+from pydantic import BaseModel
+from typing import Optional
+
+# Difference hash of a HASH_SIZE x HASH_SIZE grid, 64 bits
+HASH_SIZE = 8
+READ_CHUNK_SIZE = 1024 * 1024
+# Larger objects spill from memory to /tmp while being hashed
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+class ImageHashes(BaseModel):
+    content_hash: str
+    phash: Optional[str] = None
+
+def compute_image_hashes(body) -> ImageHashes:
+    # body is a botocore StreamingBody; the content is hashed chunk by chunk while it's downloaded
+    sha256 = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buffer:
+        for chunk in body.iter_chunks(READ_CHUNK_SIZE):
+            sha256.update(chunk)
+            buffer.write(chunk)
+        buffer.seek(0)
+        phash = difference_hash(buffer)
+    return ImageHashes(content_hash=sha256.hexdigest(), phash=phash)
+
+def difference_hash(fp) -> Optional[str]:
+    try:
+        with Image.open(fp) as image:
+            # Let the JPEG decoder downscale while decoding instead of decoding full resolution
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+            pixels = list(small.getdata())
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+def hamming_distance(phash_a: str, phash_b: str) -> int:
+    return bin(int(phash_a, 16) ^ int(phash_b, 16)).count("1")
@@ -1,5 +1,9 @@
 from dogs_common.config import AppConfig, get_config
-from dogs_common.observability import logger, tracer
+from dogs_common.models import DeleteDogTask
+from dogs_common.observability import buffered_logs, logger, tracer
+from dogs_common.request_metrics import log_request_metrics
+from dogs_common.priming import prime, prime_clients, prime_models, record_first_request
+from dogs_common.profiling import profile_handler
 from aws_lambda_powertools.utilities.data_classes import event_source, S3Event
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
@@ -8,10 +12,12 @@ from handlers import get_processor
 _app_config = get_config()
 _processor = get_processor(_app_config)
 
-@tracer.capture_lambda_handler
-@logger.inject_lambda_context(clear_state=True)
+# See dogs_service_lambda/app.py
+if _app_config.prime_on_init:
+    prime(_app_config, lambda: prime_clients(_processor.db, _processor.s3), prime_models)
+
 @event_source(data_class=S3Event)
-def lambda_handler(event: S3Event, _: LambdaContext):
+def handle_s3_event(event: S3Event, _: LambdaContext):
     
     total_result = []
     for record in event.records:
@@ -23,5 +29,27 @@ def lambda_handler(event: S3Event, _: LambdaContext):
             raise e
 
     # event.records may be a generator (no len()); use the collected results instead
-    logger.info(f"Processed {len(total_result)} records", results=total_result)
-    return total_result
\ No newline at end of file
+    logger.info(f"Processed {len(total_result)} records")
+    return total_result
+
+def handle_task(event: dict, _: LambdaContext):
+    # Only one task type for now; unknown tasks fail validation and end up in the DLQ
+    task = DeleteDogTask.model_validate(event)
+    result = _processor.process_delete_dog_task(task)
+    logger.info(f"Processed task {task.task}", result=result)
+    return result
+
+def route_name(event: dict) -> str:
+    return f"task:{event['task']}" if "task" in event else "s3"
+
+@tracer.capture_lambda_handler
+@logger.inject_lambda_context(clear_state=True)
+@buffered_logs
+@record_first_request(_app_config, primed=_app_config.prime_on_init)
+@log_request_metrics(_app_config, route_fn=route_name)
+@profile_handler(_app_config, route_fn=route_name)
+def lambda_handler(event: dict, context: LambdaContext):
+    # Background tasks are submitted by the dogs service as async invocations
+    if "task" in event:
+        return handle_task(event, context)
+    return handle_s3_event(event, context)
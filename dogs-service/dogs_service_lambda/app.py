@@ -1,25 +1,56 @@
 import exception_handlers as eh
+import json
 
-from aws_lambda_powertools.event_handler import APIGatewayRestResolver, Response
+from aws_lambda_powertools.event_handler import APIGatewayRestResolver, CORSConfig, Response
 from aws_lambda_powertools.event_handler.openapi.exceptions import RequestValidationError
-from aws_lambda_powertools.event_handler.openapi.params import Path
+from aws_lambda_powertools.event_handler.openapi.params import Path, Query
 from aws_lambda_powertools.event_handler.exceptions import ServiceError
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
 from botocore.exceptions import ClientError, BotoCoreError
+from dogs_common.aws import reset_clients
 from dogs_common.config import get_config 
-from dogs_common.observability import logger, tracer
+from dogs_common.db import get_dogs_db_client
+from dogs_common.fanout import get_fanout
+from dogs_common.observability import buffered_logs, logger, tracer, trace_route
+from dogs_common.request_metrics import log_request_metrics
+from dogs_common.priming import prime, prime_clients, prime_models, record_first_request
+from dogs_common.profiling import profile_handler
+from dogs_common.rate_limit import get_rate_limiter, rate_limit
+from dogs_common.resilience import CircuitOpenError, shed_load
+from dogs_common.s3 import get_s3_client
+from dogs_common.storage import ConditionalCheckFailed, StorageError
+from dogs_common.tasks import ImagesNotDeleted, get_tasks_client
 from dogs_common.models import CreateDogRequestPayload, CreateDogResponsePayload, GetDogResponsePayload
 from dogs_common.models import CreateImageRequestPayload, CreateImageResponsePayload
+from dogs_common.models import DeleteDogResponsePayload, DogDeletionStatus, GetImagesResponsePayload
+from dogs_common.models import CreateMultipartImageRequestPayload, CreateMultipartImageResponsePayload, ImageInfo
+from dogs_common.models import BatchGetUserDogsResponsePayload
 from handlers import DogsService, HealthService
-from typing import List
+from typing import List, Optional
 from typing_extensions import Annotated
 from uuid import UUID
 
 app_config = get_config()
 
-app = APIGatewayRestResolver(enable_validation=True)
+# Same origin and headers as the Cors of the API in template.yaml, which only answers the preflight requests
+cors_config = CORSConfig(allow_origin="*")
+app = APIGatewayRestResolver(cors=cors_config, enable_validation=True)
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+# Lambda rejects a response over 6MB, headers and JSON envelope included
+LAMBDA_EXPORT_MAX_BYTES = 6 * 1024 * 1024 - 64 * 1024
+# Services (as named by their circuit breakers) called by the write routes: the writes of a route are
+# shed while one of its services is degraded, an S3 incident doesn't stop dogs from being created
+WRITE_ROUTE_DEPENDENCIES = {
+    "POST /users/{user_id}/dogs": ["DynamoDB"],
+    "DELETE /users/{user_id}/dogs/{dog_id}": ["DynamoDB", "S3", "Lambda"],
+    "POST /users/{user_id}/dogs/{dog_id}/images": ["DynamoDB"],
+    "POST /users/{user_id}/dogs/{dog_id}/images/multipart": ["DynamoDB", "S3"],
+    "POST /users/{user_id}/dogs/{dog_id}/images/{image_id}/multipart/complete": ["DynamoDB", "S3"],
+    "DELETE /users/{user_id}/dogs/{dog_id}/images/{image_id}/multipart": ["DynamoDB", "S3"],
+}
 
 dogs_service = None
 health_service = None
@@ -39,22 +70,93 @@ def get_health_service() -> HealthService:
             app_config=app_config)
     return health_service
 
+def reset_dogs_service():
+    # Server mode forks workers after importing the app, each one must create its own clients
+    global dogs_service, health_service
+    dogs_service = None
+    health_service = None
+    get_dogs_db_client.cache_clear()
+    get_s3_client.cache_clear()
+    get_tasks_client.cache_clear()
+    get_rate_limiter.cache_clear()
+    get_fanout.cache_clear()
+    reset_clients()
+
 @app.get("/users/<user_id>/dogs")
-@tracer.capture_method
+@trace_route(capture_response=False)
 def get_user_dogs(user_id: Annotated[UUID, Path(description="user id as UUID")]) -> List[GetDogResponsePayload]:
     serv = get_dogs_service()
     dogs = serv.handle_user_dogs_get(str(user_id))
     return dogs
 
+@app.get("/dogs")
+@trace_route(capture_response=False)
+def batch_get_users_dogs(
+    user_id: Annotated[List[UUID], Query(description="user id as UUID, repeated for each user")]
+) -> BatchGetUserDogsResponsePayload:
+    serv = get_dogs_service()
+    return serv.handle_users_dogs_batch_get([str(uid) for uid in user_id])
+
+@app.get("/users/<user_id>/dogs/export")
+@trace_route(capture_response=False)
+def export_user_dogs(user_id: Annotated[UUID, Path(description="user id as UUID")]):
+    serv = get_dogs_service()
+    lines = serv.handle_user_dogs_export(str(user_id))
+    # Server mode writes the lines as they are produced. Lambda can't stream the response of a Python
+    # function, there the export is sent as one body and is limited by the 6MB response payload
+    stream = getattr(app.lambda_context, "response_stream", None)
+    if stream is None:
+        body, size = [], 0
+        for line in lines:
+            # Size once escaped in the JSON response of the function
+            size += len(json.dumps(line)) - 2
+            if size > LAMBDA_EXPORT_MAX_BYTES:
+                # Stops reading the table, the response could not be returned anyway
+                logger.warning("Export over the Lambda response limit", user_id=str(user_id), dogs=len(body))
+                return Response(status_code=413, content_type="application/json", body={
+                    "message": f"The export of user {user_id} is larger than a Lambda response can be, export it from server mode"})
+            body.append(line)
+        return Response(status_code=200, content_type=NDJSON_CONTENT_TYPE, body="".join(body))
+    stream.send(200, {"Content-Type": NDJSON_CONTENT_TYPE}, lines)
+    return Response(status_code=200, content_type=NDJSON_CONTENT_TYPE, body="")
+
 @app.post("/users/<user_id>/dogs", responses={201: {"model": CreateDogResponsePayload}})
-@tracer.capture_method
+@trace_route
 def create_user_dog(user_id: Annotated[UUID, Path(description="user id as UUID")], body: CreateDogRequestPayload) -> CreateDogResponsePayload:
     serv = get_dogs_service()
     created_dog = serv.handle_user_dogs_post(str(user_id), body)
     return created_dog
 
+@app.delete("/users/<user_id>/dogs/<dog_id>", responses={202: {"model": DeleteDogResponsePayload}})
+@trace_route
+def delete_user_dog(
+    user_id: Annotated[UUID, Path(description="user id as UUID")],
+    dog_id: Annotated[int, Path(description="dog id as integer")]
+) -> DeleteDogResponsePayload:
+    serv = get_dogs_service()
+    deleted_dog = serv.handle_user_dog_delete(str(user_id), dog_id)
+    if deleted_dog.status == DogDeletionStatus.DELETING:
+        return Response(
+            status_code=202,
+            content_type="application/json",
+            body=deleted_dog.serialize_model()
+        )
+    return deleted_dog
+
+@app.get("/users/<user_id>/dogs/<dog_id>/images")
+@trace_route(capture_response=False)
+def get_dog_images(
+    user_id: Annotated[UUID, Path(description="user id as UUID")],
+    dog_id: Annotated[int, Path(description="dog id as integer")],
+    limit: Annotated[int, Query(description="max number of images, newest first", ge=1, le=100)] = 20,
+    next_token: Annotated[Optional[str], Query(description="token from the previous page")] = None
+) -> GetImagesResponsePayload:
+    serv = get_dogs_service()
+    images = serv.handle_dog_images_get(str(user_id), dog_id, limit, next_token)
+    return images
+
 @app.post("/users/<user_id>/dogs/<dog_id>/images", responses={201: {"model": CreateImageResponsePayload}})
-@tracer.capture_method
+@trace_route
 def create_dog_image_placeholder(
     user_id: Annotated[UUID, Path(description="user id as UUID")],
     dog_id: Annotated[int, Path(description="dog id as integer")],
@@ -64,8 +166,41 @@ def create_dog_image_placeholder(
     image_response = serv.handle_create_image(str(user_id), dog_id, body)
     return image_response
 
+@app.post("/users/<user_id>/dogs/<dog_id>/images/multipart", responses={201: {"model": CreateMultipartImageResponsePayload}})
+@trace_route
+def create_dog_image_multipart_upload(
+    user_id: Annotated[UUID, Path(description="user id as UUID")],
+    dog_id: Annotated[int, Path(description="dog id as integer")],
+    body: CreateMultipartImageRequestPayload
+) -> CreateMultipartImageResponsePayload:
+    serv = get_dogs_service()
+    upload_response = serv.handle_create_multipart_image(str(user_id), dog_id, body)
+    return upload_response
+
+@app.post("/users/<user_id>/dogs/<dog_id>/images/<image_id>/multipart/complete")
+@trace_route
+def complete_dog_image_multipart_upload(
+    user_id: Annotated[UUID, Path(description="user id as UUID")],
+    dog_id: Annotated[int, Path(description="dog id as integer")],
+    image_id: Annotated[int, Path(description="image id as integer")]
+) -> ImageInfo:
+    serv = get_dogs_service()
+    image_info = serv.handle_complete_multipart_image(str(user_id), dog_id, image_id)
+    return image_info
+
+@app.delete("/users/<user_id>/dogs/<dog_id>/images/<image_id>/multipart")
+@trace_route
+def abort_dog_image_multipart_upload(
+    user_id: Annotated[UUID, Path(description="user id as UUID")],
+    dog_id: Annotated[int, Path(description="dog id as integer")],
+    image_id: Annotated[int, Path(description="image id as integer")]
+) -> ImageInfo:
+    serv = get_dogs_service()
+    image_info = serv.handle_abort_multipart_image(str(user_id), dog_id, image_id)
+    return image_info
+
 @app.get("/health")
-@tracer.capture_method
+@trace_route
 def health_check():
     health_service = get_health_service()
     health_status = health_service.get_health_status()
@@ -80,12 +215,39 @@ def health_check():
 
 app.exception_handler(ClientError)(eh.handle_boto_client_error)
 app.exception_handler(BotoCoreError)(eh.handle_boto_core_error)
+app.exception_handler(StorageError)(eh.handle_storage_error)
+app.exception_handler(ConditionalCheckFailed)(eh.handle_conditional_check_failed)
+app.exception_handler(CircuitOpenError)(eh.handle_circuit_open)
+app.exception_handler(ImagesNotDeleted)(eh.handle_images_not_deleted)
 app.exception_handler(ServiceError)(eh.handle_service_error)
 app.exception_handler(ValueError)(eh.handle_value_error)
 app.exception_handler(RequestValidationError)(eh.handle_request_validation_error)
 app.exception_handler(Exception)(eh.handle_generic_error)
 
+def prime_dogs_service():
+    serv = get_dogs_service()
+    prime(app_config, lambda: prime_clients(serv.db, serv.s3), prime_models)
+
+# Optional priming runs during Lambda init, so the first request doesn't pay for building clients,
+# validators and the first TLS handshakes
+if app_config.prime_on_init:
+    prime_dogs_service()
+
+def route_name(event: dict) -> str:
+    return f"{event.get('httpMethod')} {event.get('resource')}"
+
+def path_user_id(event: dict) -> Optional[str]:
+    return (event.get("pathParameters") or {}).get("user_id")
+
 @logger.inject_lambda_context(correlation_id_path=correlation_paths.API_GATEWAY_REST)
-@tracer.capture_lambda_handler
+@tracer.capture_lambda_handler(capture_response=False)
+@buffered_logs
+@record_first_request(app_config, primed=app_config.prime_on_init)
+@log_request_metrics(app_config,
+                     route_fn=route_name,
+                     metadata_fn=lambda event: {"user_id": path_user_id(event)})
+@rate_limit(app_config, route_fn=route_name, user_fn=path_user_id, cors=cors_config)
+@shed_load(app_config, dependencies=WRITE_ROUTE_DEPENDENCIES, cors=cors_config)
+@profile_handler(app_config, route_fn=route_name)
 def lambda_handler(event: dict, context: LambdaContext) -> dict:
     return app.resolve(event, context)
@@ -1,8 +1,13 @@
+import math
+
 from aws_lambda_powertools.event_handler import Response
 from aws_lambda_powertools.event_handler.openapi.exceptions import RequestValidationError
 from botocore.exceptions import ClientError, BotoCoreError
 from aws_lambda_powertools.event_handler.exceptions import ServiceError
 from dogs_common.observability import logger
+from dogs_common.resilience import CircuitOpenError
+from dogs_common.storage import ConditionalCheckFailed, StorageError
+from dogs_common.tasks import ImagesNotDeleted
 
 def handle_boto_client_error(e: ClientError) -> Response:
     logger.exception("ClientError: %s", e)
@@ -12,6 +17,26 @@ def handle_boto_core_error(e: BotoCoreError) -> Response:
     logger.exception("BotoCoreError: %s", e)
     return Response(status_code=503, content_type="application/json", body={"message": str(e)})
 
+def handle_storage_error(e: StorageError) -> Response:
+    logger.exception("StorageError: %s", e)
+    return Response(status_code=503, content_type="application/json", body={"message": str(e)})
+
+def handle_conditional_check_failed(e: ConditionalCheckFailed) -> Response:
+    # A concurrent request updated the item first
+    logger.warning("ConditionalCheckFailed: %s", e)
+    return Response(status_code=409, content_type="application/json", body={"message": "The item was modified concurrently, retry the request"})
+
+def handle_circuit_open(e: CircuitOpenError) -> Response:
+    # Not logged as an exception: the breaker already logged why it opened
+    logger.warning("CircuitOpenError: %s", e)
+    return Response(status_code=503, content_type="application/json", body={"message": str(e)},
+                    headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+def handle_images_not_deleted(e: ImagesNotDeleted) -> Response:
+    # The dog and the rows of the objects left are kept, deleting the dog again retries them
+    logger.error("ImagesNotDeleted: %s", e, s3_keys=e.s3_keys[:10])
+    return Response(status_code=503, content_type="application/json", body={"message": f"{e}, retry the request"})
+
 def handle_service_error(e: ServiceError) -> Response:
     logger.exception("ServiceError: %s", e)
     return Response(status_code=503, content_type="application/json", body={
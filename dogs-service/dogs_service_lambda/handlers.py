@@ -1,36 +1,118 @@
 from aws_lambda_powertools.event_handler.exceptions import ServiceError
 from aws_lambda_powertools import Logger
+from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime, timezone
-from dogs_common.db import DynamoDBClient, get_dogs_db_client
+from math import ceil
+from dogs_common.db import DogsDbClient, get_dogs_db_client
 from dogs_common.config import AppConfig
+from dogs_common.fanout import get_fanout
 from dogs_common.models import DogDb, CreateDogRequestPayload, CreateDogResponsePayload
 from dogs_common.models import GetDogResponsePayload, ImageUploadInstructions, CreateImageRequestPayload
 from dogs_common.models import CreateImageResponsePayload, ImageDb, ImageInfo
-from typing import List, Dict, Any
+from dogs_common.models import DeleteDogResponsePayload, DeleteDogTask, DogDeletionStatus
+from dogs_common.models import GetImagesResponsePayload, ImageStatus, UpdateImageRequestPayload
+from dogs_common.models import CreateMultipartImageRequestPayload, CreateMultipartImageResponsePayload
+from dogs_common.models import MultipartUploadInstructions, MultipartUploadPart
+from dogs_common.models import BatchGetUserDogsResponsePayload, UserDogsError, UserDogsResult
+from dogs_common.observability import logger
+from dogs_common.rate_limit import get_rate_limiter
+from dogs_common.resilience import CircuitOpenError
+from dogs_common.storage import StorageError
+from typing import Iterator, List, Dict, Any, Optional
 from dogs_common.s3 import S3Client, get_s3_client
-from dogs_common.utils import get_content_type_from_extension
+from dogs_common.tasks import TasksClient, delete_dog_images, get_tasks_client
+from dogs_common.utils import get_content_type_from_extension, encode_page_token, decode_page_token
+
+# Rate limit route of GET /users/{user_id}/dogs, as named by route_name in app.py
+USER_DOGS_ROUTE = "GET /users/{user_id}/dogs"
+
 
 class DogsService:
 
     def __init__(self, app_config: AppConfig):
         self.app_config = app_config
-        self.db: DynamoDBClient = get_dogs_db_client(app_config=app_config)
+        self.db: DogsDbClient = get_dogs_db_client(app_config=app_config)
         self.s3: S3Client = get_s3_client(app_config=app_config)
+        self.tasks: TasksClient = get_tasks_client(app_config=app_config)
 
     def handle_user_dogs_get(self, user_id: str) -> List[GetDogResponsePayload]:
         dogs_db: List[DogDb] = self.db.batch_query_dogs_with_images(user_id)
         return [GetDogResponsePayload.create(dog_db) for dog_db in dogs_db]
 
+    def handle_users_dogs_batch_get(self, user_ids: List[str]) -> BatchGetUserDogsResponsePayload:
+        # One lookup per user on the fanout pool; a user that fails gets an error entry, the others still get their dogs
+        user_ids = list(dict.fromkeys(user_ids))
+        if len(user_ids) > self.app_config.batch_max_users:
+            raise ValueError(f"Too many users: {len(user_ids)}/{self.app_config.batch_max_users}")
+        # Each entry reads the same items as the single user route and spends a token of that user's bucket
+        limiter = get_rate_limiter(self.app_config)
+        waits = {user_id: limiter.acquire(user_id, USER_DOGS_ROUTE) for user_id in user_ids}
+        allowed = [user_id for user_id in user_ids if not waits[user_id]]
+        results = dict(zip(allowed, get_fanout(self.app_config).map(
+            lambda db, user_id: db.batch_query_dogs_with_images(user_id), allowed)))
+        users = []
+        for user_id in user_ids:
+            if waits[user_id]:
+                logger.info("Rate limited", user_id=user_id, retry_after=round(waits[user_id], 2))
+                users.append(UserDogsResult(user_id=user_id, error=UserDogsError(
+                    status=429, message="Too many requests, retry later", retry_after=max(1, ceil(waits[user_id])))))
+                continue
+            result = results[user_id]
+            if isinstance(result, Exception):
+                users.append(UserDogsResult(user_id=user_id, error=self._user_dogs_error(user_id, result)))
+            else:
+                users.append(UserDogsResult(user_id=user_id, dogs=tuple(GetDogResponsePayload.create(dog_db) for dog_db in result)))
+        return BatchGetUserDogsResponsePayload(users=tuple(users))
+
+    def _user_dogs_error(self, user_id: str, e: Exception) -> UserDogsError:
+        # Same statuses as the exception handlers of the single user route
+        if isinstance(e, CircuitOpenError):
+            logger.warning("CircuitOpenError: %s", e, user_id=user_id)
+            return UserDogsError(status=503, message=str(e), retry_after=max(1, ceil(e.retry_after)))
+        if isinstance(e, (ClientError, BotoCoreError, StorageError)):
+            logger.exception("Batch lookup failed: %s", e, user_id=user_id, exc_info=e)
+            return UserDogsError(status=503, message=str(e))
+        logger.exception("Batch lookup failed: %s", e, user_id=user_id, exc_info=e)
+        return UserDogsError(status=500, message="An unexpected error occurred")
+
+    def handle_user_dogs_export(self, user_id: str) -> Iterator[str]:
+        # NDJSON lines, one dog with all its images per line, produced as the pages are read
+        for dog_db in self.db.iter_dogs_with_images(user_id, self.app_config.export_page_size):
+            yield GetDogResponsePayload.create(dog_db).model_dump_json() + "\n"
+
     def handle_user_dogs_post(self, user_id: str, dog: CreateDogRequestPayload) -> CreateDogResponsePayload:
         dog_db: DogDb = self.db.create_dog(user_id, dog)
         return CreateDogResponsePayload.create(dog_db)
 
+    def handle_user_dog_delete(self, user_id: str, dog_id: int) -> DeleteDogResponsePayload:
+        # Reads one image past the limit to tell a large gallery, not the whole gallery
+        max_images = self.app_config.dog_delete_sync_max_images
+        images, last_key = self.db.query_images_page_by_dog(user_id, dog_id, max_images + 1)
+
+        if (len(images) > max_images or last_key is not None) and self.tasks.is_enabled():
+            # Large gallery: hide the dog right away, images are cleaned up by the background task.
+            # images_count is the number of images read, at least DOG_DELETE_SYNC_MAX_IMAGES + 1
+            self.db.delete_dog(user_id, dog_id)
+            self.tasks.submit(DeleteDogTask(user_id=user_id, dog_id=dog_id))
+            return DeleteDogResponsePayload(dog_id=dog_id, status=DogDeletionStatus.DELETING, images_count=len(images))
+
+        # A missing dog fails before any image is touched. The dog is deleted after its images, so a failed
+        # cleanup keeps it and deleting it again retries. Images created meanwhile are swept once it is gone
+        self.db.get_dog(user_id, dog_id)
+        images_count = delete_dog_images(self.db, self.s3, user_id, dog_id)
+        self.db.delete_dog(user_id, dog_id)
+        images_count += delete_dog_images(self.db, self.s3, user_id, dog_id)
+        return DeleteDogResponsePayload(dog_id=dog_id, status=DogDeletionStatus.DELETED, images_count=images_count)
+
+    def handle_dog_images_get(self, user_id: str, dog_id: int, limit: int, next_token: Optional[str] = None) -> GetImagesResponsePayload:
+        start_key = decode_page_token(next_token) if next_token else None
+        images_db, last_key = self.db.query_images_page_by_dog(user_id, dog_id, limit, start_key)
+        return GetImagesResponsePayload.create(images_db, encode_page_token(last_key) if last_key else None)
+
     def handle_create_image(self, user_id: str, dog_id: int, image_request: CreateImageRequestPayload) -> CreateImageResponsePayload:
+        extension = self._parse_image_extension(image_request.image_extension)
         image_id = self.db.create_image_id(user_id)
-        extension = image_request.image_extension.strip().lstrip(".").lower()
-        if extension not in self.app_config.supported_image_extensions:
-            raise ValueError(f"Unsupported image extension: {extension}. Supported extensions: {self.app_config.supported_image_extensions}")
-        s3_key = f"users/{user_id}/dogs/{dog_id}/images/{image_id}.{extension}"
+        s3_key = self._image_s3_key(user_id, dog_id, image_id, extension)
         
         expires_in = self.app_config.image_upload_expiration_secs
         content_type = get_content_type_from_extension(extension)
@@ -52,6 +134,81 @@ class DogsService:
             upload_instructions=upload_instructions
         )
 
+    def handle_create_multipart_image(self, user_id: str, dog_id: int, image_request: CreateMultipartImageRequestPayload) -> CreateMultipartImageResponsePayload:
+        extension = self._parse_image_extension(image_request.image_extension)
+        max_size = self.app_config.image_multipart_upload_max_size
+        if image_request.size > max_size:
+            raise ValueError(f"Image size exceeds limit: {image_request.size}/{max_size}")
+        image_id = self.db.create_image_id(user_id)
+        s3_key = self._image_s3_key(user_id, dog_id, image_id, extension)
+
+        expires_in = self.app_config.image_upload_expiration_secs
+        content_type = get_content_type_from_extension(extension)
+        part_size = self.app_config.image_multipart_part_size
+        part_count = ceil(image_request.size / part_size)
+        upload_id = self.s3.create_multipart_upload(s3_key, content_type)
+        part_urls = self.s3.generate_presigned_upload_part_urls(s3_key, upload_id, part_count, expires_in)
+
+        image_db: ImageDb = self.db.create_image(user_id, dog_id, image_id, upload_id=upload_id, upload_key=s3_key,
+                                                 part_count=part_count)
+        image_info: ImageInfo = ImageInfo.create(image_db)
+
+        # Parts may be uploaded in parallel; a failed part is retried with the same URL
+        upload_instructions = MultipartUploadInstructions(
+            method="PUT",
+            upload_id=upload_id,
+            part_size=part_size,
+            parts=tuple(MultipartUploadPart(part_number=i + 1, presigned_url=url) for i, url in enumerate(part_urls)),
+            expires_in=expires_in,
+            max_size=max_size
+        )
+
+        return CreateMultipartImageResponsePayload(
+            image=image_info,
+            upload_instructions=upload_instructions
+        )
+
+    def handle_complete_multipart_image(self, user_id: str, dog_id: int, image_id: int) -> ImageInfo:
+        image_db: ImageDb = self._get_pending_multipart_image(user_id, dog_id, image_id)
+        parts = self.s3.list_parts(image_db.upload_key, image_db.upload_id)
+        # S3 assembles whatever parts it has, a missing or failed part would make a truncated image
+        part_numbers = {part["PartNumber"] for part in parts}
+        expected = set(range(1, image_db.part_count + 1)) if image_db.part_count else part_numbers
+        unexpected = sorted(part_numbers - expected)
+        if unexpected:
+            raise ValueError(f"Multipart upload of image {image_id} has parts past its {image_db.part_count} parts: {unexpected}")
+        if not parts or part_numbers != expected:
+            missing = sorted(expected - part_numbers)
+            raise ValueError(f"Multipart upload of image {image_id} is incomplete, missing parts: {missing or 'all'}")
+        # The image becomes uploaded once the processor handles the CompleteMultipartUpload event
+        self.s3.complete_multipart_upload(image_db.upload_key, image_db.upload_id, parts)
+        return ImageInfo.create(image_db)
+
+    def handle_abort_multipart_image(self, user_id: str, dog_id: int, image_id: int) -> ImageInfo:
+        image_db: ImageDb = self._get_pending_multipart_image(user_id, dog_id, image_id)
+        self.s3.abort_multipart_upload(image_db.upload_key, image_db.upload_id)
+        update_payload = UpdateImageRequestPayload(
+            s3_key=image_db.upload_key,
+            status=ImageStatus.DELETED,
+            status_reason="Multipart upload aborted")
+        image_db = self.db.update_image(user_id, dog_id, image_id, update_payload)
+        return ImageInfo.create(image_db)
+
+    def _get_pending_multipart_image(self, user_id: str, dog_id: int, image_id: int) -> ImageDb:
+        image_db: ImageDb = self.db.get_image(user_id, dog_id, image_id)
+        if not image_db.upload_id or image_db.status != ImageStatus.PENDING:
+            raise ValueError(f"Image with id {image_id} has no multipart upload in progress.")
+        return image_db
+
+    def _parse_image_extension(self, image_extension: str) -> str:
+        extension = image_extension.strip().lstrip(".").lower()
+        if extension not in self.app_config.supported_image_extensions:
+            raise ValueError(f"Unsupported image extension: {extension}. Supported extensions: {self.app_config.supported_image_extensions}")
+        return extension
+
+    def _image_s3_key(self, user_id: str, dog_id: int, image_id: int, extension: str) -> str:
+        return f"users/{user_id}/dogs/{dog_id}/images/{image_id}.{extension}"
+
 
 class HealthService:
     def __init__(self, dogs_service: DogsService, app_config: AppConfig):
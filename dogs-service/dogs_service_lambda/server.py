@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# Serves the API routes of app.py over HTTP from a pre-fork pool of worker processes, for running the
+# service in a container instead of Lambda. Requests are translated to API Gateway REST proxy events and
+# go through app.lambda_handler, so routing, validation, metrics and logging behave as on Lambda.
+# Usage: PYTHONPATH=layers/common python dogs_service_lambda/server.py [--port 8080] [--workers 4]
+
+import argparse
+import base64
+import os
+import re
+import select
+import signal
+import socket
+import sys
+import time
+import uuid
+
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+# The app is imported once in the parent so workers start with every module loaded (copy on write)
+import app as app_module
+
+from aws_lambda_powertools import Logger
+from dogs_common.observability import tracer, tracing_mode
+from dogs_common.resilience import ConcurrencyLimiter, get_concurrency_limiter
+
+# Process lifecycle logs happen outside any request: without a trace id the buffered shared logger
+# would drop info records, so they go through an unbuffered logger
+logger = Logger(service=f"{app_module.app_config.powertools_service_name}-server",
+                level=app_module.app_config.log_level)
+
+
+class ServerContext:
+    # The parts of the Lambda context used by Powertools
+    function_name = "dogs-service-server"
+    function_version = "$LATEST"
+    memory_limit_in_mb = 0
+    invoked_function_arn = "arn:aws:lambda:local:000000000000:function:dogs-service-server"
+
+    def __init__(self, request_id: str, deadline: float, response_stream: "Optional[ChunkedResponseStream]" = None):
+        self.aws_request_id = request_id
+        self._deadline = deadline
+        self.response_stream = response_stream
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+@lru_cache(maxsize=None)
+def route_table() -> Tuple[Tuple[str, str, Pattern], ...]:
+    # (method, resource template, pattern) of every route, built from the public OpenAPI schema of the
+    # app rather than the resolver's internals. Takes ~150ms, main() builds it before forking. Templates
+    # with fewer parameters go first, so /users/{user_id}/dogs/export wins over a {dog_id} of "export"
+    routes = []
+    for template, path_item in app_module.app.get_openapi_schema().paths.items():
+        pattern = re.compile("^" + re.sub(r"\\\{(\w+)\\\}", r"(?P<\1>[^/]+)", re.escape(template)) + "$")
+        for method in ("get", "put", "post", "delete", "patch", "head", "options"):
+            if getattr(path_item, method) is not None:
+                routes.append((method.upper(), template, pattern))
+    return tuple(sorted(routes, key=lambda route: route[2].groups))
+
+
+def match_route(method: str, path: str) -> Tuple[str, Optional[dict]]:
+    # Resource template and path parameters as API Gateway sets them: metrics are grouped by the
+    # template, never by the raw path
+    for route_method, template, pattern in route_table():
+        if route_method == method:
+            match = pattern.match(path)
+            if match:
+                return template, match.groupdict() or None
+    return path, None
+
+
+def to_event(method: str, raw_path: str, headers, body: Optional[bytes], request_id: str, source_ip: str) -> dict:
+    url = urlsplit(raw_path)
+    resource, path_parameters = match_route(method, url.path)
+    multi_query = parse_qs(url.query, keep_blank_values=True) or None
+    multi_headers = {}
+    for key, value in headers.items():
+        multi_headers.setdefault(key, []).append(value)
+    try:
+        text_body = body.decode("utf-8") if body is not None else None
+        is_base64 = False
+    except UnicodeDecodeError:
+        text_body = base64.b64encode(body).decode("ascii")
+        is_base64 = True
+    return {
+        "resource": resource,
+        "path": url.path,
+        "httpMethod": method,
+        "headers": {key: values[-1] for key, values in multi_headers.items()},
+        "multiValueHeaders": multi_headers,
+        "queryStringParameters": {key: values[-1] for key, values in multi_query.items()} if multi_query else None,
+        "multiValueQueryStringParameters": multi_query,
+        "pathParameters": path_parameters,
+        "stageVariables": None,
+        "requestContext": {
+            "requestId": request_id,
+            "resourcePath": resource,
+            "httpMethod": method,
+            "path": url.path,
+            "stage": "server",
+            "identity": {"sourceIp": source_ip},
+        },
+        "body": text_body,
+        "isBase64Encoded": is_base64,
+    }
+
+
+class ChunkedResponseStream:
+    # Lets a route send its response while producing it (see the export route in app.py), still inside
+    # lambda_handler so metrics, limits and logs cover the whole response
+    chunk_size = 32 * 1024
+
+    def __init__(self, handler: "RequestHandler"):
+        self.handler = handler
+        self.started = False
+        self.completed = False
+
+    def send(self, status_code: int, headers: dict, chunks: Iterable[str]):
+        handler = self.handler
+        handler.send_response(status_code)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header("Transfer-Encoding", "chunked")
+        if handler.server.shutting_down:
+            handler.close_connection = True
+            handler.send_header("Connection", "close")
+        handler.end_headers()
+        self.started = True
+
+        # Small lines are grouped, a chunk per line would be a write per line
+        buffer, size = [], 0
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            buffer.append(data)
+            size += len(data)
+            if size >= self.chunk_size:
+                self._write(b"".join(buffer))
+                buffer, size = [], 0
+        if buffer:
+            self._write(b"".join(buffer))
+        handler.wfile.write(b"0\r\n\r\n")
+        self.completed = True
+
+    def _write(self, data: bytes):
+        self.handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # One per connection, kept by the worker across the requests of the connection (see WorkerHTTPServer)
+    protocol_version = "HTTP/1.1"
+    server_version = "dogs-service"
+
+    def __init__(self, request, client_address, server: "WorkerHTTPServer"):
+        # Unlike BaseRequestHandler, doesn't handle the connection right away
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.last_active = time.monotonic()
+        self.setup()
+
+    def setup(self):
+        # A client that stops sending in the middle of a request is dropped after this many seconds
+        self.timeout = self.server.keepalive_timeout
+        super().setup()
+
+    def handle_request(self):
+        self.close_connection = True
+        self.handle_one_request()
+        self.last_active = time.monotonic()
+
+    def has_pending_request(self) -> bool:
+        # Pipelined requests may already be read into rfile, where select can't see them
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_GET(self):
+        self._handle()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_HEAD = do_GET
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        request_id = self.headers.get("X-Request-Id") or str(uuid.uuid4())
+        event = to_event(self.command, self.path, self.headers, body, request_id, self.client_address[0])
+        stream = ChunkedResponseStream(self)
+        context = ServerContext(request_id, time.monotonic() + self.server.request_timeout, stream)
+
+        # Powertools keys the log buffer by the X-Ray trace id, each request gets its own
+        os.environ["_X_AMZN_TRACE_ID"] = f"Root=1-{int(time.time()):08x}-{uuid.uuid4().hex[:24]}"
+        if tracing_mode == "off":
+            response = app_module.lambda_handler(event, context)
+        else:
+            # Outside Lambda there is no facade segment, the sampler decides per request
+            with tracer.provider.in_segment(app_module.app_config.powertools_service_name):
+                response = app_module.lambda_handler(event, context)
+        if stream.started:
+            # The status was sent with the first chunk: a route failing after that can only cut the
+            # response short, without the last chunk, so the client sees it is incomplete
+            if not stream.completed:
+                self.close_connection = True
+            return
+        self._write_response(response)
+
+    def _write_response(self, response: dict):
+        body = response.get("body") or ""
+        payload = base64.b64decode(body) if response.get("isBase64Encoded") else body.encode("utf-8")
+        self.send_response(response["statusCode"])
+        for key, value in (response.get("headers") or {}).items():
+            self.send_header(key, value)
+        for key, values in (response.get("multiValueHeaders") or {}).items():
+            for value in values:
+                self.send_header(key, value)
+        self.send_header("Content-Length", str(len(payload)))
+        if self.server.shutting_down:
+            self.close_connection = True
+            self.send_header("Connection", "close")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Access logs are covered by the request metrics
+        pass
+
+
+class WorkerHTTPServer(HTTPServer):
+    # Serves its keep-alive connections one request at a time, and competes with the other workers to
+    # accept new ones. A connection is given up after keepalive_timeout idle seconds, or for a client
+    # this worker accepted when it already has max_connections: never because a client is waiting, the
+    # worker that wins the accept() serves it
+
+    def __init__(self, sock: socket.socket, request_timeout: float, keepalive_timeout: float, max_connections: int):
+        super().__init__(sock.getsockname(), RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_connections = max_connections
+        self.connections: Dict[socket.socket, RequestHandler] = {}
+        self.shutting_down = False
+
+    def begin_shutdown(self):
+        # Stops accepting connections, the request in progress is finished first. Runs in the signal
+        # handler, serve_forever sees it within poll_interval
+        self.shutting_down = True
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        pending: List[RequestHandler] = []
+        while not self.shutting_down:
+            # Connections with a pipelined request already read don't wait, but don't starve the others either
+            readable, _, _ = select.select([self.socket, *self.connections], [], [], 0 if pending else poll_interval)
+            if self.socket in readable:
+                self._accept()
+            ready = [handler for handler in pending if handler.connection in self.connections]
+            ready += [self.connections[sock] for sock in readable if sock in self.connections and self.connections[sock] not in ready]
+            for handler in ready:
+                self._serve(handler)
+            pending = [handler for handler in ready if handler.connection in self.connections and handler.has_pending_request()]
+            self._close_idle()
+        for handler in list(self.connections.values()):
+            self._close(handler)
+
+    def _accept(self):
+        try:
+            sock, client_address = self.socket.accept()
+        except BlockingIOError:
+            # Another worker accepted it
+            return
+        if len(self.connections) >= self.max_connections:
+            self._close(min(self.connections.values(), key=lambda handler: handler.last_active))
+        handler = RequestHandler(sock, client_address, self)
+        self.connections[sock] = handler
+
+    def _serve(self, handler: RequestHandler):
+        try:
+            handler.handle_request()
+        except OSError:
+            handler.close_connection = True
+        except Exception:
+            logger.exception("Request failed", client=handler.client_address[0])
+            handler.close_connection = True
+        if handler.close_connection:
+            self._close(handler)
+
+    def _close_idle(self):
+        expired = time.monotonic() - self.keepalive_timeout
+        for handler in [handler for handler in self.connections.values() if handler.last_active < expired]:
+            self._close(handler)
+
+    def _close(self, handler: RequestHandler):
+        del self.connections[handler.connection]
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.connection)
+
+
+def run_worker(sock: socket.socket, request_timeout: float, keepalive_timeout: float, max_connections: int):
+    # The parent stops workers with SIGTERM, Ctrl-C in a terminal must not kill them mid request
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Connections and clients created in the parent must not be shared between processes
+    app_module.reset_dogs_service()
+    if app_module.app_config.prime_on_init:
+        app_module.prime_dogs_service()
+    server = WorkerHTTPServer(sock, request_timeout, keepalive_timeout, max_connections)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.begin_shutdown())
+    logger.info("Worker started", pid=os.getpid())
+    server.serve_forever()
+    logger.info("Worker stopped", pid=os.getpid())
+
+
+class Arbiter:
+    # Forks the workers, replaces the ones that die and stops all of them on SIGTERM/SIGINT
+
+    def __init__(self, sock: socket.socket, workers: int, graceful_timeout: float,
+                 request_timeout: float, keepalive_timeout: float, max_connections: int,
+                 limiter: ConcurrencyLimiter):
+        self.sock = sock
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_connections = max_connections
+        self.limiter = limiter
+        # Row of the shared concurrency counts of each worker, a new worker takes over the row of the dead one
+        self.pids: Dict[int, int] = {}
+        self.stopping = False
+
+    def spawn(self, row: int):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self.limiter.bind(row)
+                run_worker(self.sock, self.request_timeout, self.keepalive_timeout, self.max_connections)
+            except Exception:
+                logger.exception("Worker failed")
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+        self.pids[pid] = row
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Stopping workers", signal=signal.Signals(signum).name, timeout=self.graceful_timeout)
+        self._signal_workers(signal.SIGTERM)
+        signal.signal(signal.SIGALRM, lambda *args: self._signal_workers(signal.SIGKILL))
+        signal.alarm(max(1, int(self.graceful_timeout)))
+
+    def _signal_workers(self, signum: int):
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                self.pids.pop(pid, None)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for row in range(self.workers):
+            self.spawn(row)
+        logger.info("Server started", address=self.sock.getsockname(), workers=self.workers)
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            row = self.pids.pop(pid, None)
+            if row is None:
+                continue
+            # A killed worker never released the concurrency slots of its in-flight requests
+            self.limiter.reset(row)
+            if not self.stopping:
+                logger.warning("Worker exited, starting a new one", pid=pid, status=status)
+                # Avoids a tight respawn loop when workers fail right at start
+                time.sleep(1)
+                self.spawn(row)
+        signal.alarm(0)
+        logger.info("Server stopped")
+
+
+def main() -> int:
+    config = app_module.app_config
+    parser = argparse.ArgumentParser(description="Serve the Dogs Service API from a pool of worker processes")
+    parser.add_argument("--host", default=config.server_host)
+    parser.add_argument("--port", type=int, default=config.server_port)
+    parser.add_argument("--workers", type=int, default=config.server_workers or os.cpu_count())
+    parser.add_argument("--graceful-timeout", type=float, default=config.server_graceful_timeout_secs,
+                        help="seconds workers get to finish in-flight requests on shutdown")
+    args = parser.parse_args()
+
+    sock = socket.create_server((args.host, args.port), backlog=config.server_backlog)
+    # Every worker waits on the same socket: non blocking, so a worker that loses the race for a
+    # connection returns to its loop (and can shut down) instead of blocking in accept()
+    sock.setblocking(False)
+    # Concurrency limits count the requests of all the workers
+    limiter = get_concurrency_limiter(config)
+    limiter.share(args.workers)
+    route_table()
+    Arbiter(sock, args.workers, args.graceful_timeout,
+            request_timeout=config.server_request_timeout_secs,
+            keepalive_timeout=config.server_keepalive_timeout_secs,
+            max_connections=config.server_worker_connections,
+            limiter=limiter).run()
+    sock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+from functools import lru_cache
+from typing import Optional
+import boto3
+import threading
+
+from botocore.config import Config
+from .config import AppConfig
+from .request_metrics import instrument_client
+from .resilience import instrument_breaker
+
+# All clients and resources are created from one session so credentials are resolved once and
+# every client gets the same pool, keepalive and retry settings from AppConfig.
+# Clients are thread safe, resources are not: threads must not share a resource.
+
+_session_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def get_session() -> boto3.session.Session:
+    return boto3.session.Session()
+
+def client_config(app_config: AppConfig, **overrides) -> Config:
+    config = Config(
+        max_pool_connections=app_config.boto_max_pool_connections,
+        tcp_keepalive=app_config.boto_tcp_keepalive,
+        connect_timeout=app_config.boto_connect_timeout,
+        read_timeout=app_config.boto_read_timeout,
+        retries={"mode": app_config.boto_retry_mode, "total_max_attempts": app_config.boto_max_attempts},
+    )
+    return config.merge(Config(**overrides)) if overrides else config
+
+@lru_cache(maxsize=None)
+def get_client(app_config: AppConfig, service_name: str, endpoint_url: Optional[str] = None, **overrides):
+    with _session_lock:
+        client = get_session().client(service_name, endpoint_url=endpoint_url,
+                                      config=client_config(app_config, **overrides))
+    if app_config.request_metrics_enabled:
+        instrument_client(client)
+    if app_config.circuit_breaker_enabled:
+        instrument_breaker(client, app_config)
+    return client
+
+@lru_cache(maxsize=None)
+def get_resource(app_config: AppConfig, service_name: str, endpoint_url: Optional[str] = None, **overrides):
+    return create_resource(app_config, service_name, endpoint_url, **overrides)
+
+def create_resource(app_config: AppConfig, service_name: str, endpoint_url: Optional[str] = None, **overrides):
+    # Not cached: for threads that can't share the resource of get_resource (see dogs_common.fanout).
+    # The session isn't thread safe either, resources are created one at a time
+    with _session_lock:
+        resource = get_session().resource(service_name, endpoint_url=endpoint_url,
+                                          config=client_config(app_config, **overrides))
+    if app_config.request_metrics_enabled:
+        instrument_client(resource.meta.client)
+    if app_config.circuit_breaker_enabled:
+        instrument_breaker(resource.meta.client, app_config)
+    return resource
+
+def reset_clients():
+    # Pooled connections must not be shared across processes, forked workers call this first
+    get_resource.cache_clear()
+    get_client.cache_clear()
+    get_session.cache_clear()
@@ -1,15 +1,89 @@
-from typing import Optional
+import json
+
+from typing import Literal, Optional
 from functools import lru_cache
 from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings
+from .keys import PHASH_BANDS
 
 class AppConfig(BaseSettings):
 
     # Service configuration
     powertools_service_name: str = "dogs_service"
     log_level: str = "INFO"
+    log_buffer_enabled: bool = Field(default=True)
+    log_buffer_level: Literal["DEBUG", "INFO"] = Field(default="INFO")
+    log_buffer_max_bytes: int = Field(default=20480)
+    log_buffer_sample_rate: float = Field(default=0.01, ge=0, le=1)
+    log_max_field_length: int = Field(default=1024)
+    log_max_collection_items: int = Field(default=20)
+    metrics_namespace: str = "DogsService"
+    prime_on_init: bool = Field(default=False)
+    # off: no X-Ray SDK at all, minimal: subsegments around hot DynamoDB/S3 calls, full: every AWS call and route
+    tracing_mode: Literal["off", "minimal", "full"] = Field(default="minimal")
+    tracing_sampling_rate: float = Field(default=0.05, ge=0, le=1)
+    tracing_sampling_reservoir: int = Field(default=1, ge=0)
+    request_metrics_enabled: bool = Field(default=True)
+    # Adds a Server-Timing header with the AWS calls of the request, for debugging only
+    request_metrics_debug_header: bool = Field(default=False)
+
+    # Profiling of sampled invocations with tracemalloc and cProfile (see dogs_common.profiling), slows them down
+    profiling_enabled: bool = Field(default=False)
+    profiling_sample_rate: float = Field(default=1.0, ge=0, le=1)
+    profiling_top_n: int = Field(default=10, ge=1)
+    profiling_traceback_frames: int = Field(default=10, ge=1)
+    profiling_output: Literal["log", "file"] = Field(default="log")
+    profiling_dump_dir: str = "/tmp/profiles"
+
+    # Server mode configuration (dogs_service_lambda/server.py)
+    server_host: str = "0.0.0.0"
+    server_port: int = Field(default=8080)
+    server_workers: Optional[int] = None
+    server_backlog: int = Field(default=128)
+    server_graceful_timeout_secs: int = Field(default=30)
+    server_request_timeout_secs: int = Field(default=30)
+    server_keepalive_timeout_secs: int = Field(default=5)
+    server_worker_connections: int = Field(default=100, ge=1)
+
+    # AWS clients configuration, shared by every boto3 client (see dogs_common.aws)
+    boto_max_pool_connections: int = Field(default=25, ge=1)
+    boto_tcp_keepalive: bool = Field(default=True)
+    boto_retry_mode: Literal["legacy", "standard", "adaptive"] = Field(default="standard")
+    boto_max_attempts: int = Field(default=3, ge=1)
+    boto_connect_timeout: int = Field(default=2)
+    boto_read_timeout: int = Field(default=5)
+
+    # Circuit breakers of the AWS clients and load shedding of the API (see dogs_common.resilience)
+    circuit_breaker_enabled: bool = Field(default=True)
+    circuit_window_size: int = Field(default=20, ge=1)
+    circuit_min_calls: int = Field(default=10, ge=1)
+    circuit_failure_ratio: float = Field(default=0.5, gt=0, le=1)
+    circuit_open_secs: float = Field(default=1.0, gt=0)
+    circuit_max_open_secs: float = Field(default=30.0, gt=0)
+    # Writes are shed while a service fails this often, 0 sheds them only while its circuit is open
+    shed_writes_failure_ratio: float = Field(default=0.2, ge=0, le=1)
+    # Retry-After of requests shed over a concurrency limit, slots usually free up within a request time
+    shed_retry_after_secs: int = Field(default=1, ge=1)
+    # In-flight request limits, shared by all the workers in server mode. Route limits are JSON,
+    # e.g. {"POST /users/{user_id}/dogs/{dog_id}/images": 8}
+    max_concurrent_reads: Optional[int] = Field(default=None, ge=1)
+    max_concurrent_writes: Optional[int] = Field(default=None, ge=1)
+    route_concurrency_limits: str = Field(default="{}")
+
+    # Token buckets per user and route (see dogs_common.rate_limit). JSON of rate (tokens per second) and
+    # burst per route, "*" for the other routes, e.g. {"POST /users/{user_id}/dogs": {"rate": 1, "burst": 5}}
+    rate_limits: str = Field(default="{}")
+    # Share the buckets of all the containers through the table, otherwise each container limits on its own
+    rate_limit_shared: bool = Field(default=True)
+    # Tokens taken from the shared bucket per table update, and how long unused ones are kept
+    rate_limit_lease_size: int = Field(default=5, ge=1)
+    rate_limit_lease_secs: float = Field(default=1.0, gt=0)
+    rate_limit_max_users: int = Field(default=10000, ge=1)
 
     # Database configuration
+    # dynamodb in AWS, memory (per process) or sqlite (file at SQLITE_PATH) to run without AWS (see dogs_common.storage)
+    storage_backend: Literal["dynamodb", "memory", "sqlite"] = Field(default="dynamodb")
+    sqlite_path: str = "dogs-service.sqlite3"
     dogs_table_name: str
     dynamodb_endpoint: Optional[str] = None
 
@@ -17,15 +91,39 @@ class AppConfig(BaseSettings):
     dogs_images_bucket: str
     s3_endpoint: Optional[str] = None
     s3_presign_endpoint: Optional[str] = None
+    # Multipart completion and object reads can take longer than a DynamoDB call
+    s3_read_timeout: int = Field(default=60)
 
     # Upload configuration
     image_upload_expiration_secs: int = Field(default=3600)
     image_upload_max_size: int = Field(default=5 * 1024 * 1024)
     supported_image_extensions: str = Field(default=['jpg', 'jpeg', 'png', 'webp'])
+    image_multipart_upload_max_size: int = Field(default=100 * 1024 * 1024)
+    image_multipart_part_size: int = Field(default=8 * 1024 * 1024)
+    # Also read legacy unpadded image sort keys, until scripts/migrate_image_sort_keys.py has completed
+    image_sk_legacy_reads: bool = Field(default=True)
+
+    # Deduplication configuration
+    image_dedup_enabled: bool = Field(default=True)
+    # Near duplicates are looked up by perceptual hash band (see dogs_common.keys), which finds every hash
+    # up to PHASH_BANDS - 1 bits away, reading at most IMAGE_PHASH_MAX_CANDIDATES hashes per band
+    image_phash_max_distance: int = Field(default=4, ge=0, le=PHASH_BANDS - 1)
+    image_phash_max_candidates: int = Field(default=50, ge=1)
+
+    # Background tasks configuration
+    background_tasks_function_name: Optional[str] = None
+    dog_delete_sync_max_images: int = Field(default=100)
+
+    # Export configuration: dogs per batch read and images per query page of GET .../dogs/export
+    export_page_size: int = Field(default=100, ge=1, le=100)
+
+    # Batch lookup configuration: users per GET /dogs request, and table reads in flight per container
+    batch_max_users: int = Field(default=50, ge=1)
+    batch_max_concurrency: int = Field(default=8, ge=1)
 
     model_config = {"case_sensitive": False, "frozen": True}
 
-    @field_validator("log_level")
+    @field_validator("log_level", "log_buffer_level", mode="before")
     @classmethod
     def validate_log_level(cls, v):
         return v.upper()
@@ -40,6 +138,11 @@ class AppConfig(BaseSettings):
     def set_s3_endpoint(cls, v, info):
         return None if v == "" else v
 
+    @field_validator("background_tasks_function_name")
+    @classmethod
+    def set_background_tasks_function_name(cls, v, info):
+        return None if v == "" else v
+
     @field_validator("s3_presign_endpoint")
     @classmethod
     def set_presign_endpoint(cls, v, info):
@@ -47,6 +150,41 @@ class AppConfig(BaseSettings):
             return info.data.get("s3_endpoint")
         return v
 
+    @field_validator("image_multipart_part_size")
+    @classmethod
+    def validate_image_multipart_part_size(cls, v):
+        # S3 rejects parts smaller than 5MB (except the last one)
+        if v < 5 * 1024 * 1024:
+            raise ValueError("IMAGE_MULTIPART_PART_SIZE must be at least 5MB")
+        return v
+
+    @field_validator("tracing_mode", "boto_retry_mode", "storage_backend", "profiling_output", mode="before")
+    @classmethod
+    def lower_case_modes(cls, v):
+        return v.lower() if isinstance(v, str) else v
+
+    @field_validator("route_concurrency_limits")
+    @classmethod
+    def validate_route_concurrency_limits(cls, v):
+        # Kept as a string, the config must stay hashable
+        limits = json.loads(v or "{}")
+        if not isinstance(limits, dict) or not all(isinstance(n, int) and n >= 1 for n in limits.values()):
+            raise ValueError('ROUTE_CONCURRENCY_LIMITS must be a JSON object of positive integers, e.g. {"GET /health": 2}')
+        return v or "{}"
+
+    @field_validator("rate_limits")
+    @classmethod
+    def validate_rate_limits(cls, v):
+        limits = json.loads(v or "{}")
+        valid = isinstance(limits, dict) and all(
+            isinstance(limit, dict) and set(limit) == {"rate", "burst"}
+            and isinstance(limit["rate"], (int, float)) and limit["rate"] > 0
+            and isinstance(limit["burst"], int) and limit["burst"] >= 1
+            for limit in limits.values())
+        if not valid:
+            raise ValueError('RATE_LIMITS must map routes to a positive rate and burst, e.g. {"*": {"rate": 10, "burst": 20}}')
+        return v or "{}"
+
     @field_validator("dogs_table_name")
     @classmethod
     def validate_dogs_table_name(cls, v):
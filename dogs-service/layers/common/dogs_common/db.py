@@ -1,55 +1,92 @@
-from functools import lru_cache
-import boto3
+from functools import cached_property, lru_cache
 import json
 
-from botocore.config import Config
-from boto3.dynamodb.conditions import Key
 from datetime import datetime, timedelta
 from decimal import Decimal
 
 from .config import AppConfig
+from .observability import trace_call
+from .keys import LEGACY_IMAGE_SK_PREFIXES, image_sk, image_sk_prefix, is_legacy_image_sk
+from .keys import legacy_image_sk, legacy_image_sk_prefix, parse_image_sk, phash_band_prefixes, phash_band_sks
+from .storage import ConditionalCheckFailed, ItemStore, create_item_store
 from .utils import DATETIME_NOW_UTC_FN
 from .models import DogDb, CreateDogRequestPayload, ImageStatus, UpdateDogRequestPayload, ImageDb, UpdateImageRequestPayload
-from typing import List
+from .models import ImageHashDb, RateLimitBucketDb
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
 
-class DynamoDBClient:
+class DogsDbClient:
+    # Dogs, images and image hashes on top of an ItemStore: DynamoDB, or the in-memory and SQLite
+    # stores selected by STORAGE_BACKEND
     
-    def __init__(self, app_config: AppConfig):
+    def __init__(self, app_config: AppConfig, dedicated_resource: bool = False):
+        self.app_config = app_config
         self.image_upload_expiration_secs = app_config.image_upload_expiration_secs
         self.table_name = app_config.dogs_table_name
-        self.endpoint_url = app_config.dynamodb_endpoint
-        config = Config(connect_timeout=2, read_timeout=5, retries={"max_attempts": 2})
-        self._ddb = boto3.resource("dynamodb", config=config, endpoint_url=self.endpoint_url)
-        self._table = self._ddb.Table(self.table_name)
+        self.image_sk_legacy_reads = app_config.image_sk_legacy_reads
+        # True for the clients of other threads, which can't share the DynamoDB resource
+        self.dedicated_resource = dedicated_resource
+
+    @cached_property
+    def _store(self) -> ItemStore:
+        return create_item_store(self.app_config, dedicated_resource=self.dedicated_resource)
     
     def query_dogs_by_user_id(self, user_id: str) -> List[DogDb]:
-        pk = f"USER#{user_id}"
-        resp = self._table.query(
-            KeyConditionExpression=Key("PK").eq(pk) & Key("SK").begins_with("DOG#")
-        )
-        items = resp.get("Items", [])
+        items, _ = self._store.query(f"USER#{user_id}", "DOG#")
         normalized_items = [self._normalize_item(item) for item in items]
         return [DogDb.model_validate(item) for item in normalized_items]
     
     def query_images_by_user(self, user_id: str) -> List[ImageDb]:
-        pk = f"USER#{user_id}"
-        resp = self._table.query(
-            KeyConditionExpression=Key("PK").eq(pk) & Key("SK").begins_with("IMAGE#")
-        )
-        items = resp.get("Items", [])
+        items, _ = self._store.query(f"USER#{user_id}", "IMAGE#")
         normalized_items = [self._normalize_item(item) for item in items]
         return [ImageDb.model_validate(item) for item in normalized_items]
     
-    def query_images_by_dog(self, user_id: str, dog_id: int) -> List[ImageDb]:
+    def iter_image_pages_by_dog(self, user_id: str, dog_id: int) -> Iterator[List[ImageDb]]:
+        # Every image of the dog, one query page (up to 1MB on DynamoDB) at a time. The start key
+        # stays valid when the items of the previous page were deleted meanwhile
+        for sk_prefix in self._image_sk_prefixes(dog_id):
+            start_key = None
+            while True:
+                items, start_key = self._store.query(f"USER#{user_id}", sk_prefix, start_key=start_key)
+                if items:
+                    yield [ImageDb.model_validate(self._normalize_item(item)) for item in items]
+                if start_key is None:
+                    break
+
+    def _image_sk_prefixes(self, dog_id: int) -> List[str]:
+        # Legacy rows have lower image ids than every padded row, so they come last in newest first order
+        if self.image_sk_legacy_reads:
+            return [image_sk_prefix(dog_id), legacy_image_sk_prefix(dog_id)]
+        return [image_sk_prefix(dog_id)]
+    
+    @trace_call("DynamoDB.query_images_page_by_dog")
+    def query_images_page_by_dog(self, user_id: str, dog_id: int, limit: int,
+                                 start_key: Optional[dict] = None) -> Tuple[List[ImageDb], Optional[dict]]:
+        # Newest first: image ids are zero padded in the SK so descending order is numeric order
         pk = f"USER#{user_id}"
-        sk_prefix = f"IMAGE#{dog_id}#"
-        resp = self._table.query(
-            KeyConditionExpression=Key("PK").eq(pk) & Key("SK").begins_with(sk_prefix)
-        )
-        items = resp.get("Items", [])
+        sk_prefixes = self._image_sk_prefixes(dog_id)
+        first = 0
+        if start_key is not None:
+            first = next((i for i, sk_prefix in enumerate(sk_prefixes) if str(start_key.get("SK", "")).startswith(sk_prefix)), None)
+            if start_key.get("PK") != pk or first is None:
+                raise ValueError("Invalid pagination token")
+
+        items, last_key = [], None
+        for i in range(first, len(sk_prefixes)):
+            page, last_key = self._store.query(pk, sk_prefixes[i], descending=True, limit=limit - len(items), start_key=start_key)
+            items.extend(page)
+            start_key = None
+            if last_key is not None:
+                break
+            if len(items) == limit:
+                # The next page starts with what is left of this prefix (nothing), then the next prefix
+                if i + 1 < len(sk_prefixes):
+                    last_key = {"PK": pk, "SK": items[-1]["SK"]}
+                break
         normalized_items = [self._normalize_item(item) for item in items]
-        return [ImageDb.model_validate(item) for item in normalized_items]
+        return [ImageDb.model_validate(item) for item in normalized_items], last_key
     
+    @trace_call("DynamoDB.batch_query_dogs_with_images")
     def batch_query_dogs_with_images(self, user_id: str) -> List[DogDb]:
         # TODO: Implement batch query to fetch dogs with their images in a single request
         dogs: List[DogDb] = self.query_dogs_by_user_id(user_id)
@@ -57,6 +94,58 @@ class DynamoDBClient:
         result_dogs: List[DogDb] = self._merge_dogs_with_images(dogs, images)
         return result_dogs
 
+    def iter_dogs_with_images(self, user_id: str, page_size: int) -> Iterator[DogDb]:
+        # Dogs in id order with their images, for exports of any size: dogs are read page_size ids
+        # at a time up to the user's counter and merged with one paginated query of the images,
+        # which are sorted by dog id. Only a page of each is held at a time
+        # Legacy rows aren't in dog order, they are read up front until the sort key migration is done
+        legacy_images = self._legacy_images_by_dog(user_id) if self.image_sk_legacy_reads else {}
+        images = (image for image in self.iter_images_by_user(user_id, page_size) if not is_legacy_image_sk(image.SK))
+        image = next(images, None)
+        last_dog_id = self.get_sequence_id(user_id, "dog_counter")
+        for first_dog_id in range(1, last_dog_id + 1, page_size):
+            dog_ids = range(first_dog_id, min(first_dog_id + page_size, last_dog_id + 1))
+            for dog in self.batch_get_dogs(user_id, list(dog_ids)):
+                dog_id = int(dog.SK.split("#")[1])
+                dog.images.extend(legacy_images.pop(dog_id, []))
+                # Images of deleted dogs are skipped
+                while image is not None and parse_image_sk(image.SK)[0] <= dog_id:
+                    if parse_image_sk(image.SK)[0] == dog_id:
+                        dog.images.append(image)
+                    image = next(images, None)
+                yield dog
+
+    def _legacy_images_by_dog(self, user_id: str) -> Dict[int, List[ImageDb]]:
+        images = defaultdict(list)
+        for sk_prefix in LEGACY_IMAGE_SK_PREFIXES:
+            start_key = None
+            while True:
+                items, start_key = self._store.query(f"USER#{user_id}", sk_prefix, start_key=start_key)
+                for item in items:
+                    image = ImageDb.model_validate(self._normalize_item(item))
+                    images[parse_image_sk(image.SK)[0]].append(image)
+                if start_key is None:
+                    break
+        return images
+
+    def iter_images_by_user(self, user_id: str, page_size: int) -> Iterator[ImageDb]:
+        start_key = None
+        while True:
+            items, start_key = self._store.query(f"USER#{user_id}", "IMAGE#", limit=page_size, start_key=start_key)
+            for item in items:
+                yield ImageDb.model_validate(self._normalize_item(item))
+            if start_key is None:
+                return
+
+    @trace_call("DynamoDB.batch_get_dogs")
+    def batch_get_dogs(self, user_id: str, dog_ids: List[int]) -> List[DogDb]:
+        # In dog id order, missing dogs are left out
+        pk = f"USER#{user_id}"
+        items = self._store.batch_get([{"PK": pk, "SK": f"DOG#{dog_id}"} for dog_id in dog_ids])
+        dogs = [DogDb.model_validate(self._normalize_item(item)) for item in items]
+        return sorted(dogs, key=lambda dog: int(dog.SK.split("#")[1]))
+
+    @trace_call("DynamoDB.create_dog")
     def create_dog(self, user_id: str, item: CreateDogRequestPayload) -> DogDb:
         seq = self._next_sequence_id(user_id, "dog_counter")
         pk = f"USER#{user_id}"
@@ -69,86 +158,82 @@ class DynamoDBClient:
             age=item.age
         )
 
-        self._table.put_item(Item=item.model_dump(exclude_none=True))
+        self._store.put(item.model_dump(exclude_none=True))
         return item
     
+    @trace_call("DynamoDB.get_dog")
     def get_dog(self, user_id: str, dog_id: int) -> DogDb:
-        pk = f"USER#{user_id}"
-        sk = f"DOG#{dog_id}"
-        
-        resp = self._table.get_item(Key={"PK": pk, "SK": sk})
-        item = resp.get("Item")
+        item = self._store.get({"PK": f"USER#{user_id}", "SK": f"DOG#{dog_id}"})
         if not item:
             raise ValueError(f"Dog with id {dog_id} for user {user_id} not found.")
         
         normalized_item = self._normalize_item(item)
         return DogDb.model_validate(normalized_item)
     
+    @trace_call("DynamoDB.update_dog")
     def update_dog(self, user_id: str, dog_id: int, current_version: int, item: UpdateDogRequestPayload) -> DogDb:
-        pk = f"USER#{user_id}"
-        sk = f"DOG#{dog_id}"
         now_iso = DATETIME_NOW_UTC_FN().isoformat()
 
-        resp = self._table.update_item(
-            Key={"PK": pk, "SK": sk},
-            UpdateExpression="SET #n = :name, #a = :age, #u = :updated_at ADD #v :inc",
-            ConditionExpression="attribute_not_exists(#v) OR #v = :current_version",
-            ExpressionAttributeNames={
-                "#n": "name",
-                "#a": "age",
-                "#u": "updated_at",
-                "#v": "version"
-            },
-            ExpressionAttributeValues={
-                ":name": item.name,
-                ":age": item.age,
-                ":updated_at": now_iso,
-                ":inc": Decimal(1),
-                ":current_version": Decimal(current_version)
-            },
-            ReturnValues="ALL_NEW"
+        updated_item = self._store.update(
+            {"PK": f"USER#{user_id}", "SK": f"DOG#{dog_id}"},
+            set_values={"name": item.name, "age": item.age, "updated_at": now_iso},
+            add={"version": 1},
+            expected_version=current_version
         )
-        
-        updated_item = resp.get("Attributes")
         if not updated_item:
             raise ValueError(f"Dog with id {dog_id} for user {user_id} not found.")
         
         normalized_item = self._normalize_item(updated_item)
         return DogDb.model_validate(normalized_item)
     
+    @trace_call("DynamoDB.delete_dog")
+    def delete_dog(self, user_id: str, dog_id: int):
+        try:
+            self._store.delete({"PK": f"USER#{user_id}", "SK": f"DOG#{dog_id}"}, if_exists=True)
+        except ConditionalCheckFailed:
+            raise ValueError(f"Dog with id {dog_id} for user {user_id} not found.")
+
+    @trace_call("DynamoDB.batch_delete_images")
+    def batch_delete_images(self, images: List[ImageDb]):
+        self._store.batch_delete([{"PK": image.PK, "SK": image.SK} for image in images])
+
     def create_image_id(self, user_id) -> int:
         return self._next_sequence_id(user_id, "image_counter")
 
-    def create_image(self, user_id: str, dog_id: int, image_id: int) -> ImageDb:
+    @trace_call("DynamoDB.create_image")
+    def create_image(self, user_id: str, dog_id: int, image_id: int,
+                     upload_id: Optional[str] = None, upload_key: Optional[str] = None,
+                     part_count: Optional[int] = None) -> ImageDb:
         pk = f"USER#{user_id}"
-        sk = f"IMAGE#{dog_id}#{image_id}"
+        sk = image_sk(dog_id, image_id)
         expires_at: datetime = DATETIME_NOW_UTC_FN() + timedelta(hours=self.image_upload_expiration_secs)
         item = ImageDb(
             PK=pk,
             SK=sk,
             status="pending",
-            expires_at=int(expires_at.timestamp())
+            expires_at=int(expires_at.timestamp()),
+            upload_id=upload_id,
+            upload_key=upload_key,
+            part_count=part_count
         )
         
-        self._table.put_item(Item=item.model_dump(exclude_none=True))
+        self._store.put(item.model_dump(exclude_none=True))
         return item
     
+    @trace_call("DynamoDB.get_image")
     def get_image(self, user_id: str, dog_id: int, image_id: int) -> ImageDb:
-        pk = f"USER#{user_id}"
-        sk = f"IMAGE#{dog_id}#{image_id}"
-        
-        resp = self._table.get_item(Key={"PK": pk, "SK": sk})
-        item = resp.get("Item")
+        item = self._store.get({"PK": f"USER#{user_id}", "SK": image_sk(dog_id, image_id)})
+        if not item and self.image_sk_legacy_reads:
+            item = self._store.get({"PK": f"USER#{user_id}", "SK": legacy_image_sk(dog_id, image_id)})
         if not item:
             raise ValueError(f"Image with id {image_id} for dog {dog_id} and user {user_id} not found.")
         
         normalized_item = self._normalize_item(item)
         return ImageDb.model_validate(normalized_item)
 
+    @trace_call("DynamoDB.update_image")
     def update_image(self, user_id: str, dog_id: int, image_id: int, 
                      item: UpdateImageRequestPayload) -> ImageDb:
-        pk = f"USER#{user_id}"
-        sk = f"IMAGE#{dog_id}#{image_id}"
         now_iso = DATETIME_NOW_UTC_FN().isoformat()
         
         if (item.s3_key is None or item.s3_key.strip() == "") and item.status == "uploaded":
@@ -158,71 +243,139 @@ class DynamoDBClient:
         current: ImageDb = self.get_image(user_id, dog_id, image_id)
         current_version: int = current.version
 
-        set_parts = [
-            "#s = :status",
-            "#sr = :status_reason",
-            "#obj = :s3_key",
-            "#u = :updated_at"
-        ]
-        expr_attr_names = {
-            "#s": "status",
-            "#sr": "status_reason",
-            "#obj": "s3_key",
-            "#u": "updated_at",
-            "#v": "version"
-        }
-        expr_attr_values = {
-            ":status": item.status,
-            ":status_reason": item.status_reason,
-            ":updated_at": now_iso,
-            ":inc": Decimal(1),
-            ":current_version": Decimal(current_version),
-            ":s3_key": item.s3_key
+        set_values = {
+            "status": item.status,
+            "status_reason": item.status_reason,
+            "s3_key": item.s3_key,
+            "updated_at": now_iso
         }
+        for attr_name in ("content_hash", "phash", "duplicate_of"):
+            if getattr(item, attr_name) is not None:
+                set_values[attr_name] = getattr(item, attr_name)
 
-        remove_clause = None
-        if getattr(item, "clear_ttl", False):
-            remove_clause = "REMOVE #expires_at"
-            expr_attr_names["#expires_at"] = "expires_at"
-
-        update_expr_parts = []
-        update_expr_parts.append("SET " + ", ".join(set_parts))
-        if remove_clause:
-            update_expr_parts.append(remove_clause)
-        update_expr_parts.append("ADD #v :inc")
-        update_expr = "\n".join(update_expr_parts)
-
-        resp = self._table.update_item(
-            Key={"PK": pk, "SK": sk},
-            UpdateExpression=update_expr,
-            ConditionExpression="attribute_not_exists(#v) OR #v = :current_version",
-            ExpressionAttributeNames=expr_attr_names,
-            ExpressionAttributeValues=expr_attr_values,
-            ReturnValues="ALL_NEW"
+        # The row read, a legacy row is updated in place until it is migrated
+        updated_item = self._store.update(
+            {"PK": f"USER#{user_id}", "SK": current.SK},
+            set_values=set_values,
+            remove=["expires_at"] if getattr(item, "clear_ttl", False) else [],
+            add={"version": 1},
+            expected_version=current_version
         )
-        
-        updated_item = resp.get("Attributes")
         if not updated_item:
             raise ValueError(f"Image with id {image_id} for dog {dog_id} and user {user_id} not found.")
         
         normalized_item = self._normalize_item(updated_item)
         return ImageDb.model_validate(normalized_item)
 
+    def get_image_hash(self, user_id: str, content_hash: str) -> Optional[ImageHashDb]:
+        item = self._store.get({"PK": f"USER#{user_id}", "SK": f"HASH#{content_hash}"})
+        if not item:
+            return None
+        return ImageHashDb.model_validate(self._normalize_item(item))
+
+    @trace_call("DynamoDB.batch_get_image_hashes")
+    def batch_get_image_hashes(self, user_id: str, content_hashes: List[str]) -> List[ImageHashDb]:
+        pk = f"USER#{user_id}"
+        items = self._store.batch_get([{"PK": pk, "SK": f"HASH#{content_hash}"} for content_hash in set(content_hashes)])
+        return [ImageHashDb.model_validate(self._normalize_item(item)) for item in items]
+
+    @trace_call("DynamoDB.query_similar_image_hashes")
+    def query_similar_image_hashes(self, user_id: str, phash: str, limit: int) -> Dict[str, str]:
+        # Perceptual hash by content hash of the hashes sharing a band with phash, at most limit per band
+        candidates = {}
+        for sk_prefix in phash_band_prefixes(phash):
+            items, _ = self._store.query(f"USER#{user_id}", sk_prefix, limit=limit)
+            candidates.update((item["content_hash"], item["phash"]) for item in items)
+        return candidates
+
+    def create_image_hash(self, user_id: str, content_hash: str, phash: Optional[str], s3_key: str, owner_sk: str) -> bool:
+        # Returns False when another upload of the same content registered the hash first
+        item = ImageHashDb(
+            PK=f"USER#{user_id}",
+            SK=f"HASH#{content_hash}",
+            content_hash=content_hash,
+            phash=phash,
+            s3_key=s3_key,
+            image_sk=owner_sk,
+            image_sks=[owner_sk]
+        )
+        db_item = item.model_dump(exclude_none=True)
+        db_item["image_sks"] = set(item.image_sks)
+        try:
+            self._store.put(db_item, if_not_exists=True)
+        except ConditionalCheckFailed:
+            return False
+        if phash:
+            # Band items go after the hash: one left by a failed write or a delete in progress points to
+            # a missing hash, and is skipped by the lookup
+            self._store.batch_put([{"PK": item.PK, "SK": sk, "content_hash": content_hash, "phash": phash}
+                                   for sk in phash_band_sks(phash, content_hash)])
+        return True
+
+    def add_image_hash_ref(self, user_id: str, content_hash: str, ref_sk: str) -> bool:
+        # Returns False when the hash was deleted meanwhile, together with its S3 object
+        try:
+            self._store.update({"PK": f"USER#{user_id}", "SK": f"HASH#{content_hash}"},
+                               add_to_set={"image_sks": [ref_sk]}, add={"version": 1}, if_exists=True)
+        except ConditionalCheckFailed:
+            return False
+        return True
+
+    def remove_image_hash_refs(self, image_hash: ImageHashDb, ref_sks: List[str]) -> bool:
+        # Returns False when the hash changed since image_hash was read, or was deleted
+        try:
+            self._store.update({"PK": image_hash.PK, "SK": image_hash.SK}, delete_from_set={"image_sks": ref_sks},
+                               add={"version": 1}, expected_version=image_hash.version, if_exists=True)
+        except ConditionalCheckFailed:
+            return False
+        return True
+
+    def delete_image_hash(self, image_hash: ImageHashDb) -> bool:
+        # Returns False when a reference was added or removed since image_hash was read
+        try:
+            self._store.delete({"PK": image_hash.PK, "SK": image_hash.SK}, expected_version=image_hash.version)
+        except ConditionalCheckFailed:
+            return False
+        if image_hash.phash:
+            # The same content registered again meanwhile loses its band items, it is still matched exactly
+            self._store.batch_delete([{"PK": image_hash.PK, "SK": sk}
+                                      for sk in phash_band_sks(image_hash.phash, image_hash.content_hash)])
+        return True
+
+    def get_rate_limit_bucket(self, user_id: str, bucket: str) -> Optional[RateLimitBucketDb]:
+        item = self._store.get({"PK": f"RATELIMIT#{user_id}", "SK": f"BUCKET#{bucket}"})
+        if not item:
+            return None
+        return RateLimitBucketDb.model_validate(self._normalize_item(item))
+
+    @trace_call("DynamoDB.update_rate_limit_bucket")
+    def update_rate_limit_bucket(self, user_id: str, bucket: str, tokens: float, refilled_at: float,
+                                 expires_at: int, current_version: int) -> RateLimitBucketDb:
+        # Raises ConditionalCheckFailed when another container updated the bucket since current_version
+        attributes = self._store.update(
+            {"PK": f"RATELIMIT#{user_id}", "SK": f"BUCKET#{bucket}"},
+            set_values={
+                "tokens": Decimal(f"{tokens:.3f}"),
+                "refilled_at": Decimal(f"{refilled_at:.3f}"),
+                "expires_at": expires_at
+            },
+            add={"version": 1},
+            expected_version=current_version
+        )
+        return RateLimitBucketDb.model_validate(self._normalize_item(attributes))
+
     def health_check(self):
-        self._table.meta.client.describe_table(TableName=self.table_name)
+        self._store.health_check()
     
+    def get_sequence_id(self, user_id: str, counter_name) -> int:
+        # Last id given out by the counter, 0 when none was
+        item = self._store.get({"PK": f"USER#{user_id}", "SK": "META#SEQUENCE"})
+        return int(item.get(counter_name, 0)) if item else 0
+
+    @trace_call("DynamoDB.next_sequence_id")
     def _next_sequence_id(self, user_id: str, counter_name) -> int:
-        pk = f"USER#{user_id}"
-        
-        resp = self._table.update_item(
-            Key={"PK": pk, "SK": "META#SEQUENCE"},
-            UpdateExpression="ADD #c :inc",
-            ExpressionAttributeNames={"#c": counter_name},
-            ExpressionAttributeValues={":inc": Decimal(1)},
-            ReturnValues="UPDATED_NEW")
-
-        new_val = resp.get("Attributes", {}).get(counter_name, 0)
-        return int(new_val)
+        attributes = self._store.update({"PK": f"USER#{user_id}", "SK": "META#SEQUENCE"}, add={counter_name: 1})
+        return int(attributes.get(counter_name, 0))
     
     def _normalize_item(self, item: dict) -> dict:
         return json.loads(json.dumps(item, default=self._decimal_default))
@@ -232,19 +385,20 @@ class DynamoDBClient:
             if obj == obj.to_integral_value():
                 return int(obj)
             return float(obj)
+        if isinstance(obj, set):
+            return sorted(obj)
         raise TypeError
     
     def _merge_dogs_with_images(self, dogs: List[DogDb], images: List[ImageDb]) -> List[DogDb]:
         dog_map = {dog.SK: dog for dog in dogs}
         for image in images:
-            parts = image.SK.split("#")
-            if len(parts) >= 3:
-                dog_id = parts[1]
-                dog_sk = f"DOG#{dog_id}"
+            ids = parse_image_sk(image.SK)
+            if ids:
+                dog_sk = f"DOG#{ids[0]}"
                 if dog_sk in dog_map:
                     dog_map[dog_sk].images.append(image)
         return list(dog_map.values())
 
 @lru_cache(maxsize=1)
-def get_dogs_db_client(app_config: AppConfig) -> DynamoDBClient:
-    return DynamoDBClient(app_config=app_config)
+def get_dogs_db_client(app_config: AppConfig) -> DogsDbClient:
+    return DogsDbClient(app_config=app_config)
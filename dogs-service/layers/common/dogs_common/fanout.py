@@ -0,0 +1,46 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, List, TypeVar, Union
+from .config import AppConfig
+from .db import DogsDbClient
+from .observability import propagate_trace
+
+K = TypeVar("K")
+R = TypeVar("R")
+
+
+class Fanout:
+    """Runs a table read per key on a bounded pool of threads, e.g. the lookups of many users in one
+    request. The pool is shared by every request of the container, so BATCH_MAX_CONCURRENCY is also the
+    most calls it makes to the table at once."""
+
+    def __init__(self, app_config: AppConfig):
+        self.app_config = app_config
+        self._executor = ThreadPoolExecutor(max_workers=app_config.batch_max_concurrency, thread_name_prefix="fanout")
+        self._local = threading.local()
+
+    def _db(self) -> DogsDbClient:
+        # Each thread keeps its own client and DynamoDB resource, resources aren't thread safe
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = DogsDbClient(self.app_config, dedicated_resource=True)
+        return db
+
+    def map(self, fn: Callable[[DogsDbClient, K], R], keys: List[K]) -> List[Union[R, Exception]]:
+        """Returns the result of fn for each key in order, or the exception it raised."""
+        call = propagate_trace(lambda key: fn(self._db(), key))
+        futures = [self._executor.submit(call, key) for key in keys]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+@lru_cache(maxsize=1)
+def get_fanout(app_config: AppConfig) -> Fanout:
+    return Fanout(app_config)
@@ -0,0 +1,52 @@
+from typing import List, Optional, Tuple
+
+# Ids in image sort keys are zero padded so DynamoDB orders them numerically,
+# e.g. IMAGE#0000000001#0000000010 sorts after IMAGE#0000000001#0000000002
+ID_WIDTH = 10
+
+def image_sk_prefix(dog_id: int) -> str:
+    return f"IMAGE#{dog_id:0{ID_WIDTH}d}#"
+
+def image_sk(dog_id: int, image_id: int) -> str:
+    return f"{image_sk_prefix(dog_id)}{image_id:0{ID_WIDTH}d}"
+
+# Rows written before the padding, IMAGE#<dog_id>#<image_id>, until they are migrated. Legacy keys
+# start with the first digit of the dog id, padded ones with 0, so they sort after all padded keys
+LEGACY_IMAGE_SK_PREFIXES = tuple(f"IMAGE#{digit}" for digit in range(1, 10))
+
+def legacy_image_sk_prefix(dog_id: int) -> str:
+    return f"IMAGE#{dog_id}#"
+
+def legacy_image_sk(dog_id: int, image_id: int) -> str:
+    return f"{legacy_image_sk_prefix(dog_id)}{image_id}"
+
+def normalize_image_sk(sk: str) -> str:
+    ids = parse_image_sk(sk)
+    return image_sk(*ids) if ids else sk
+
+def parse_image_sk(sk: str) -> Optional[Tuple[int, int]]:
+    # Accepts both the padded and the legacy IMAGE#<dog_id>#<image_id> format
+    parts = sk.split("#")
+    if len(parts) != 3 or parts[0] != "IMAGE":
+        return None
+    try:
+        return int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+
+def is_legacy_image_sk(sk: str) -> bool:
+    ids = parse_image_sk(sk)
+    return ids is not None and sk != image_sk(*ids)
+
+# Perceptual hashes (16 hex digits) are indexed by band, one PHASH#<band>#<digits>#<sha256> item per band
+# of PHASH_BAND_DIGITS digits. Hashes at most PHASH_BANDS - 1 bits apart have at least one equal band,
+# so near duplicates are found by querying the band prefixes of a hash instead of every hash of the user
+PHASH_BAND_DIGITS = 2
+PHASH_BANDS = 16 // PHASH_BAND_DIGITS
+
+def phash_band_prefixes(phash: str) -> List[str]:
+    return [f"PHASH#{band}#{phash[band * PHASH_BAND_DIGITS:(band + 1) * PHASH_BAND_DIGITS]}#"
+            for band in range(PHASH_BANDS)]
+
+def phash_band_sks(phash: str, content_hash: str) -> List[str]:
+    return [f"{prefix}{content_hash}" for prefix in phash_band_prefixes(phash)]
@@ -1,19 +1,25 @@
 from __future__ import annotations
 
 from pydantic import BaseModel, Field, ConfigDict, model_serializer
-from typing import List, Optional
+from typing import List, Literal, Optional
 from enum import Enum
+from .keys import parse_image_sk
 from .utils import DATETIME_NOW_UTC_FN
 
+class DeferredBuildModel(BaseModel):
+    # Validators and serializers are built on first use instead of at import time,
+    # so a cold start only pays for the models the invoked route actually touches
+    model_config = ConfigDict(defer_build=True)
+
 class ImageStatus(str, Enum):
     PENDING = "pending"
     UPLOADED = "uploaded" # Uploaded to S3 successfully, link is available
     DELETED = "deleted" # Explicit deletion, deleted from S3
 
 # Image DB Models
-class ImageDb(BaseModel):
+class ImageDb(DeferredBuildModel):
     PK: str = Field(..., description="Partition Key, format: USER#<user_id>")
-    SK: str = Field(..., description="Sort Key, format: IMAGE#<dog_id>#<image_id>")
+    SK: str = Field(..., description="Sort Key, format: IMAGE#<dog_id>#<image_id>, ids zero padded")
     s3_key: Optional[str] = None
     status: ImageStatus = ImageStatus.PENDING
     status_reason: Optional[str] = None
@@ -21,20 +27,51 @@ class ImageDb(BaseModel):
     created_at: str = Field(default_factory=lambda: DATETIME_NOW_UTC_FN().isoformat())
     updated_at: str = Field(default_factory=lambda: DATETIME_NOW_UTC_FN().isoformat())
     expires_at: Optional[int] = None
+    upload_id: Optional[str] = Field(default=None, description="S3 multipart upload id, set for multipart uploads")
+    upload_key: Optional[str] = Field(default=None, description="S3 key the multipart upload is written to")
+    part_count: Optional[int] = Field(default=None, description="Number of parts the multipart upload must have")
+    content_hash: Optional[str] = Field(default=None, description="sha256 of the image content, key of the HASH# item it is registered under")
+    phash: Optional[str] = Field(default=None, description="Perceptual (difference) hash of the image as 16 hex digits")
+    duplicate_of: Optional[str] = Field(default=None, description="SK of the image whose S3 object this image shares")
+
+class ImageHashDb(DeferredBuildModel):
+    PK: str = Field(..., description="Partition Key, format: USER#<user_id>")
+    SK: str = Field(..., description="Sort Key, format: HASH#<content_hash>")
+    content_hash: str
+    phash: Optional[str] = None
+    s3_key: str
+    image_sk: str = Field(..., description="SK of the image that owns the S3 object")
+    image_sks: List[str] = Field(default_factory=list, description="SKs of all images sharing the S3 object")
+    version: int = Field(default=0, description="Incremented on every change of image_sks")
+
+class RateLimitBucketDb(DeferredBuildModel):
+    # Own partition, so limiting a hot user doesn't add writes to its USER# partition
+    PK: str = Field(..., description="Partition Key, format: RATELIMIT#<user_id>")
+    SK: str = Field(..., description="Sort Key, format: BUCKET#<route>")
+    tokens: float
+    refilled_at: float = Field(..., description="Epoch seconds of the last refill")
+    version: int = Field(default=0)
+    expires_at: Optional[int] = None
 
 # Image API Models
-class CreateImageRequestPayload(BaseModel):
+class CreateImageRequestPayload(DeferredBuildModel):
     model_config = ConfigDict(frozen=True)
     image_extension: str = Field(..., description="File extension of the image, e.g., jpg, png")
 
-class UpdateImageRequestPayload(BaseModel):
+class CreateMultipartImageRequestPayload(CreateImageRequestPayload):
+    size: int = Field(..., gt=0, description="Total size of the image in bytes")
+
+class UpdateImageRequestPayload(DeferredBuildModel):
     model_config = ConfigDict(frozen=True)
     s3_key: str
     status: ImageStatus
     status_reason: Optional[str] = None
     clear_ttl: Optional[bool] = Field(default=False, description="If true, clears the expires_at field")
+    content_hash: Optional[str] = None
+    phash: Optional[str] = None
+    duplicate_of: Optional[str] = None
 
-class ImageUploadInstructions(BaseModel):
+class ImageUploadInstructions(DeferredBuildModel):
     model_config = ConfigDict(frozen=True)
     method: str
     presigned_url: str
@@ -65,7 +102,37 @@ class ImageUploadInstructions(BaseModel):
             max_size=max_size
         )
 
-class ImageInfo(BaseModel):    
+class MultipartUploadPart(DeferredBuildModel):
+    model_config = ConfigDict(frozen=True)
+    part_number: int
+    presigned_url: str
+
+class MultipartUploadInstructions(DeferredBuildModel):
+    model_config = ConfigDict(frozen=True)
+    method: str
+    upload_id: str
+    part_size: int
+    parts: tuple[MultipartUploadPart, ...]
+    expires_in: int
+    headers: Optional[dict[str, str]] = None
+    max_size: Optional[int] = None
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        data = {
+            "method": self.method,
+            "upload_id": self.upload_id,
+            "part_size": self.part_size,
+            "parts": [{"part_number": part.part_number, "presigned_url": part.presigned_url} for part in self.parts],
+            "expires_in": self.expires_in,
+        }
+        if self.headers is not None:
+            data["headers"] = self.headers
+        if self.max_size is not None:
+            data["max_size"] = self.max_size
+        return data
+
+class ImageInfo(DeferredBuildModel):    
     image_id: str
     image_url: Optional[str] = None
     status: ImageStatus
@@ -92,8 +159,8 @@ class ImageInfo(BaseModel):
 
     @classmethod
     def create(cls, image_db: ImageDb) -> "ImageInfo":
-        parts = image_db.SK.split("#")
-        image_id = parts[2] if len(parts) > 2 else "0"
+        ids = parse_image_sk(image_db.SK)
+        image_id = str(ids[1]) if ids else "0"
         return cls(
             image_id=image_id,
             image_url=f"s3://{image_db.s3_key}" if image_db.s3_key else None,
@@ -104,7 +171,7 @@ class ImageInfo(BaseModel):
             updated_at=image_db.updated_at,
         )
 
-class CreateImageResponsePayload(BaseModel):
+class CreateImageResponsePayload(DeferredBuildModel):
     image: ImageInfo
     upload_instructions: ImageUploadInstructions
     
@@ -122,8 +189,37 @@ class CreateImageResponsePayload(BaseModel):
             upload_instructions=upload_instructions
         )
 
+class GetImagesResponsePayload(DeferredBuildModel):
+    images: tuple[ImageInfo, ...] = Field(default_factory=tuple)
+    next_token: Optional[str] = None
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        data = {"images": [image.serialize_model() for image in self.images]}
+        if self.next_token is not None:
+            data["next_token"] = self.next_token
+        return data
+
+    @classmethod
+    def create(cls, images_db: List[ImageDb], next_token: Optional[str] = None) -> "GetImagesResponsePayload":
+        return cls(
+            images=tuple(ImageInfo.create(image_db) for image_db in images_db),
+            next_token=next_token
+        )
+
+class CreateMultipartImageResponsePayload(DeferredBuildModel):
+    image: ImageInfo
+    upload_instructions: MultipartUploadInstructions
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        return {
+            "image": self.image.serialize_model(),
+            "upload_instructions": self.upload_instructions.serialize_model()
+        }
+
 # Dogs DB Models
-class DogDb(BaseModel):
+class DogDb(DeferredBuildModel):
     PK: str = Field(..., description="Partition Key, format: USER#<user_id>")
     SK: str = Field(..., description="Sort Key, format: DOG#<dog_id>")
     name: str
@@ -134,7 +230,7 @@ class DogDb(BaseModel):
     updated_at: str = Field(default_factory=lambda: DATETIME_NOW_UTC_FN().isoformat())
 
 # Dogs API Models
-class BaseDogFields(BaseModel):
+class BaseDogFields(DeferredBuildModel):
     model_config = ConfigDict(frozen=True)
     name: str
     age: int
@@ -189,3 +285,60 @@ class UpdateDogResponsePayload(BaseDogResponsePayload):
 
 class GetDogResponsePayload(BaseDogResponsePayload):
     pass
+
+class DogDeletionStatus(str, Enum):
+    DELETED = "deleted" # Dog and all its images removed
+    DELETING = "deleting" # Dog removed, images are being removed in background
+
+class DeleteDogResponsePayload(DeferredBuildModel):
+    model_config = ConfigDict(frozen=True)
+    dog_id: int
+    status: DogDeletionStatus
+    images_count: int
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        return {
+            "dog_id": self.dog_id,
+            "status": self.status.value,
+            "images_count": self.images_count,
+        }
+
+class UserDogsError(DeferredBuildModel):
+    model_config = ConfigDict(frozen=True)
+    status: int = Field(..., description="HTTP status the single user route would have returned")
+    message: str
+    retry_after: Optional[int] = Field(default=None, description="Seconds to wait before retrying this user")
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        data = {"status": self.status, "message": self.message}
+        if self.retry_after is not None:
+            data["retry_after"] = self.retry_after
+        return data
+
+class UserDogsResult(DeferredBuildModel):
+    model_config = ConfigDict(frozen=True)
+    user_id: str
+    dogs: Optional[tuple[GetDogResponsePayload, ...]] = None
+    error: Optional[UserDogsError] = None
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        if self.error is not None:
+            return {"user_id": self.user_id, "error": self.error.serialize_model()}
+        return {"user_id": self.user_id, "dogs": [dog.serialize_model() for dog in self.dogs or ()]}
+
+class BatchGetUserDogsResponsePayload(DeferredBuildModel):
+    users: tuple[UserDogsResult, ...] = Field(default_factory=tuple)
+
+    @model_serializer
+    def serialize_model(self) -> dict:
+        return {"users": [user.serialize_model() for user in self.users]}
+
+# Background task Models
+class DeleteDogTask(DeferredBuildModel):
+    model_config = ConfigDict(frozen=True)
+    task: Literal["delete_dog"] = "delete_dog"
+    user_id: str
+    dog_id: int
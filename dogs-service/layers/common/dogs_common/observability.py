@@ -1,19 +1,165 @@
-from aws_lambda_powertools import Logger, Tracer
-from aws_xray_sdk.core import patch_all
-from .config import get_config
+import functools
+import os
+import random
 
-# Apply X-Ray patching early at module import time
-patch_all()
+from aws_lambda_powertools import Logger, Metrics, Tracer
+from aws_lambda_powertools.logging.buffer import LoggerBufferConfig
+from aws_lambda_powertools.logging.formatter import LambdaPowertoolsFormatter
+from .config import get_config
 
 # Get config once at module import time
 _config = get_config()
 
-# Create shared logger and tracer instances with consistent configuration
+# Values of these keys never reach the logs
+REDACTED_LOG_KEYS = {"presigned_url", "presigned_urls", "authorization", "password", "token", "next_token"}
+# Error details are kept whole
+UNTRIMMED_LOG_KEYS = {"message", "exception", "exception_name", "stack_trace"}
+
+
+class CompactFormatter(LambdaPowertoolsFormatter):
+    # Redacts secrets and trims large values before a record is serialized: long strings are
+    # truncated, large lists and dicts are replaced by their size
+    def __init__(self, max_field_length: int, **kwargs):
+        self.max_field_length = max_field_length
+        super().__init__(**kwargs)
+
+    def serialize(self, log: dict) -> str:
+        return super().serialize({key: self._compact(key, value) for key, value in log.items()})
+
+    def _compact(self, key: str, value):
+        if key in UNTRIMMED_LOG_KEYS:
+            return value
+        if key.lower() in REDACTED_LOG_KEYS:
+            return "[REDACTED]"
+        if isinstance(value, str) and len(value) > self.max_field_length:
+            return f"{value[:self.max_field_length]}...[{len(value)} chars]"
+        if isinstance(value, (list, tuple, set, dict)) and len(value) > _config.log_max_collection_items:
+            return f"[{type(value).__name__} of {len(value)} items dropped]"
+        return value
+
+
+# Create shared logger, tracer and metrics instances with consistent configuration.
+# With buffering, records at or below LOG_BUFFER_LEVEL are kept in memory per invocation and only
+# written when an error is logged or the invocation is sampled (see buffered_logs)
 logger = Logger(
     service=_config.powertools_service_name,
-    level=_config.log_level
+    level=_config.log_level,
+    logger_formatter=CompactFormatter(max_field_length=_config.log_max_field_length),
+    buffer_config=LoggerBufferConfig(
+        max_bytes=_config.log_buffer_max_bytes,
+        buffer_at_verbosity=_config.log_buffer_level,
+        flush_on_error_log=True
+    ) if _config.log_buffer_enabled else None
 )
 
-tracer = Tracer(
+
+class NoopTracer:
+    # Stands in for Tracer when tracing is off: Tracer imports and configures the X-Ray SDK
+    # (and its botocore clients) even when disabled, which costs hundreds of ms on a cold start
+    disabled = True
+
+    def capture_lambda_handler(self, lambda_handler=None, **kwargs):
+        return lambda_handler if lambda_handler is not None else (lambda fn: fn)
+
+    def capture_method(self, method=None, **kwargs):
+        return method if method is not None else (lambda fn: fn)
+
+    def put_annotation(self, key, value):
+        pass
+
+    def put_metadata(self, key, value, namespace=None):
+        pass
+
+
+def _tracing_mode() -> str:
+    if os.getenv("POWERTOOLS_TRACE_DISABLED", "false").lower() == "true":
+        return "off"
+    return _config.tracing_mode
+
+def _sampling_rules() -> dict:
+    # Local rules only apply outside Lambda (server mode): in Lambda the sampling decision comes
+    # with the trace header, from the X-Ray sampling rules of the account (see template.yaml)
+    return {
+        "version": 2,
+        "default": {"fixed_target": _config.tracing_sampling_reservoir, "rate": _config.tracing_sampling_rate},
+        "rules": [],
+    }
+
+tracing_mode = _tracing_mode()
+
+if tracing_mode == "off":
+    tracer = NoopTracer()
+else:
+    # full patches botocore, so every AWS call gets a subsegment; minimal only records the
+    # explicit subsegments of the hot calls (see trace_call)
+    tracer = Tracer(
+        service=_config.powertools_service_name,
+        auto_patch=tracing_mode == "full",
+        patch_modules=("botocore",)
+    )
+    if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ:
+        tracer.provider.configure(sampling_rules=_sampling_rules())
+
+metrics = Metrics(
+    namespace=_config.metrics_namespace,
     service=_config.powertools_service_name
-)
\ No newline at end of file
+)
+
+def trace_route(route=None, *, capture_response: bool = True):
+    # Route handler subsegments are only recorded in full mode. List routes pass
+    # capture_response=False so their (large) responses are never added to the trace
+    def decorator(fn):
+        if tracing_mode != "full":
+            return fn
+        return tracer.capture_method(fn, capture_response=capture_response)
+    return decorator(route) if route is not None else decorator
+
+def trace_call(name: str):
+    # Explicit subsegment around a hot DynamoDB/S3 call, the decorator is a no-op when tracing is off.
+    # Unsampled requests get a dummy subsegment from the X-Ray SDK, which records nothing
+    def decorator(fn):
+        if tracing_mode == "off":
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.provider.in_subsegment(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def propagate_trace(fn):
+    # Wraps fn to run in another thread under the caller's segment, so subsegments of the calls it
+    # makes are part of the request's trace. Must be called in the request's thread
+    if tracing_mode == "off":
+        return fn
+    entity = tracer.provider.get_trace_entity()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if entity is not None:
+            tracer.provider.set_trace_entity(entity)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            tracer.provider.clear_trace_entities()
+    return wrapper
+
+def buffered_logs(handler):
+    # Writes the buffered records of sampled or failed invocations, drops them otherwise
+    if not _config.log_buffer_enabled:
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            result = handler(event, context)
+        except Exception:
+            logger.flush_buffer()
+            raise
+        if random.random() < _config.log_buffer_sample_rate:
+            logger.flush_buffer()
+        else:
+            logger.clear_buffer()
+        return result
+    return wrapper
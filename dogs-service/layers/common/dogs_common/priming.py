@@ -0,0 +1,67 @@
+import functools
+import time
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools.metrics import MetricUnit, single_metric
+from botocore.exceptions import ClientError
+from typing import Callable
+from .config import AppConfig
+from .db import DogsDbClient
+from .models import DeferredBuildModel
+from .s3 import S3Client
+
+logger = Logger(service="dogs-service", child=True)
+
+def prime_clients(db: DogsDbClient, s3: S3Client):
+    # A cheap call per service builds the client (service model, endpoint resolution) and leaves
+    # a TLS connection in the pool for the first request. An error response still warms the
+    # connection, so ClientErrors (e.g. a missing s3:ListBucket permission) are fine here.
+    for service, call in (("dynamodb", db.health_check), ("s3", s3.health_check)):
+        try:
+            call()
+        except ClientError as e:
+            logger.debug(f"Priming {service} returned an error response", error=str(e))
+        except Exception as e:
+            logger.warning(f"Priming {service} failed", error=str(e))
+
+def prime_models():
+    pending = list(DeferredBuildModel.__subclasses__())
+    seen = set()
+    while pending:
+        model = pending.pop()
+        if model in seen:
+            continue
+        seen.add(model)
+        model.model_rebuild(force=True)
+        pending.extend(model.__subclasses__())
+
+def emit_latency_metric(app_config: AppConfig, name: str, latency_ms: float, primed: bool):
+    with single_metric(name=name, unit=MetricUnit.Milliseconds, value=latency_ms,
+                       namespace=app_config.metrics_namespace) as metric:
+        metric.add_dimension(name="service", value=app_config.powertools_service_name)
+        metric.add_dimension(name="primed", value=str(primed).lower())
+
+def prime(app_config: AppConfig, *steps: Callable[[], None]):
+    start = time.perf_counter()
+    for step in steps:
+        step()
+    emit_latency_metric(app_config, "InitPrimingDuration", (time.perf_counter() - start) * 1000, primed=True)
+
+def record_first_request(app_config: AppConfig, primed: bool):
+    """Decorates a Lambda handler to emit the latency of the first invocation in the container."""
+    def decorator(handler):
+        is_first = True
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            nonlocal is_first
+            if not is_first:
+                return handler(event, context)
+            is_first = False
+            start = time.perf_counter()
+            try:
+                return handler(event, context)
+            finally:
+                emit_latency_metric(app_config, "FirstRequestLatency", (time.perf_counter() - start) * 1000, primed)
+        return wrapper
+    return decorator
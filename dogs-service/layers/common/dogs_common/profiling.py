@@ -0,0 +1,150 @@
+import functools
+import json
+import os
+import random
+import re
+import resource
+import sysconfig
+import time
+
+from aws_lambda_powertools import Logger
+from typing import Callable, List
+from .config import AppConfig
+
+# Frames recorded by tracemalloc are skipped when they belong to these files
+_IGNORED_ALLOCATION_FILES = ("tracemalloc.py", "cProfile.py", "<frozen importlib._bootstrap>")
+
+
+class PathShortener:
+    # Paths relative to the service code or site-packages/stdlib, so reports read the same locally and in Lambda
+    def __init__(self, handler: Callable):
+        self.handler_dir = os.path.dirname(handler.__code__.co_filename)
+        self.common_dir = os.path.dirname(os.path.abspath(__file__))
+        paths = sysconfig.get_paths()
+        roots = {os.path.dirname(self.common_dir), self.handler_dir, paths["purelib"], paths["platlib"], paths["stdlib"]}
+        self.roots = sorted(roots, key=len, reverse=True)
+
+    def is_service_code(self, filename: str) -> bool:
+        # Function code sits at the top of its directory, its dependencies in subdirectories
+        return os.path.dirname(filename) == self.handler_dir or filename.startswith(self.common_dir + os.sep)
+
+    def __call__(self, filename: str) -> str:
+        for root in self.roots:
+            if filename.startswith(root + os.sep):
+                return filename[len(root) + 1:]
+        return filename
+
+
+def top_allocations(snapshot, shorten: PathShortener, limit: int) -> List[dict]:
+    import tracemalloc
+
+    filters = [tracemalloc.Filter(False, f"*{name}") for name in _IGNORED_ALLOCATION_FILES]
+    snapshot = snapshot.filter_traces(filters + [tracemalloc.Filter(False, __file__)])
+    allocations = []
+    for stat in snapshot.statistics("traceback")[:limit]:
+        site = stat.traceback[-1]
+        # The innermost frame is often in a library (json, pydantic), the origin is the service code that called it
+        origin = next((frame for frame in reversed(stat.traceback) if shorten.is_service_code(frame.filename)), None)
+        allocations.append({
+            "site": f"{shorten(site.filename)}:{site.lineno}",
+            "origin": f"{shorten(origin.filename)}:{origin.lineno}" if origin else None,
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count
+        })
+    return allocations
+
+
+def top_functions(profiler, shorten: PathShortener, limit: int) -> List[dict]:
+    import pstats
+
+    stats = pstats.Stats(profiler).stats
+    # Own time first: cumulative time ranks the handler and the framework above the code doing the work
+    ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [{
+        "function": f"{shorten(filename)}:{lineno}({name})",
+        "calls": calls,
+        "own_ms": round(own_time * 1000, 3),
+        "cumulative_ms": round(cumulative_time * 1000, 3)
+    } for (filename, lineno, name), (_, calls, own_time, cumulative_time, _) in ranked]
+
+
+def profile_handler(app_config: AppConfig, route_fn: Callable[[dict], str]):
+    """Decorates a handler to profile a sample of its invocations with tracemalloc and cProfile."""
+    def decorator(handler):
+        if not app_config.profiling_enabled:
+            return handler
+
+        # Only imported when profiling, they are not needed otherwise
+        import cProfile
+        import tracemalloc
+
+        shorten = PathShortener(handler)
+        # Not the shared logger: its buffer would drop the reports of unsampled invocations
+        profile_logger = Logger(service=f"{app_config.powertools_service_name}-profiler")
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            # One profiled invocation at a time, e.g. when a server worker runs a fan out in threads
+            if random.random() >= app_config.profiling_sample_rate or tracemalloc.is_tracing():
+                return handler(event, context)
+
+            profiler = cProfile.Profile()
+            result = None
+            error = None
+            # Started per invocation: only allocations of this request are traced and there's no
+            # overhead in between. The snapshot is taken before the response is released
+            tracemalloc.start(app_config.profiling_traceback_frames)
+            start = time.perf_counter()
+            try:
+                profiler.enable()
+                try:
+                    result = handler(event, context)
+                except Exception as e:
+                    error = e
+                finally:
+                    profiler.disable()
+                duration_ms = (time.perf_counter() - start) * 1000
+                retained, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+
+            route = route_fn(event)
+            report = {
+                "route": route,
+                "error": type(error).__name__ if error else None,
+                # Includes the profilers' overhead, compare durations between profiled invocations only
+                "duration_ms": round(duration_ms, 2),
+                "peak_memory_kb": round(peak / 1024, 1),
+                "retained_memory_kb": round(retained / 1024, 1),
+                # ru_maxrss is in KB on Linux
+                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "top_allocations": top_allocations(snapshot, shorten, app_config.profiling_top_n),
+                "top_functions": top_functions(profiler, shorten, app_config.profiling_top_n)
+            }
+            try:
+                if app_config.profiling_output == "file":
+                    path = write_profile(app_config.profiling_dump_dir, route, profiler, report)
+                    profile_logger.info("Invocation profile written", route=route, path=path,
+                                        peak_memory_kb=report["peak_memory_kb"])
+                else:
+                    profile_logger.info("Invocation profile", **report)
+            except Exception as e:
+                profile_logger.warning("Failed to write the invocation profile", route=route, error=str(e))
+
+            if error is not None:
+                raise error
+            return result
+        return wrapper
+    return decorator
+
+
+def write_profile(dump_dir: str, route: str, profiler, report: dict) -> str:
+    # <dir>/<time>-<route>.prof for pstats/snakeviz and the same report as JSON next to it
+    os.makedirs(dump_dir, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{time.time_ns() % 1_000_000_000:09d}-{re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_')}"
+    path = os.path.join(dump_dir, name)
+    profiler.dump_stats(f"{path}.prof")
+    with open(f"{path}.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return f"{path}.prof"
@@ -0,0 +1,169 @@
+import functools
+import json
+import math
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from aws_lambda_powertools.event_handler import CORSConfig
+from .config import AppConfig
+from .db import get_dogs_db_client
+from .models import RateLimitBucketDb
+from .observability import logger
+from .resilience import CircuitOpenError
+from .storage import ConditionalCheckFailed, StorageError
+from .utils import cors_headers
+
+# Limit applied to the routes that have none of their own
+DEFAULT_ROUTE = "*"
+# Attempts to take tokens from the shared bucket when other containers update it at the same time
+_SHARED_BUCKET_ATTEMPTS = 3
+
+
+class Limit(NamedTuple):
+    rate: float
+    burst: int
+
+
+class TokenBucket:
+    def __init__(self, limit: Limit, now: float):
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self.refilled_at = now
+
+    def take(self, now: float) -> float:
+        # Returns 0 when a token was taken, otherwise the seconds until one is available
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.refilled_at) * self.limit.rate)
+        self.refilled_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.limit.rate
+
+
+class _UserBucket:
+    # What a container knows about one user and route: its own bucket, the tokens it leased from
+    # the shared bucket and the last state of the shared bucket it saw
+    def __init__(self, limit: Limit, now: float):
+        self.lock = threading.Lock()
+        self.local = TokenBucket(limit, now)
+        self.leased = 0
+        self.lease_expires_at = 0.0
+        self.shared: Optional[RateLimitBucketDb] = None
+
+
+class RateLimiter:
+    """Token buckets per user and route. The container's own bucket rejects a runaway client without
+    any DynamoDB call; allowed requests spend tokens leased in batches from a bucket shared by all the
+    containers, stored in the table and refilled with version checked updates."""
+
+    def __init__(self, app_config: AppConfig):
+        self.app_config = app_config
+        self.limits = {route: Limit(**limit) for route, limit in json.loads(app_config.rate_limits).items()}
+        self.shared = app_config.rate_limit_shared
+        self.lease_size = app_config.rate_limit_lease_size
+        self.lease_secs = app_config.rate_limit_lease_secs
+        self.max_users = app_config.rate_limit_max_users
+        self._buckets: "OrderedDict[Tuple[str, str], _UserBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, user_id: str, route: str, limit: Limit, now: float) -> _UserBucket:
+        with self._lock:
+            bucket = self._buckets.get((user_id, route))
+            if bucket is None:
+                bucket = self._buckets[(user_id, route)] = _UserBucket(limit, now)
+                # Least recently used users are forgotten first, their next request starts with a full bucket
+                if len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end((user_id, route))
+            return bucket
+
+    def acquire(self, user_id: str, route: str) -> float:
+        """Returns 0 when the request is allowed, otherwise the seconds to wait before retrying."""
+        route = route if route in self.limits else DEFAULT_ROUTE
+        limit = self.limits.get(route)
+        if limit is None:
+            return 0
+        now = time.time()
+        bucket = self._bucket(user_id, route, limit, now)
+        with bucket.lock:
+            wait = bucket.local.take(now)
+            if wait or not self.shared:
+                return wait
+            if bucket.leased and now < bucket.lease_expires_at:
+                bucket.leased -= 1
+                return 0
+            try:
+                taken, wait = self._take_shared(user_id, route, limit, bucket, now)
+            except (ClientError, BotoCoreError, StorageError, CircuitOpenError) as e:
+                # Limiting must not fail requests the table could still serve: the container's bucket decides alone
+                logger.warning("Shared rate limit bucket unavailable", route=route, error=str(e))
+                return 0
+            if not taken:
+                return wait
+            bucket.leased = taken - 1
+            bucket.lease_expires_at = now + self.lease_secs
+            return 0
+
+    def _take_shared(self, user_id: str, route: str, limit: Limit, bucket: _UserBucket, now: float) -> Tuple[int, float]:
+        # Takes up to lease_size tokens. The last state seen is tried first: only other containers take
+        # tokens, so if it has none the bucket has none either, and if it is stale the update fails
+        db = get_dogs_db_client(self.app_config)
+        for _ in range(_SHARED_BUCKET_ATTEMPTS):
+            shared = bucket.shared or db.get_rate_limit_bucket(user_id, route)
+            if shared is None:
+                tokens, version = float(limit.burst), 0
+            else:
+                tokens = min(limit.burst, shared.tokens + max(0.0, now - shared.refilled_at) * limit.rate)
+                version = shared.version
+            taken = min(self.lease_size, int(tokens))
+            if taken < 1:
+                return 0, (1 - tokens) / limit.rate
+            try:
+                # Expires once it would be full again anyway
+                expires_at = int(now + limit.burst / limit.rate) + 60
+                bucket.shared = db.update_rate_limit_bucket(user_id, route, tokens - taken, now, expires_at, version)
+                return taken, 0
+            except ConditionalCheckFailed:
+                bucket.shared = None
+        return 0, 1 / limit.rate
+
+
+@lru_cache(maxsize=1)
+def get_rate_limiter(app_config: AppConfig) -> RateLimiter:
+    return RateLimiter(app_config)
+
+
+def too_many_requests_response(retry_after: float, headers: Optional[dict] = None) -> dict:
+    return {
+        "statusCode": 429,
+        "headers": {"Content-Type": "application/json", "Retry-After": str(max(1, math.ceil(retry_after))), **(headers or {})},
+        "body": json.dumps({"message": "Too many requests, retry later"}),
+        "isBase64Encoded": False,
+    }
+
+
+def rate_limit(app_config: AppConfig, route_fn: Callable[[dict], str], user_fn: Callable[[dict], Optional[str]],
+               cors: Optional[CORSConfig] = None):
+    """Decorates an API handler to answer 429 with a Retry-After header to users over the RATE_LIMITS of the route.
+    The 429 is returned before the resolver runs, cors is the resolver's config so browsers can read it."""
+    def decorator(handler):
+        if not json.loads(app_config.rate_limits):
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            user_id = user_fn(event)
+            if user_id:
+                wait = get_rate_limiter(app_config).acquire(user_id, route_fn(event))
+                if wait:
+                    logger.info("Rate limited", user_id=user_id, retry_after=round(wait, 2))
+                    return too_many_requests_response(wait, cors_headers(event, cors))
+            return handler(event, context)
+        return wrapper
+    return decorator
@@ -0,0 +1,188 @@
+import functools
+import threading
+import time
+
+from aws_lambda_powertools.metrics import MetricUnit
+from collections import defaultdict
+from typing import Callable, Dict, Optional
+from .config import AppConfig
+from .observability import logger, metrics
+
+# Operations whose consumed capacity is reported as reads, everything else consumes write units
+DYNAMODB_READ_OPERATIONS = {"GetItem", "BatchGetItem", "Query", "Scan", "TransactGetItems", "ExecuteStatement"}
+DYNAMODB_SINGLE_WRITE_OPERATIONS = {"PutItem", "UpdateItem", "DeleteItem"}
+
+
+class ServiceStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        # Totals rather than one value per call: a request fanning out to many calls keeps a fixed size
+        self.latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.rcu = 0.0
+        self.wcu = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.operations = defaultdict(int)
+
+
+class RequestMetrics:
+    # Collects the AWS calls of the current request. A Lambda container (or a server worker process)
+    # handles one request at a time, calls fanned out to threads are added under the lock
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.services: Dict[str, ServiceStats] = {}
+
+    def reset(self):
+        with self._lock:
+            self.services = {}
+
+    def record(self, service: str, operation: str, latency_ms: float, error: bool = False,
+               rcu: float = 0.0, wcu: float = 0.0, items: int = 0, payload_bytes: int = 0):
+        with self._lock:
+            stats = self.services.setdefault(service, ServiceStats())
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.latency_ms += latency_ms
+            stats.max_latency_ms = max(stats.max_latency_ms, latency_ms)
+            stats.rcu += rcu
+            stats.wcu += wcu
+            stats.items += items
+            stats.bytes += payload_bytes
+            stats.operations[operation] += 1
+
+    def server_timing(self) -> str:
+        # Server-Timing header value, e.g. DynamoDB;dur=12.5;desc="calls=2 rcu=1.5 wcu=0 items=10 bytes=2048"
+        entries = []
+        for service, stats in self.services.items():
+            desc = f"calls={stats.calls} rcu={stats.rcu:g} wcu={stats.wcu:g} items={stats.items} bytes={stats.bytes}"
+            entries.append(f'{service};dur={stats.latency_ms:.1f};desc="{desc}"')
+        return ", ".join(entries)
+
+
+request_metrics = RequestMetrics()
+
+
+def _operation_stats(operation: str, parsed: dict, context: dict):
+    consumed = parsed.get("ConsumedCapacity") or []
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    rcu = sum(c.get("ReadCapacityUnits", 0) for c in consumed)
+    wcu = sum(c.get("WriteCapacityUnits", 0) for c in consumed)
+    if not rcu and not wcu:
+        total = sum(c.get("CapacityUnits", 0) for c in consumed)
+        rcu, wcu = (total, 0) if operation in DYNAMODB_READ_OPERATIONS else (0, total)
+
+    if "Count" in parsed:
+        items = parsed["Count"]
+    elif "Item" in parsed:
+        items = 1
+    elif "Responses" in parsed:
+        responses = parsed["Responses"]
+        items = sum(len(v) for v in responses.values()) if isinstance(responses, dict) else len(responses)
+    else:
+        items = context.get("request_metrics_write_items", 0)
+    return float(rcu), float(wcu), items
+
+
+def _on_before_parameter_build(params: dict, model, context: dict, **kwargs):
+    if model.input_shape is not None and "ReturnConsumedCapacity" in model.input_shape.members:
+        params.setdefault("ReturnConsumedCapacity", "TOTAL")
+    if model.name == "BatchWriteItem":
+        context["request_metrics_write_items"] = sum(len(requests) for requests in params.get("RequestItems", {}).values())
+    elif model.name == "TransactWriteItems":
+        context["request_metrics_write_items"] = len(params.get("TransactItems", []))
+    elif model.name in DYNAMODB_SINGLE_WRITE_OPERATIONS:
+        context["request_metrics_write_items"] = 1
+
+
+def _on_before_call(params: dict, model, context: dict, **kwargs):
+    body = params.get("body")
+    context["request_metrics_bytes"] = len(body) if isinstance(body, (bytes, str)) else 0
+    # after-call-error doesn't get the operation model
+    context["request_metrics_operation"] = (model.service_model.service_id.replace(" ", ""), model.name)
+    context["request_metrics_start"] = time.perf_counter()
+
+
+def _on_after_call(http_response, parsed: dict, model, context: dict, **kwargs):
+    start = context.get("request_metrics_start")
+    if start is None:
+        return
+    latency_ms = (time.perf_counter() - start) * 1000
+    response_bytes = int(http_response.headers.get("content-length") or 0)
+    rcu, wcu, items = _operation_stats(model.name, parsed, context)
+    service = model.service_model.service_id.replace(" ", "")
+    request_metrics.record(service, model.name, latency_ms, error=http_response.status_code >= 400, rcu=rcu, wcu=wcu,
+                           items=items, payload_bytes=context.get("request_metrics_bytes", 0) + response_bytes)
+
+
+def _on_after_call_error(context: dict, **kwargs):
+    # Connection errors and timeouts that exhausted the retries never reach after-call
+    start = context.get("request_metrics_start")
+    if start is not None:
+        service, operation = context["request_metrics_operation"]
+        request_metrics.record(service, operation, (time.perf_counter() - start) * 1000, error=True)
+
+
+def instrument_client(client):
+    events = client.meta.events
+    # Not provide-client-params: the DynamoDB resource replaces the params with a copy in that event
+    events.register("before-parameter-build", _on_before_parameter_build)
+    events.register("before-call", _on_before_call)
+    events.register("after-call", _on_after_call)
+    events.register("after-call-error", _on_after_call_error)
+    return client
+
+
+def flush_request_metrics(route: str, metadata: Optional[dict] = None):
+    if not request_metrics.services:
+        return
+    metrics.add_dimension(name="route", value=route)
+    for service, stats in request_metrics.services.items():
+        metrics.add_metric(name=f"{service}Calls", unit=MetricUnit.Count, value=stats.calls)
+        if stats.errors:
+            metrics.add_metric(name=f"{service}Errors", unit=MetricUnit.Count, value=stats.errors)
+        # Per request: time spent in the service and its slowest call. An EMF metric holds at most 100
+        # values, one value per call would break the line of a request that makes more calls
+        metrics.add_metric(name=f"{service}Latency", unit=MetricUnit.Milliseconds, value=round(stats.latency_ms, 3))
+        metrics.add_metric(name=f"{service}MaxLatency", unit=MetricUnit.Milliseconds, value=round(stats.max_latency_ms, 3))
+        metrics.add_metric(name=f"{service}PayloadBytes", unit=MetricUnit.Bytes, value=stats.bytes)
+        if service == "DynamoDB":
+            metrics.add_metric(name="ConsumedRCU", unit=MetricUnit.Count, value=stats.rcu)
+            metrics.add_metric(name="ConsumedWCU", unit=MetricUnit.Count, value=stats.wcu)
+            metrics.add_metric(name="DynamoDBItems", unit=MetricUnit.Count, value=stats.items)
+        metrics.add_metadata(key=f"{service}Operations", value=dict(stats.operations))
+    # High cardinality values (user ids) are metadata: searchable in Logs Insights, not dimensions
+    for key, value in (metadata or {}).items():
+        if value is not None:
+            metrics.add_metadata(key=key, value=value)
+    try:
+        metrics.flush_metrics()
+    except Exception as e:
+        logger.warning("Failed to flush request metrics", error=str(e))
+    finally:
+        # flush_metrics doesn't clear anything when POWERTOOLS_METRICS_DISABLED is set
+        metrics.clear_metrics()
+
+
+def log_request_metrics(app_config: AppConfig, route_fn: Callable[[dict], str],
+                        metadata_fn: Optional[Callable[[dict], dict]] = None):
+    """Decorates a Lambda handler to emit the AWS calls made by each invocation as EMF metrics."""
+    def decorator(handler):
+        if not app_config.request_metrics_enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            request_metrics.reset()
+            result = None
+            try:
+                result = handler(event, context)
+                return result
+            finally:
+                if app_config.request_metrics_debug_header and isinstance(result, dict) and request_metrics.services:
+                    result.setdefault("multiValueHeaders", {})["Server-Timing"] = [request_metrics.server_timing()]
+                flush_request_metrics(route_fn(event), metadata_fn(event) if metadata_fn else None)
+        return wrapper
+    return decorator
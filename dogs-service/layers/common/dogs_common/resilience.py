@@ -0,0 +1,259 @@
+import functools
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+from aws_lambda_powertools.event_handler import CORSConfig
+from .config import AppConfig
+from .observability import logger
+from .utils import cors_headers
+
+# Error codes returned when a service throttles, retrying them right away makes the incident worse
+THROTTLING_ERROR_CODES = {
+    "ProvisionedThroughputExceededException", "ThrottlingException", "Throttling", "RequestLimitExceeded",
+    "TooManyRequestsException", "RequestThrottled", "RequestThrottledException", "SlowDown",
+}
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class CircuitOpenError(Exception):
+    # Raised instead of calling a service whose circuit is open, or when a request is shed
+    def __init__(self, service: str, retry_after: float, reason: str = "unavailable"):
+        self.service = service
+        self.retry_after = retry_after
+        super().__init__(f"{service} is {reason}, retry after {math.ceil(retry_after)}s")
+
+
+class CircuitBreaker:
+    # Opens when the failure ratio of the last calls (throttling, 5xx, connection errors and timeouts,
+    # counted once per API call after botocore's retries) reaches failure_ratio. While open, calls
+    # fail right away; afterwards a single probe call is let through (half open) and closes the
+    # circuit when it succeeds. Every consecutive trip doubles the open time, up to max_open_secs.
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, service: str, app_config: AppConfig):
+        self.service = service
+        self.window_size = app_config.circuit_window_size
+        self.min_calls = app_config.circuit_min_calls
+        self.failure_ratio = app_config.circuit_failure_ratio
+        self.degraded_ratio = app_config.shed_writes_failure_ratio
+        self.open_secs = app_config.circuit_open_secs
+        self.max_open_secs = app_config.circuit_max_open_secs
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=self.window_size)
+        self.state = self.CLOSED
+        self._trips = 0
+        self._open_until = 0.0
+        self._probe_started_at: Optional[float] = None
+
+    def _ratio(self) -> float:
+        if len(self._outcomes) < self.min_calls:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def before_call(self) -> bool:
+        # Returns True when the call is the half open probe, raises CircuitOpenError when it must not be made
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and now < self._open_until:
+                raise CircuitOpenError(self.service, self._open_until - now)
+            # A probe that never reported back (e.g. the process was busy elsewhere) doesn't block forever
+            if self._probe_started_at is not None and now - self._probe_started_at < self.max_open_secs:
+                raise CircuitOpenError(self.service, self.open_secs)
+            self.state = self.HALF_OPEN
+            self._probe_started_at = now
+            return True
+
+    def record(self, success: bool, probe: bool = False):
+        with self._lock:
+            if probe:
+                self._probe_started_at = None
+                if success:
+                    logger.info("Circuit closed", service=self.service)
+                    self.state = self.CLOSED
+                    self._trips = 0
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(success)
+            if self.state == self.CLOSED and self._ratio() >= self.failure_ratio:
+                self._open()
+
+    def _open(self):
+        self._trips += 1
+        # Jitter spreads the probes of all the containers that saw the same incident
+        open_for = min(self.max_open_secs, self.open_secs * 2 ** (self._trips - 1)) * random.uniform(0.8, 1.2)
+        self.state = self.OPEN
+        self._open_until = time.monotonic() + open_for
+        self._outcomes.clear()
+        logger.warning("Circuit opened", service=self.service, open_secs=round(open_for, 2), trips=self._trips)
+
+    @property
+    def degraded(self) -> bool:
+        # Early sign of an incident: writes are shed from here on, reads still go through
+        with self._lock:
+            return self.state != self.CLOSED or (self.degraded_ratio > 0 and self._ratio() >= self.degraded_ratio)
+
+    @property
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(self.open_secs, self._open_until - time.monotonic())
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(service: str, app_config: AppConfig) -> CircuitBreaker:
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(service, app_config)
+        return _breakers[service]
+
+
+def degraded_breakers(services: Optional[Iterable[str]] = None) -> List[CircuitBreaker]:
+    # Degraded breakers of the given services, of all of them by default
+    return [breaker for breaker in list(_breakers.values())
+            if (services is None or breaker.service in services) and breaker.degraded]
+
+
+def instrument_breaker(client, app_config: AppConfig):
+    # botocore events, as for the request metrics: before-call happens once per API call, before
+    # the first attempt, after-call/after-call-error once botocore is done retrying
+    breaker = get_breaker(client.meta.service_model.service_id.replace(" ", ""), app_config)
+
+    def on_before_call(context: dict, **kwargs):
+        context["circuit_probe"] = breaker.before_call()
+
+    def on_after_call(http_response, parsed: dict, context: dict, **kwargs):
+        error_code = (parsed.get("Error") or {}).get("Code")
+        failed = http_response.status_code >= 500 or error_code in THROTTLING_ERROR_CODES
+        breaker.record(not failed, probe=context.get("circuit_probe", False))
+
+    def on_after_call_error(context: dict, **kwargs):
+        breaker.record(False, probe=context.get("circuit_probe", False))
+
+    events = client.meta.events
+    events.register("before-call", on_before_call)
+    events.register("after-call", on_after_call)
+    events.register("after-call-error", on_after_call_error)
+    return client
+
+
+class ConcurrencyLimiter:
+    # In-flight requests per limit: "read", "write" and route templates. A Lambda container handles one
+    # request at a time, the limits matter in server mode where share() is called before the workers
+    # are forked so they all count in the same shared memory. Each worker counts in its own row, so the
+    # slots of a worker that dies mid-request are given back by resetting its row
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self._index = {name: i for i, name in enumerate(limits)}
+        self._counts = [0] * len(limits)
+        self._rows = 1
+        self._row = 0
+        self._lock = threading.Lock()
+
+    def share(self, workers: int):
+        if self.limits:
+            self._counts = multiprocessing.Array("i", workers * len(self.limits), lock=False)
+            self._rows = workers
+            self._lock = multiprocessing.Lock()
+
+    def bind(self, row: int):
+        # Called in a forked worker, before it handles requests
+        self._row = row * len(self.limits)
+
+    def reset(self, row: int):
+        # Called by the server once the worker counting in row is gone, it is the only one writing there
+        for i in range(row * len(self.limits), (row + 1) * len(self.limits)):
+            self._counts[i] = 0
+
+    def _in_flight(self, i: int) -> int:
+        return sum(self._counts[row * len(self.limits) + i] for row in range(self._rows))
+
+    def try_acquire(self, names: List[str]) -> Optional[str]:
+        # Takes a slot of every limit or none, returns the name of the full limit
+        limited = [(name, self._index[name]) for name in names if name in self._index]
+        with self._lock:
+            for name, i in limited:
+                if self._in_flight(i) >= self.limits[name]:
+                    return name
+            for _, i in limited:
+                self._counts[self._row + i] += 1
+        return None
+
+    def release(self, names: List[str]):
+        with self._lock:
+            for name in names:
+                if name in self._index:
+                    self._counts[self._row + self._index[name]] -= 1
+
+
+@lru_cache(maxsize=1)
+def get_concurrency_limiter(app_config: AppConfig) -> ConcurrencyLimiter:
+    limits = dict(json.loads(app_config.route_concurrency_limits))
+    if app_config.max_concurrent_reads is not None:
+        limits["read"] = app_config.max_concurrent_reads
+    if app_config.max_concurrent_writes is not None:
+        limits["write"] = app_config.max_concurrent_writes
+    return ConcurrencyLimiter(limits)
+
+
+def shed_response(error: CircuitOpenError, headers: Optional[dict] = None) -> dict:
+    return {
+        "statusCode": 503,
+        "headers": {"Content-Type": "application/json", "Retry-After": str(max(1, math.ceil(error.retry_after))), **(headers or {})},
+        "body": json.dumps({"message": str(error)}),
+        "isBase64Encoded": False,
+    }
+
+
+def shed_load(app_config: AppConfig, dependencies: Optional[Dict[str, List[str]]] = None,
+              cors: Optional[CORSConfig] = None):
+    """Decorates an API handler to reject requests with a 503 and Retry-After before they reach a dependency:
+    writes while a service they call is degraded, any request over its route or read/write concurrency limit.
+    dependencies maps routes ("POST /users/{user_id}/dogs") to the services they call, named as their
+    circuit breakers ("DynamoDB", "S3"). The writes of a route not listed depend on every service. cors is
+    the resolver's config, the 503 is returned before it runs."""
+    dependencies = dependencies or {}
+
+    def decorator(handler):
+        limiter = get_concurrency_limiter(app_config)
+        if not app_config.circuit_breaker_enabled and not limiter.limits:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            method = event.get("httpMethod", "GET")
+            route = f"{method} {event.get('resource')}"
+            is_write = method not in READ_METHODS
+            if is_write and app_config.circuit_breaker_enabled:
+                degraded = degraded_breakers(dependencies.get(route))
+                if degraded:
+                    # Reads still go through: a failing write costs more (retries, partial updates) and
+                    # clients can usually retry it later
+                    return shed_response(CircuitOpenError(degraded[0].service, degraded[0].retry_after, reason="degraded"),
+                                         cors_headers(event, cors))
+
+            names = ["write" if is_write else "read", route]
+            full = limiter.try_acquire(names)
+            if full is not None:
+                return shed_response(CircuitOpenError(full, app_config.shed_retry_after_secs, reason="at its concurrency limit"),
+                                     cors_headers(event, cors))
+            try:
+                return handler(event, context)
+            finally:
+                limiter.release(names)
+        return wrapper
+    return decorator
@@ -1,26 +1,36 @@
-from functools import lru_cache
-import boto3
+from functools import cached_property, lru_cache
 
 from aws_lambda_powertools import Logger
-from typing import Optional
+from typing import List, Optional
+from .aws import get_client
 from .config import AppConfig
+from .observability import trace_call
 from .utils import is_running_local
 
+# S3 DeleteObjects accepts at most 1000 keys per request
+DELETE_OBJECTS_MAX_KEYS = 1000
+
 class S3Client:
     def __init__(self, app_config: AppConfig):
+        self.app_config = app_config
         self.bucket_name = app_config.dogs_images_bucket
         self.endpoint_url = app_config.s3_endpoint
         self.presign_url = app_config.s3_presign_endpoint
-        self.client = boto3.client("s3", endpoint_url=self.endpoint_url)
         self.logger = Logger(service="dogs-service", child=True)
+
+    @cached_property
+    def client(self):
+        # Created on first use, see DynamoDBStore._ddb
+        return get_client(self.app_config, "s3", self.endpoint_url, read_timeout=self.app_config.s3_read_timeout)
     
+    @trace_call("S3.generate_presigned_put_url")
     def generate_presigned_put_url(
         self, 
         s3_key: str, 
         expires_in: int = 3600, 
         content_type: Optional[str] = None
     ) -> str:
-        self.logger.info(f"Generating presigned PUT URL for key: {s3_key}")
+        self.logger.debug(f"Generating presigned PUT URL for key: {s3_key}")
         
         params = {
             "Bucket": self.bucket_name,
@@ -34,14 +44,86 @@ class S3Client:
         
         if is_running_local():
             presigned_url = presigned_url.replace(self.endpoint_url, self.presign_url)
-        
-        self.logger.info(f"Generated presigned PUT URL: {presigned_url}")
+
         return presigned_url
+
+    @trace_call("S3.create_multipart_upload")
+    def create_multipart_upload(self, s3_key: str, content_type: Optional[str] = None) -> str:
+        self.logger.debug(f"Creating multipart upload for key: {s3_key}")
+        params = {
+            "Bucket": self.bucket_name,
+            "Key": s3_key,
+        }
+        if content_type:
+            params["ContentType"] = content_type
+        resp = self.client.create_multipart_upload(**params)
+        return resp["UploadId"]
+
+    def generate_presigned_upload_part_urls(self, s3_key: str, upload_id: str, part_count: int, expires_in: int = 3600) -> List[str]:
+        self.logger.debug(f"Generating {part_count} presigned part URLs for key: {s3_key}")
+        urls = []
+        for part_number in range(1, part_count + 1):
+            params = {
+                "Bucket": self.bucket_name,
+                "Key": s3_key,
+                "UploadId": upload_id,
+                "PartNumber": part_number,
+            }
+            presigned_url = self.client.generate_presigned_url("upload_part", Params=params, ExpiresIn=expires_in)
+            if is_running_local():
+                presigned_url = presigned_url.replace(self.endpoint_url, self.presign_url)
+            urls.append(presigned_url)
+        return urls
+
+    @trace_call("S3.list_parts")
+    def list_parts(self, s3_key: str, upload_id: str) -> List[dict]:
+        # Parts uploaded successfully so far, as {"PartNumber", "ETag"} in part number order
+        parts = []
+        paginator = self.client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id):
+            parts.extend({"PartNumber": part["PartNumber"], "ETag": part["ETag"]} for part in page.get("Parts", []))
+        return parts
+
+    @trace_call("S3.complete_multipart_upload")
+    def complete_multipart_upload(self, s3_key: str, upload_id: str, parts: List[dict]):
+        # Part ETags are collected server side (list_parts), so clients don't need the ETag header exposed through CORS
+        self.logger.debug(f"Completing multipart upload for key: {s3_key}")
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+
+    @trace_call("S3.abort_multipart_upload")
+    def abort_multipart_upload(self, s3_key: str, upload_id: str):
+        self.logger.debug(f"Aborting multipart upload for key: {s3_key}")
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id)
     
+    @trace_call("S3.get_object_body")
+    def get_object_body(self, s3_key: str):
+        resp = self.client.get_object(Bucket=self.bucket_name, Key=s3_key)
+        return resp["Body"]
+
     def delete_object(self, s3_key: str):
-        self.logger.info(f"Deleting S3 object: {s3_key}")
+        self.logger.debug(f"Deleting S3 object: {s3_key}")
         self.client.delete_object(Bucket=self.bucket_name, Key=s3_key)
 
+    @trace_call("S3.delete_objects")
+    def delete_objects(self, s3_keys: List[str]) -> List[dict]:
+        self.logger.debug(f"Deleting {len(s3_keys)} S3 objects")
+        errors = []
+        for i in range(0, len(s3_keys), DELETE_OBJECTS_MAX_KEYS):
+            chunk = s3_keys[i:i + DELETE_OBJECTS_MAX_KEYS]
+            resp = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True}
+            )
+            errors.extend(resp.get("Errors", []))
+        if errors:
+            self.logger.warning(f"Failed to delete {len(errors)} S3 objects", errors=errors)
+        return errors
+
     def health_check(self):
         self.client.list_objects_v2(Bucket=self.bucket_name, MaxKeys=1)
 
@@ -0,0 +1,530 @@
+import copy
+import functools
+import json
+import sqlite3
+import threading
+
+from bisect import bisect_left, bisect_right, insort
+from boto3.dynamodb.conditions import Key
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import cached_property
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .aws import create_resource, get_resource
+from .config import AppConfig
+from .utils import DATETIME_NOW_UTC_FN
+
+# Items are addressed by PK (partition) and SK (sort key) as in the DynamoDB table. Every backend keeps
+# the semantics the service relies on: SK ordered begins_with queries with an exclusive start key,
+# conditional puts/deletes, version checked updates, atomic counters, string sets and the
+# expires_at TTL attribute.
+#
+# One known divergence: the local stores treat an expired item as absent everywhere, for reads and
+# for the if_not_exists/if_exists/expected_version conditions alike, while DynamoDB keeps returning
+# it and checking conditions against it until its TTL deletion runs (up to a few days later). Callers
+# must not rely on either: the service only writes TTL items it reads first (rate limit buckets) or
+# never conditions on them (upload expiry).
+
+# DynamoDB BatchGetItem accepts at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+TTL_ATTRIBUTE = "expires_at"
+VERSION_ATTRIBUTE = "version"
+
+
+class ConditionalCheckFailed(Exception):
+    # The item didn't match the condition of a put, delete or update (missing, present or another version)
+    pass
+
+
+class StorageError(Exception):
+    # A local store failed (SQLite database locked, unwritable...), as ClientError/BotoCoreError for DynamoDB
+    pass
+
+
+class ItemStore:
+
+    def get(self, key: dict) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put(self, item: dict, if_not_exists: bool = False):
+        raise NotImplementedError
+
+    def delete(self, key: dict, if_exists: bool = False, expected_version: Optional[int] = None):
+        # With expected_version the item, when present, must have no version yet or that version
+        raise NotImplementedError
+
+    def update(self, key: dict, set_values: Optional[dict] = None, remove: Iterable[str] = (),
+               add: Optional[Dict[str, int]] = None, add_to_set: Optional[Dict[str, Iterable[str]]] = None,
+               delete_from_set: Optional[Dict[str, Iterable[str]]] = None,
+               expected_version: Optional[int] = None, if_exists: bool = False) -> dict:
+        # Creates the item when missing, like UpdateItem, unless if_exists. With expected_version the item
+        # must have no version yet or that version. Returns the whole updated item
+        raise NotImplementedError
+
+    def query(self, pk: str, sk_prefix: str, descending: bool = False, limit: Optional[int] = None,
+              start_key: Optional[dict] = None) -> Tuple[List[dict], Optional[dict]]:
+        # One page of items, and the key to start the next page from (None on the last page)
+        raise NotImplementedError
+
+    def batch_get(self, keys: List[dict]) -> List[dict]:
+        raise NotImplementedError
+
+    def batch_put(self, items: List[dict]):
+        # Unconditional puts, not atomic as a whole
+        raise NotImplementedError
+
+    def batch_delete(self, keys: List[dict]):
+        raise NotImplementedError
+
+    def health_check(self):
+        raise NotImplementedError
+
+
+class DynamoDBStore(ItemStore):
+
+    def __init__(self, app_config: AppConfig, dedicated_resource: bool = False):
+        self.app_config = app_config
+        self.table_name = app_config.dogs_table_name
+        self.endpoint_url = app_config.dynamodb_endpoint
+        self.dedicated_resource = dedicated_resource
+
+    # The resource is created on first use: loading the botocore service model is a large part
+    # of a cold start and isn't needed by requests that never reach the table
+    @cached_property
+    def _ddb(self):
+        if self.dedicated_resource:
+            return create_resource(self.app_config, "dynamodb", self.endpoint_url)
+        return get_resource(self.app_config, "dynamodb", self.endpoint_url)
+
+    @cached_property
+    def _table(self):
+        return self._ddb.Table(self.table_name)
+
+    @property
+    def _conditional_check_failed(self):
+        return self._table.meta.client.exceptions.ConditionalCheckFailedException
+
+    def get(self, key: dict) -> Optional[dict]:
+        return self._table.get_item(Key=key).get("Item")
+
+    def put(self, item: dict, if_not_exists: bool = False):
+        params = {"ConditionExpression": "attribute_not_exists(PK)"} if if_not_exists else {}
+        try:
+            self._table.put_item(Item=item, **params)
+        except self._conditional_check_failed as e:
+            raise ConditionalCheckFailed(str(e)) from e
+
+    def delete(self, key: dict, if_exists: bool = False, expected_version: Optional[int] = None):
+        conditions, params = [], {}
+        if if_exists:
+            conditions.append("attribute_exists(PK)")
+        if expected_version is not None:
+            conditions.append("(attribute_not_exists(#version) OR #version = :current_version)")
+            params["ExpressionAttributeNames"] = {"#version": VERSION_ATTRIBUTE}
+            params["ExpressionAttributeValues"] = {":current_version": Decimal(expected_version)}
+        if conditions:
+            params["ConditionExpression"] = " AND ".join(conditions)
+        try:
+            self._table.delete_item(Key=key, **params)
+        except self._conditional_check_failed as e:
+            raise ConditionalCheckFailed(str(e)) from e
+
+    def update(self, key: dict, set_values: Optional[dict] = None, remove: Iterable[str] = (),
+               add: Optional[Dict[str, int]] = None, add_to_set: Optional[Dict[str, Iterable[str]]] = None,
+               delete_from_set: Optional[Dict[str, Iterable[str]]] = None,
+               expected_version: Optional[int] = None, if_exists: bool = False) -> dict:
+        names, values = {}, {}
+
+        def name(attribute: str) -> str:
+            names[f"#a{len(names)}"] = attribute
+            return f"#a{len(names) - 1}"
+
+        def value(v) -> str:
+            values[f":v{len(values)}"] = v
+            return f":v{len(values) - 1}"
+
+        sets = [f"{name(attribute)} = {value(v)}" for attribute, v in (set_values or {}).items()]
+        removes = [name(attribute) for attribute in remove]
+        adds = [f"{name(attribute)} {value(Decimal(v))}" for attribute, v in (add or {}).items()]
+        adds += [f"{name(attribute)} {value(set(refs))}" for attribute, refs in (add_to_set or {}).items()]
+        deletes = [f"{name(attribute)} {value(set(refs))}" for attribute, refs in (delete_from_set or {}).items()]
+
+        clauses = [(keyword, parts) for keyword, parts in
+                   (("SET", sets), ("REMOVE", removes), ("ADD", adds), ("DELETE", deletes)) if parts]
+        params = {
+            "Key": key,
+            "UpdateExpression": "\n".join(f"{keyword} {', '.join(parts)}" for keyword, parts in clauses),
+            "ExpressionAttributeNames": names,
+            "ReturnValues": "ALL_NEW"
+        }
+        conditions = ["attribute_exists(PK)"] if if_exists else []
+        if expected_version is not None:
+            conditions.append("(attribute_not_exists(#version) OR #version = :current_version)")
+            names["#version"] = VERSION_ATTRIBUTE
+            values[":current_version"] = Decimal(expected_version)
+        if conditions:
+            params["ConditionExpression"] = " AND ".join(conditions)
+        if values:
+            params["ExpressionAttributeValues"] = values
+        try:
+            return self._table.update_item(**params).get("Attributes", {})
+        except self._conditional_check_failed as e:
+            raise ConditionalCheckFailed(str(e)) from e
+
+    def query(self, pk: str, sk_prefix: str, descending: bool = False, limit: Optional[int] = None,
+              start_key: Optional[dict] = None) -> Tuple[List[dict], Optional[dict]]:
+        params = {"KeyConditionExpression": Key("PK").eq(pk) & Key("SK").begins_with(sk_prefix)}
+        if descending:
+            params["ScanIndexForward"] = False
+        if limit is not None:
+            params["Limit"] = limit
+        if start_key is not None:
+            params["ExclusiveStartKey"] = start_key
+        resp = self._table.query(**params)
+        return resp.get("Items", []), resp.get("LastEvaluatedKey")
+
+    def batch_get(self, keys: List[dict]) -> List[dict]:
+        items = []
+        for i in range(0, len(keys), BATCH_GET_MAX_KEYS):
+            request = {self.table_name: {"Keys": keys[i:i + BATCH_GET_MAX_KEYS]}}
+            while request:
+                resp = self._ddb.batch_get_item(RequestItems=request)
+                items.extend(resp.get("Responses", {}).get(self.table_name, []))
+                request = resp.get("UnprocessedKeys")
+        return items
+
+    def batch_put(self, items: List[dict]):
+        with self._table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    def batch_delete(self, keys: List[dict]):
+        # batch_writer chunks deletes into 25-item BatchWriteItem calls and resends UnprocessedItems
+        with self._table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as batch:
+            for key in keys:
+                batch.delete_item(Key=key)
+
+    def health_check(self):
+        self._table.meta.client.describe_table(TableName=self.table_name)
+
+
+def _plain(value):
+    # Stored copy of a value: numbers as int/float and string sets as sorted lists, as the
+    # DynamoDB items look once normalized
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _now() -> int:
+    return int(DATETIME_NOW_UTC_FN().timestamp())
+
+
+def _is_expired(item: dict, now: int) -> bool:
+    # DynamoDB deletes expired items in the background, here they are gone as soon as they expire
+    expires_at = item.get(TTL_ATTRIBUTE)
+    return isinstance(expires_at, (int, float)) and expires_at <= now
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    # Smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else "\U0010ffff"
+
+
+def _check_version(item: Optional[dict], key: dict, expected_version: Optional[int]):
+    if expected_version is not None and item is not None and item.get(VERSION_ATTRIBUTE, expected_version) != expected_version:
+        raise ConditionalCheckFailed(f"Item {key} is not at version {expected_version}")
+
+
+def _apply_update(item: Optional[dict], key: dict, set_values: Optional[dict], remove: Iterable[str],
+                  add: Optional[Dict[str, int]], add_to_set: Optional[Dict[str, Iterable[str]]],
+                  delete_from_set: Optional[Dict[str, Iterable[str]]], expected_version: Optional[int],
+                  if_exists: bool = False) -> dict:
+    if if_exists and item is None:
+        raise ConditionalCheckFailed(f"Item {key['PK']}/{key['SK']} doesn't exist")
+    _check_version(item, key, expected_version)
+    updated = dict(item) if item is not None else dict(key)
+    updated.update(_plain(set_values or {}))
+    for name in remove:
+        updated.pop(name, None)
+    for name, value in (add or {}).items():
+        updated[name] = updated.get(name, 0) + _plain(value)
+    for name, refs in (add_to_set or {}).items():
+        updated[name] = sorted(set(updated.get(name, [])) | set(refs))
+    for name, refs in (delete_from_set or {}).items():
+        remaining = sorted(set(updated.get(name, [])) - set(refs))
+        # Like DynamoDB, an empty set removes the attribute
+        if remaining:
+            updated[name] = remaining
+        else:
+            updated.pop(name, None)
+    return updated
+
+
+class _Partition:
+    # Items of one PK, with their SKs kept sorted for range queries
+    def __init__(self):
+        self.sks: List[str] = []
+        self.items: Dict[str, dict] = {}
+
+
+# Shared by every InMemoryStore of the process, so the API and the processor (or a client created
+# again after a reset) see the same data
+_memory_tables: Dict[str, Dict[str, _Partition]] = {}
+_memory_lock = threading.RLock()
+
+
+class InMemoryStore(ItemStore):
+    # Process local store for tests, benchmarks and running the service without AWS.
+    # Forked server workers each get their own copy of the data
+
+    def __init__(self, app_config: AppConfig):
+        self.table_name = app_config.dogs_table_name
+        with _memory_lock:
+            self._partitions = _memory_tables.setdefault(self.table_name, {})
+
+    def _get(self, key: dict, now: int) -> Optional[dict]:
+        partition = self._partitions.get(key["PK"])
+        item = partition.items.get(key["SK"]) if partition else None
+        if item is not None and _is_expired(item, now):
+            self._remove(key)
+            return None
+        return item
+
+    def _store(self, item: dict):
+        partition = self._partitions.setdefault(item["PK"], _Partition())
+        if item["SK"] not in partition.items:
+            insort(partition.sks, item["SK"])
+        partition.items[item["SK"]] = item
+
+    def _remove(self, key: dict):
+        partition = self._partitions.get(key["PK"])
+        if partition and partition.items.pop(key["SK"], None) is not None:
+            del partition.sks[bisect_left(partition.sks, key["SK"])]
+            if not partition.items:
+                del self._partitions[key["PK"]]
+
+    def get(self, key: dict) -> Optional[dict]:
+        with _memory_lock:
+            item = self._get(key, _now())
+            return copy.deepcopy(item) if item is not None else None
+
+    def put(self, item: dict, if_not_exists: bool = False):
+        with _memory_lock:
+            if if_not_exists and self._get(item, _now()) is not None:
+                raise ConditionalCheckFailed(f"Item {item['PK']}/{item['SK']} already exists")
+            self._store(_plain(item))
+
+    def delete(self, key: dict, if_exists: bool = False, expected_version: Optional[int] = None):
+        with _memory_lock:
+            item = self._get(key, _now())
+            if if_exists and item is None:
+                raise ConditionalCheckFailed(f"Item {key['PK']}/{key['SK']} doesn't exist")
+            _check_version(item, key, expected_version)
+            self._remove(key)
+
+    def update(self, key: dict, set_values: Optional[dict] = None, remove: Iterable[str] = (),
+               add: Optional[Dict[str, int]] = None, add_to_set: Optional[Dict[str, Iterable[str]]] = None,
+               delete_from_set: Optional[Dict[str, Iterable[str]]] = None,
+               expected_version: Optional[int] = None, if_exists: bool = False) -> dict:
+        with _memory_lock:
+            updated = _apply_update(self._get(key, _now()), key, set_values, remove, add, add_to_set,
+                                    delete_from_set, expected_version, if_exists)
+            self._store(updated)
+            return copy.deepcopy(updated)
+
+    def query(self, pk: str, sk_prefix: str, descending: bool = False, limit: Optional[int] = None,
+              start_key: Optional[dict] = None) -> Tuple[List[dict], Optional[dict]]:
+        with _memory_lock:
+            partition = self._partitions.get(pk)
+            if partition is None:
+                return [], None
+            lower = bisect_left(partition.sks, sk_prefix)
+            upper = bisect_left(partition.sks, _prefix_upper_bound(sk_prefix))
+            if start_key is not None:
+                if descending:
+                    upper = min(upper, bisect_left(partition.sks, start_key["SK"]))
+                else:
+                    lower = max(lower, bisect_right(partition.sks, start_key["SK"]))
+            sks = partition.sks[lower:upper]
+            if descending:
+                sks.reverse()
+
+            now = _now()
+            items = []
+            for sk in sks:
+                item = partition.items[sk]
+                if _is_expired(item, now):
+                    continue
+                if limit is not None and len(items) == limit:
+                    last = items[-1]
+                    return items, {"PK": last["PK"], "SK": last["SK"]}
+                items.append(copy.deepcopy(item))
+            return items, None
+
+    def batch_get(self, keys: List[dict]) -> List[dict]:
+        return [item for item in (self.get(key) for key in keys) if item is not None]
+
+    def batch_put(self, items: List[dict]):
+        with _memory_lock:
+            for item in items:
+                self._store(_plain(item))
+
+    def batch_delete(self, keys: List[dict]):
+        with _memory_lock:
+            for key in keys:
+                self._remove(key)
+
+    def health_check(self):
+        pass
+
+
+def _sqlite_errors(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except sqlite3.Error as e:
+            raise StorageError(f"SQLite store {self.path} failed: {e}") from e
+    return wrapper
+
+
+class SqliteStore(ItemStore):
+    # Single file store for running the service (or server mode) without AWS. Items are JSON in one
+    # table keyed by (PK, SK); writes that read the item first run in an IMMEDIATE transaction, so
+    # counters and version checks stay atomic across threads and processes sharing the file
+
+    def __init__(self, app_config: AppConfig):
+        self.path = app_config.sqlite_path
+        self._lock = threading.RLock()
+
+    # Opened on first use: a connection must not be inherited by forked server workers
+    @cached_property
+    def _conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "PK TEXT NOT NULL, SK TEXT NOT NULL, expires_at INTEGER, data TEXT NOT NULL, "
+            "PRIMARY KEY (PK, SK)) WITHOUT ROWID"
+        )
+        conn.execute("DELETE FROM items WHERE expires_at <= ?", (_now(),))
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _select(self, conn: sqlite3.Connection, key: dict) -> Optional[dict]:
+        row = conn.execute("SELECT data FROM items WHERE PK = ? AND SK = ? AND (expires_at IS NULL OR expires_at > ?)",
+                           (key["PK"], key["SK"], _now())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, conn: sqlite3.Connection, item: dict):
+        expires_at = item.get(TTL_ATTRIBUTE)
+        conn.execute("INSERT OR REPLACE INTO items (PK, SK, expires_at, data) VALUES (?, ?, ?, ?)",
+                     (item["PK"], item["SK"], expires_at if isinstance(expires_at, (int, float)) else None,
+                      json.dumps(item)))
+
+    @_sqlite_errors
+    def get(self, key: dict) -> Optional[dict]:
+        with self._lock:
+            return self._select(self._conn, key)
+
+    @_sqlite_errors
+    def put(self, item: dict, if_not_exists: bool = False):
+        with self._transaction() as conn:
+            if if_not_exists and self._select(conn, item) is not None:
+                raise ConditionalCheckFailed(f"Item {item['PK']}/{item['SK']} already exists")
+            self._write(conn, _plain(item))
+
+    @_sqlite_errors
+    def delete(self, key: dict, if_exists: bool = False, expected_version: Optional[int] = None):
+        with self._transaction() as conn:
+            item = self._select(conn, key)
+            if if_exists and item is None:
+                raise ConditionalCheckFailed(f"Item {key['PK']}/{key['SK']} doesn't exist")
+            _check_version(item, key, expected_version)
+            conn.execute("DELETE FROM items WHERE PK = ? AND SK = ?", (key["PK"], key["SK"]))
+
+    @_sqlite_errors
+    def update(self, key: dict, set_values: Optional[dict] = None, remove: Iterable[str] = (),
+               add: Optional[Dict[str, int]] = None, add_to_set: Optional[Dict[str, Iterable[str]]] = None,
+               delete_from_set: Optional[Dict[str, Iterable[str]]] = None,
+               expected_version: Optional[int] = None, if_exists: bool = False) -> dict:
+        with self._transaction() as conn:
+            updated = _apply_update(self._select(conn, key), key, set_values, remove, add, add_to_set,
+                                    delete_from_set, expected_version, if_exists)
+            self._write(conn, updated)
+            return updated
+
+    @_sqlite_errors
+    def query(self, pk: str, sk_prefix: str, descending: bool = False, limit: Optional[int] = None,
+              start_key: Optional[dict] = None) -> Tuple[List[dict], Optional[dict]]:
+        # The start key replaces the bound it narrows: with both, SQLite may seek to the prefix and
+        # scan every earlier page again
+        lower, upper = (">=", sk_prefix), ("<", _prefix_upper_bound(sk_prefix))
+        if start_key is not None:
+            if descending:
+                upper = ("<", min(upper[1], start_key["SK"]))
+            else:
+                lower = (">", max(lower[1], start_key["SK"]))
+        sql = (f"SELECT data FROM items WHERE PK = ? AND SK {lower[0]} ? AND SK {upper[0]} ? "
+               "AND (expires_at IS NULL OR expires_at > ?)")
+        params = [pk, lower[1], upper[1], _now()]
+        sql += " ORDER BY SK DESC" if descending else " ORDER BY SK"
+        if limit is not None:
+            # One more row tells whether there is a next page
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        with self._lock:
+            items = [json.loads(row[0]) for row in self._conn.execute(sql, params)]
+        if limit is not None and len(items) > limit:
+            items = items[:limit]
+            return items, {"PK": items[-1]["PK"], "SK": items[-1]["SK"]}
+        return items, None
+
+    @_sqlite_errors
+    def batch_get(self, keys: List[dict]) -> List[dict]:
+        with self._lock:
+            return [item for item in (self._select(self._conn, key) for key in keys) if item is not None]
+
+    @_sqlite_errors
+    def batch_put(self, items: List[dict]):
+        with self._transaction() as conn:
+            for item in items:
+                self._write(conn, _plain(item))
+
+    @_sqlite_errors
+    def batch_delete(self, keys: List[dict]):
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM items WHERE PK = ? AND SK = ?", [(key["PK"], key["SK"]) for key in keys])
+
+    @_sqlite_errors
+    def health_check(self):
+        with self._lock:
+            self._conn.execute("SELECT 1").fetchone()
+
+
+def create_item_store(app_config: AppConfig, dedicated_resource: bool = False) -> ItemStore:
+    # dedicated_resource: a DynamoDB store for another thread, the local stores are thread safe
+    if app_config.storage_backend == "dynamodb":
+        return DynamoDBStore(app_config, dedicated_resource=dedicated_resource)
+    stores = {"memory": InMemoryStore, "sqlite": SqliteStore}
+    return stores[app_config.storage_backend](app_config)
@@ -0,0 +1,113 @@
+from collections import defaultdict
+from functools import cached_property, lru_cache
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError
+from pydantic import BaseModel
+from typing import List, Optional, Set
+from .aws import get_client
+from .config import AppConfig
+from .db import DogsDbClient
+from .keys import normalize_image_sk
+from .models import ImageDb, ImageHashDb, ImageStatus
+from .observability import logger
+from .s3 import S3Client
+
+class TasksClient:
+    def __init__(self, app_config: AppConfig):
+        self.app_config = app_config
+        self.function_name = app_config.background_tasks_function_name
+        self.logger = Logger(service="dogs-service", child=True)
+
+    @cached_property
+    def client(self):
+        return get_client(self.app_config, "lambda")
+
+    def is_enabled(self) -> bool:
+        return self.function_name is not None
+
+    def submit(self, task: BaseModel):
+        self.logger.info(f"Submitting background task to {self.function_name}", task=task.model_dump())
+        self.client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="Event",
+            Payload=task.model_dump_json().encode("utf-8")
+        )
+
+class ImagesNotDeleted(Exception):
+    # Some S3 objects weren't deleted, the rows referencing them are kept for a retry
+    def __init__(self, s3_keys: List[str]):
+        super().__init__(f"Failed to delete {len(s3_keys)} S3 objects")
+        self.s3_keys = s3_keys
+
+def delete_dog_images(db: DogsDbClient, s3: S3Client, user_id: str, dog_id: int) -> int:
+    # Page by page, the gallery of a dog can be larger than what one query returns
+    images_count = 0
+    for images in db.iter_image_pages_by_dog(user_id, dog_id):
+        delete_images(db, s3, images)
+        images_count += len(images)
+    return images_count
+
+def delete_images(db: DogsDbClient, s3: S3Client, images: List[ImageDb]):
+    # Deduplicated images share S3 objects, an object is deleted only with its last reference
+    s3_keys = [image.s3_key for image in images if image.s3_key and not image.content_hash]
+    refs_by_hash = defaultdict(set)
+    for image in images:
+        if image.content_hash:
+            # Hash references always use the padded key, legacy rows included
+            refs_by_hash[image.content_hash].add(normalize_image_sk(image.SK))
+    if refs_by_hash:
+        user_id = images[0].PK.split("#", 1)[1]
+        image_hashes = db.batch_get_image_hashes(user_id, list(refs_by_hash))
+        found_hashes = {image_hash.content_hash for image_hash in image_hashes}
+        s3_keys.extend(image.s3_key for image in images
+                       if image.content_hash and image.content_hash not in found_hashes and image.s3_key)
+        for image_hash in image_hashes:
+            s3_key = _release_image_hash(db, user_id, image_hash, refs_by_hash[image_hash.content_hash])
+            if s3_key:
+                s3_keys.append(s3_key)
+
+    # Objects go before the image rows so a failed run can be retried from the rows that are still there:
+    # rows whose object wasn't deleted are kept, and the error fails the request or retries the task.
+    # Their hash may be gone already, the retry then deletes the object they reference
+    failed_keys = set()
+    if s3_keys:
+        failed_keys = {error["Key"] for error in s3.delete_objects(s3_keys)}
+    failed_keys.update(_abort_multipart_uploads(s3, images))
+    db.batch_delete_images([image for image in images
+                            if image.s3_key not in failed_keys and image.upload_key not in failed_keys])
+    if failed_keys:
+        raise ImagesNotDeleted(sorted(failed_keys))
+
+def _abort_multipart_uploads(s3: S3Client, images: List[ImageDb]) -> List[str]:
+    # Pending multipart uploads keep their parts (and their storage cost) until aborted. An upload that
+    # is already gone was completed or aborted, only the keys of the other failures are returned
+    failed_keys = []
+    for image in images:
+        if not image.upload_id or image.status != ImageStatus.PENDING:
+            continue
+        try:
+            s3.abort_multipart_upload(image.upload_key, image.upload_id)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "NoSuchUpload":
+                logger.warning("Failed to abort multipart upload", s3_key=image.upload_key, error=str(e))
+                failed_keys.append(image.upload_key)
+    return failed_keys
+
+def _release_image_hash(db: DogsDbClient, user_id: str, image_hash: ImageHashDb, refs: Set[str]) -> Optional[str]:
+    # Removes refs from the hash, or deletes the hash when they are its last references and returns its
+    # S3 key. The hash goes before its object: once it is gone add_image_hash_ref fails, and a concurrent
+    # duplicate keeps its own object instead of linking to a deleted one. Both writes are version checked,
+    # a hash changed meanwhile is read again
+    while image_hash is not None:
+        if set(image_hash.image_sks) - refs:
+            if db.remove_image_hash_refs(image_hash, sorted(refs)):
+                return None
+        elif db.delete_image_hash(image_hash):
+            return image_hash.s3_key
+        image_hash = db.get_image_hash(user_id, image_hash.content_hash)
+    return None
+
+@lru_cache(maxsize=1)
+def get_tasks_client(app_config: AppConfig) -> TasksClient:
+    return TasksClient(app_config=app_config)
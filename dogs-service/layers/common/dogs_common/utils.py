@@ -1,6 +1,11 @@
+import base64
+import json
 import os
 
 from datetime import datetime, timezone
+from typing import Optional
+
+from aws_lambda_powertools.event_handler import CORSConfig
 
 DATETIME_NOW_UTC_FN = lambda: datetime.now(timezone.utc)
 
@@ -14,5 +19,25 @@ def get_content_type_from_extension(extension: str) -> str:
     }
     return content_types.get(extension.lower(), 'application/octet-stream')
 
+def encode_page_token(last_key: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(last_key).encode("utf-8")).decode("ascii")
+
+def decode_page_token(token: str) -> dict:
+    try:
+        last_key = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid pagination token")
+    if not isinstance(last_key, dict):
+        raise ValueError("Invalid pagination token")
+    return last_key
+
 def is_running_local() -> bool:
-    return os.getenv("AWS_SAM_LOCAL") == "true" or os.getenv("LOCALSTACK_HOSTNAME") is not None
\ No newline at end of file
+    return os.getenv("AWS_SAM_LOCAL") == "true" or os.getenv("LOCALSTACK_HOSTNAME") is not None
+
+def cors_headers(event: dict, cors: Optional[CORSConfig]) -> dict:
+    """CORS headers the resolver adds to its responses, for the ones returned before it runs."""
+    if cors is None:
+        return {}
+    origin = next((value for key, value in (event.get("headers") or {}).items() if key.lower() == "origin"), None)
+    allowed = cors.allowed_origin(origin)
+    return cors.to_dict(allowed) if allowed is not None else {}
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Writes the PHASH# band items of image hashes registered before near duplicates were looked up by band
+# Usage: python scripts/index_image_phashes.py --table local-dogs-db [--endpoint-url http://localhost:4566] [--segments 8] [--dry-run]
+
+import argparse
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "layers", "common"))
+
+from dogs_common.keys import phash_band_sks  # noqa: E402
+
+
+def index_segment(table, segment: int, total_segments: int, dry_run: bool) -> int:
+    indexed = 0
+    params = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "FilterExpression": Attr("SK").begins_with("HASH#") & Attr("phash").exists(),
+    }
+    while True:
+        resp = table.scan(**params)
+        hash_items = resp.get("Items", [])
+
+        if hash_items and not dry_run:
+            # Band items are plain puts, a re-run or a hash indexed meanwhile by the processor is rewritten as is
+            with table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as batch:
+                for item in hash_items:
+                    for sk in phash_band_sks(item["phash"], item["content_hash"]):
+                        batch.put_item(Item={"PK": item["PK"], "SK": sk, "content_hash": item["content_hash"],
+                                             "phash": item["phash"]})
+        indexed += len(hash_items)
+
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key:
+            return indexed
+        params["ExclusiveStartKey"] = last_key
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Index the perceptual hashes of image hashes by band")
+    parser.add_argument("--table", default=os.getenv("TABLE_NAME", "local-dogs-db"))
+    parser.add_argument("--endpoint-url", default=os.getenv("ENDPOINT"))
+    parser.add_argument("--segments", type=int, default=8, help="parallel scan segments")
+    parser.add_argument("--dry-run", action="store_true", help="only count hashes to index")
+    args = parser.parse_args()
+
+    # boto3 resources are not thread safe, each segment gets its own
+    def run(segment: int) -> int:
+        table = boto3.session.Session().resource("dynamodb", endpoint_url=args.endpoint_url).Table(args.table)
+        return index_segment(table, segment, args.segments, args.dry_run)
+
+    with ThreadPoolExecutor(max_workers=args.segments) as pool:
+        counts = list(pool.map(run, range(args.segments)))
+
+    action = "Would index" if args.dry_run else "Indexed"
+    print(f"{action} {sum(counts)} image hashes in table '{args.table}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Rewrites legacy image rows (SK=IMAGE#<dog_id>#<image_id>) to the zero padded sort key format
+# Usage: python scripts/migrate_image_sort_keys.py --table local-dogs-db [--endpoint-url http://localhost:4566] [--segments 8] [--dry-run]
+
+import argparse
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "layers", "common"))
+
+from dogs_common.keys import image_sk, is_legacy_image_sk, parse_image_sk  # noqa: E402
+
+
+def migrate_segment(table, segment: int, total_segments: int, dry_run: bool) -> int:
+    migrated = 0
+    params = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "FilterExpression": Attr("SK").begins_with("IMAGE#"),
+    }
+    while True:
+        resp = table.scan(**params)
+        legacy_items = [item for item in resp.get("Items", []) if is_legacy_image_sk(item["SK"])]
+
+        if legacy_items and not dry_run:
+            # Write all new rows before deleting the old ones so an interrupted run never loses an image
+            with table.batch_writer() as batch:
+                for item in legacy_items:
+                    batch.put_item(Item={**item, "SK": image_sk(*parse_image_sk(item["SK"]))})
+            with table.batch_writer() as batch:
+                for item in legacy_items:
+                    batch.delete_item(Key={"PK": item["PK"], "SK": item["SK"]})
+        migrated += len(legacy_items)
+
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key:
+            return migrated
+        params["ExclusiveStartKey"] = last_key
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Migrate image sort keys to the sortable format")
+    parser.add_argument("--table", default=os.getenv("TABLE_NAME", "local-dogs-db"))
+    parser.add_argument("--endpoint-url", default=os.getenv("ENDPOINT"))
+    parser.add_argument("--segments", type=int, default=8, help="parallel scan segments")
+    parser.add_argument("--dry-run", action="store_true", help="only count rows to migrate")
+    args = parser.parse_args()
+
+    # boto3 resources are not thread safe, each segment gets its own
+    def run(segment: int) -> int:
+        table = boto3.session.Session().resource("dynamodb", endpoint_url=args.endpoint_url).Table(args.table)
+        return migrate_segment(table, segment, args.segments, args.dry_run)
+
+    with ThreadPoolExecutor(max_workers=args.segments) as pool:
+        counts = list(pool.map(run, range(args.segments)))
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{action} {sum(counts)} image rows in table '{args.table}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Reproducible cold-start import benchmark for both Lambda functions, based on
+`python -X importtime`. Every run imports the handler module in a fresh
+interpreter (after one warm-up run that compiles the bytecode), the median of
+the runs is compared with the budget in import_budget.json.
+
+import_budget.json also keeps the median measured before the import time work
+(baseline_ms). A budget is always set at least BASELINE_MARGIN below it, so
+undoing that work fails the benchmark even on a slower machine.
+
+Usage (from dogs-service/):
+    python -m tests.benchmark.bench_cold_start
+    python -m tests.benchmark.bench_cold_start --runs 20 --top 25
+    python -m tests.benchmark.bench_cold_start --update-budget
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from collections import defaultdict
+
+from tests.benchmark import harness
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), "import_budget.json")
+# Headroom applied to the measured median by --update-budget, capped at BASELINE_MARGIN below the baseline
+BUDGET_HEADROOM = 1.25
+BASELINE_MARGIN = 0.15
+
+FUNCTIONS = {
+    "app": "dogs_service_lambda",
+    "processor": "dogs_image_processor_lambda",
+}
+
+
+def import_once(module_name: str, function_dir: str) -> dict:
+    """Imports the module in a fresh interpreter, returns {module: (self_us, cumulative_us)}."""
+    env = {**os.environ, **harness.TEST_ENV}
+    env["PYTHONPATH"] = os.pathsep.join([
+        os.path.join(harness.SERVICE_ROOT, "layers", "common"),
+        os.path.join(harness.SERVICE_ROOT, function_dir),
+    ])
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        cwd=os.path.join(harness.SERVICE_ROOT, function_dir),
+        env=env, capture_output=True, text=True, check=True,
+    )
+    timings = {}
+    for line in proc.stderr.splitlines():
+        # import time:  self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def measure(module_name: str, function_dir: str, runs: int) -> dict:
+    import_once(module_name, function_dir)
+    totals = []
+    self_times = defaultdict(list)
+    for _ in range(runs):
+        timings = import_once(module_name, function_dir)
+        totals.append(timings[module_name][1] / 1000)
+        for name, (self_us, _) in timings.items():
+            self_times[name].append(self_us / 1000)
+    return {
+        "median_ms": round(statistics.median(totals), 1),
+        "min_ms": round(min(totals), 1),
+        "max_ms": round(max(totals), 1),
+        "modules": {name: round(statistics.median(samples), 2) for name, samples in self_times.items()},
+    }
+
+
+def load_budget() -> dict:
+    if not os.path.exists(BUDGET_FILE):
+        return {}
+    with open(BUDGET_FILE) as f:
+        return json.load(f)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure Lambda handler import time against the budget")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules (self time) to print")
+    parser.add_argument("--update-budget", action="store_true", help="store the measured medians plus headroom as the budget")
+    args = parser.parse_args()
+
+    budget = load_budget()
+    over_budget = []
+    for module_name, function_dir in FUNCTIONS.items():
+        result = measure(module_name, function_dir, args.runs)
+        entry = budget.setdefault(module_name, {})
+        limit = entry.get("budget_ms")
+        print(f"{module_name}: median {result['median_ms']} ms (min {result['min_ms']}, max {result['max_ms']}), "
+              f"budget {limit} ms, baseline {entry.get('baseline_ms')} ms")
+        slowest = sorted(result["modules"].items(), key=lambda item: item[1], reverse=True)[:args.top]
+        for name, self_ms in slowest:
+            print(f"    {self_ms:>8.2f} ms  {name}")
+        if args.update_budget:
+            limit = round(result["median_ms"] * BUDGET_HEADROOM)
+            if "baseline_ms" in entry:
+                limit = min(limit, round(entry["baseline_ms"] * (1 - BASELINE_MARGIN)))
+            entry["budget_ms"] = limit
+        elif limit is not None and result["median_ms"] > limit:
+            over_budget.append(f"{module_name}: {result['median_ms']} ms > {limit} ms")
+
+    if args.update_budget:
+        with open(BUDGET_FILE, "w") as f:
+            json.dump(budget, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Budget saved to {BUDGET_FILE}")
+    for message in over_budget:
+        print(f"OVER BUDGET {message}")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Benchmarks app.lambda_handler and processor.lambda_handler in-process against
+moto-backed DynamoDB and S3, using the sample payloads from events/*.json.
+
+Usage (from dogs-service/):
+    python -m tests.benchmark.bench_handlers
+    python -m tests.benchmark.bench_handlers --sizes 10 1000 --iterations 50 --save-baseline tests/benchmark/baseline.json
+    python -m tests.benchmark.bench_handlers --compare tests/benchmark/baseline.json --threshold 0.2
+"""
+
+import argparse
+import json
+import sys
+import uuid
+
+from tests.benchmark import harness
+
+DEFAULT_SIZES = [10, 1000, 10000]
+
+
+def bench_api(app, counter: harness.CallCounter, user_id: str, iterations: int) -> dict:
+    get_dogs = harness.load_event("200_get_dogs_ev.json", user_id)
+    post_dog = harness.load_event("200_post_dogs_ev.json", user_id)
+    post_image = harness.load_event("200_post_images_ev.json", user_id)
+    get_dog_images = harness.load_event("200_get_dogs_ev.json", user_id)
+    get_dog_images["path"] = get_dog_images["path"] + "/1/images"
+    get_health = harness.load_event("200_get_health_ev.json", user_id)
+
+    def invoke(event):
+        def call():
+            response = app.lambda_handler(event, harness.LambdaContext())
+            assert response["statusCode"] < 300, response
+        return call
+
+    return {
+        "GET /users/{user_id}/dogs": harness.measure(invoke(get_dogs), iterations, counter),
+        "GET /users/{user_id}/dogs/{dog_id}/images": harness.measure(invoke(get_dog_images), iterations, counter),
+        "POST /users/{user_id}/dogs": harness.measure(invoke(post_dog), iterations, counter),
+        "POST /users/{user_id}/dogs/{dog_id}/images": harness.measure(invoke(post_image), iterations, counter),
+        "GET /health": harness.measure(invoke(get_health), iterations, counter),
+    }
+
+
+def bench_processor(processor, counter: harness.CallCounter, user_id: str, iterations: int) -> dict:
+    import boto3
+
+    s3 = boto3.client("s3")
+    db = processor._processor.db
+    with open(harness.SAMPLE_IMAGE, "rb") as f:
+        image_bytes = f.read()
+
+    def upload(i: int):
+        # Fresh pending image and object for every run, outside of the measured call
+        image_id = 1_000_000 + i
+        key = f"users/{user_id}/dogs/1/images/{image_id}.jpg"
+        db.create_image(user_id, 1, image_id)
+        s3.put_object(Bucket=harness.BUCKET_NAME, Key=key, Body=image_bytes)
+        event = harness.s3_event("s3_put_image_ev.json", key, len(image_bytes))
+        return lambda: processor.lambda_handler(event, harness.LambdaContext())
+
+    removed = harness.s3_event("s3_delete_image_ev.json", f"users/{user_id}/dogs/1/images/1.jpg", 0)
+    return {
+        "S3 ObjectCreated:Put": harness.measure(None, iterations, counter, setup=upload),
+        "S3 ObjectRemoved:Delete": harness.measure(
+            lambda: processor.lambda_handler(removed, harness.LambdaContext()), iterations, counter),
+    }
+
+
+def run(sizes, iterations: int, images_per_dog: int) -> dict:
+    harness.configure_environment()
+    results = {}
+    with harness.mocked_aws():
+        counter = harness.CallCounter().install()
+        app = harness.import_lambda_module("dogs_service_lambda", "app")
+        processor = harness.import_lambda_module("dogs_image_processor_lambda", "processor")
+        for size in sizes:
+            user_id = str(uuid.uuid4())
+            harness.seed_account(user_id, size, images_per_dog)
+            for route, result in bench_api(app, counter, user_id, iterations).items():
+                results[f"{route} [{size} dogs]"] = result
+            for route, result in bench_processor(processor, counter, user_id, iterations).items():
+                results[f"{route} [{size} dogs]"] = result
+    return results
+
+
+def print_results(results: dict):
+    print(f"{'benchmark':<58} {'p50 ms':>9} {'p99 ms':>9}  calls/request")
+    for name, result in results.items():
+        calls = ", ".join(f"{service}={count}" for service, count in result["calls_per_request"].items())
+        print(f"{name:<58} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}  {calls}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the API and processor Lambda handlers locally")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="dogs per seeded account")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--images-per-dog", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--save-baseline", help="store the results as a baseline")
+    parser.add_argument("--compare", help="baseline to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed latency increase over the baseline")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.iterations, args.images_per_dog)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        harness.save_baseline(args.save_baseline, results)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        regressions = harness.compare_with_baseline(args.compare, results, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
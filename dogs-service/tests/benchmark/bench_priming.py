@@ -0,0 +1,83 @@
+"""
+Measures the first-request latency of both Lambda functions with and without
+PRIME_ON_INIT. Every run starts a fresh interpreter (a new "container") against
+moto-backed DynamoDB and S3, times the module import (init phase), then the
+first and second request.
+
+moto intercepts requests before they reach the network, so the TLS handshake
+saved by priming is not part of these numbers; they cover client creation,
+botocore service models and pydantic/route validators.
+
+Usage (from dogs-service/):
+    python -m tests.benchmark.bench_priming --runs 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+from tests.benchmark import harness
+
+
+def child(function: str):
+    harness.configure_environment()
+    with harness.mocked_aws():
+        if function == "app":
+            user_id = str(uuid.uuid4())
+            harness.seed_account(user_id, 10)
+            event = harness.load_event("200_get_dogs_ev.json", user_id)
+            start = time.perf_counter()
+            module = harness.import_lambda_module("dogs_service_lambda", "app")
+            init_ms = (time.perf_counter() - start) * 1000
+        else:
+            start = time.perf_counter()
+            module = harness.import_lambda_module("dogs_image_processor_lambda", "processor")
+            init_ms = (time.perf_counter() - start) * 1000
+            # The removal event needs no object or row, so both requests do the same work
+            event = harness.s3_event("s3_delete_image_ev.json", f"users/{uuid.uuid4()}/dogs/1/images/1.jpg", 0)
+
+        latencies = []
+        for _ in range(2):
+            start = time.perf_counter()
+            module.lambda_handler(event, harness.LambdaContext())
+            latencies.append((time.perf_counter() - start) * 1000)
+    print(json.dumps({"init_ms": init_ms, "first_ms": latencies[0], "second_ms": latencies[1]}))
+
+
+def run_child(function: str, primed: bool) -> dict:
+    env = {**os.environ, "PRIME_ON_INIT": str(primed).lower(), "POWERTOOLS_METRICS_NAMESPACE": "DogsServiceBench"}
+    proc = subprocess.run(
+        [sys.executable, "-m", "tests.benchmark.bench_priming", "--child", function],
+        cwd=harness.SERVICE_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    # The last line is the result, the lines before are the EMF metrics printed by the handler
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare primed and unprimed first-request latency")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", choices=["app", "processor"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return 0
+
+    print(f"{'function':<10} {'mode':<9} {'init ms':>9} {'first ms':>9} {'second ms':>10}")
+    for function in ("app", "processor"):
+        for primed in (False, True):
+            results = [run_child(function, primed) for _ in range(args.runs)]
+            medians = {key: statistics.median(result[key] for result in results) for key in results[0]}
+            mode = "primed" if primed else "unprimed"
+            print(f"{function:<10} {mode:<9} {medians['init_ms']:>9.1f} {medians['first_ms']:>9.1f} {medians['second_ms']:>10.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Measures the handler overhead of each TRACING_MODE. Every mode runs in a fresh
+interpreter, because the tracer is configured at import, and reports the
+import time and the p50 of every API route against moto-backed DynamoDB and S3.
+
+The X-Ray SDK is run as in Lambda: AWS_LAMBDA_FUNCTION_NAME is set and every
+request carries a _X_AMZN_TRACE_ID header, sampled or not. Segments are sent
+over UDP to the daemon address and dropped when no daemon listens.
+
+Usage (from dogs-service/):
+    python -m tests.benchmark.bench_tracing --dogs 1000 --iterations 30
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+from tests.benchmark import harness
+from tests.benchmark.bench_handlers import bench_api
+
+# (label, TRACING_MODE, sampled)
+SCENARIOS = [
+    ("off", "off", False),
+    ("minimal unsampled", "minimal", False),
+    ("minimal sampled", "minimal", True),
+    ("full unsampled", "full", False),
+    ("full sampled", "full", True),
+]
+
+
+def child(dogs: int, iterations: int):
+    harness.configure_environment()
+    with harness.mocked_aws():
+        counter = harness.CallCounter().install()
+        start = time.perf_counter()
+        app = harness.import_lambda_module("dogs_service_lambda", "app")
+        import_ms = (time.perf_counter() - start) * 1000
+        user_id = str(uuid.uuid4())
+        harness.seed_account(user_id, dogs)
+        results = bench_api(app, counter, user_id, iterations)
+    print(json.dumps({"import_ms": import_ms, "p50_ms": {route: result["p50_ms"] for route, result in results.items()}}))
+
+
+def run_child(mode: str, sampled: bool, dogs: int, iterations: int) -> dict:
+    env = {
+        **os.environ,
+        "TRACING_MODE": mode,
+        "POWERTOOLS_TRACE_DISABLED": "false",
+        "POWERTOOLS_METRICS_DISABLED": "true",
+        "AWS_LAMBDA_FUNCTION_NAME": "bench",
+        "_X_AMZN_TRACE_ID": f"Root=1-{int(time.time()):08x}-{uuid.uuid4().hex[:24]};Parent={uuid.uuid4().hex[:16]};"
+                            f"Sampled={int(sampled)}",
+    }
+    proc = subprocess.run(
+        [sys.executable, "-m", "tests.benchmark.bench_tracing", "--child", "--dogs", str(dogs), "--iterations", str(iterations)],
+        cwd=harness.SERVICE_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare handler overhead with tracing on and off")
+    parser.add_argument("--dogs", type=int, default=1000, help="dogs in the seeded account")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.dogs, args.iterations)
+        return 0
+
+    results = {label: run_child(mode, sampled, args.dogs, args.iterations) for label, mode, sampled in SCENARIOS}
+    labels = [label for label, _, _ in SCENARIOS]
+    print(f"{'p50 ms':<45}" + "".join(f"{label:>19}" for label in labels))
+    print(f"{'import':<45}" + "".join(f"{results[label]['import_ms']:>19.1f}" for label in labels))
+    for route in results["off"]["p50_ms"]:
+        print(f"{route:<45}" + "".join(f"{results[label]['p50_ms'][route]:>19.2f}" for label in labels))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Shared helpers for the local benchmarks: AWS call counting and latency statistics. The moto-backed
+AWS environment and the sample events come from tests/unit/environment.py, shared with the unit tests.
+"""
+
+import json
+import math
+import time
+
+from collections import Counter
+from typing import Callable, List, Optional
+
+from tests.unit.environment import (  # noqa: F401
+    BUCKET_NAME, EVENTS_USER_ID, SAMPLE_IMAGE, SERVICE_ROOT, TABLE_NAME, TEST_ENV, LambdaContext,
+    configure_environment, create_resources, import_lambda_module, load_event, mocked_aws, s3_event, seed_account,
+)
+
+
+class CallCounter:
+    """Counts AWS API calls per service made by any client of the shared dogs_common session."""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def install(self):
+        from dogs_common.aws import get_session
+
+        get_session().events.register("before-call", self._on_call)
+        return self
+
+    def reset(self):
+        self.calls.clear()
+
+    def _on_call(self, event_name: str, **kwargs):
+        # event_name is before-call.<service>.<operation>
+        self.calls[event_name.split(".")[1]] += 1
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(samples)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(samples_ms: List[float], calls: Counter, requests: int) -> dict:
+    return {
+        "requests": requests,
+        "p50_ms": round(percentile(samples_ms, 50), 3),
+        "p99_ms": round(percentile(samples_ms, 99), 3),
+        "mean_ms": round(sum(samples_ms) / len(samples_ms), 3),
+        "calls_per_request": {service: round(count / requests, 2) for service, count in sorted(calls.items())},
+    }
+
+
+def measure(fn: Callable[[], object], iterations: int, counter: CallCounter,
+            setup: Optional[Callable[[int], Callable[[], object]]] = None) -> dict:
+    """Runs fn (or the callable returned by setup(i)) iterations times, setup calls are not measured."""
+    samples = []
+    calls = Counter()
+    for i in range(iterations):
+        call = setup(i) if setup else fn
+        counter.reset()
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+        calls.update(counter.calls)
+    return summarize(samples, calls, iterations)
+
+
+def save_baseline(path: str, results: dict):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare_with_baseline(path: str, results: dict, threshold: float) -> List[str]:
+    """Returns a message per regression: latency above baseline * (1 + threshold) or more AWS calls."""
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {base[metric]} -> {result[metric]}")
+        for service, count in result["calls_per_request"].items():
+            base_count = base["calls_per_request"].get(service, 0)
+            if count > base_count:
+                regressions.append(f"{name}: {service} calls per request {base_count} -> {count}")
+    return regressions
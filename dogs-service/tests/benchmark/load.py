@@ -0,0 +1,449 @@
+"""
+Drives the service at a target request rate with a traffic mix, to find where
+throughput saturates. Reports a latency histogram, per-operation percentiles,
+throughput and error rates.
+
+Requests are sent on an open-loop schedule: every worker process starts its
+share of the requests at fixed intervals and latency is measured from the
+scheduled start, so time spent queued behind a slow request is included.
+Requests that can't start before the end of the step are reported as dropped.
+
+Targets:
+- in-process (default): every worker imports app.lambda_handler and
+  processor.lambda_handler with S3 mocked by moto. STORAGE_BACKEND=sqlite (the
+  default here) makes all workers share one database file, so hot users
+  contend as they would on one table; memory and dynamodb (moto) give every
+  worker its own data.
+- http: server mode or `sam local start-api`. Uploads PUT the image to the
+  presigned URL; with --lambda-endpoint (`sam local start-lambda`) the
+  synthesized S3 event is also sent to the processor function.
+
+Usage (from dogs-service/):
+    python -m tests.benchmark.load --rate 50 --duration 20
+    python -m tests.benchmark.load --scenario hot-user --rates 25 50 100 200
+    python -m tests.benchmark.load --scenario hot-sequence --storage memory --workers 1
+    python -m tests.benchmark.load --target http://127.0.0.1:8080 --workers 16 --rates 100 200 400
+    python -m tests.benchmark.load --target http://127.0.0.1:3000 --lambda-endpoint http://127.0.0.1:3001
+"""
+
+import argparse
+import copy
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from tests.benchmark import harness
+
+# name: (traffic mix weights, fraction of requests sent to the hot user)
+SCENARIOS = {
+    "mixed": ({"list_dogs": 60, "create_dog": 15, "create_image": 15, "upload": 10}, 0.0),
+    # One user gets most of the traffic: a single USER# partition
+    "hot-user": ({"list_dogs": 60, "create_dog": 15, "create_image": 15, "upload": 10}, 0.8),
+    # Every request increments the META#SEQUENCE counter of the same user
+    "hot-sequence": ({"create_dog": 50, "create_image": 50}, 1.0),
+}
+
+DOGS_RESOURCE = "/users/{user_id}/dogs"
+IMAGES_RESOURCE = "/users/{user_id}/dogs/{dog_id}/images"
+
+# Upper bounds of the histogram buckets in ms, the last bucket is open
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# (operation, HTTP status or 0 for an exception, latency ms)
+Sample = Tuple[str, int, float]
+
+
+class InProcessClient:
+    def __init__(self):
+        from moto import mock_aws
+
+        harness.configure_environment()
+        self._mock = mock_aws()
+        self._mock.start()
+        harness.create_resources()
+        self.app = harness.import_lambda_module("dogs_service_lambda", "app")
+        self.processor = harness.import_lambda_module("dogs_image_processor_lambda", "processor")
+        self._template = harness.load_event("200_get_dogs_ev.json")
+
+        import boto3
+        self._s3 = boto3.client("s3")
+
+    def request(self, method: str, resource: str, params: dict, body: Optional[dict] = None) -> Tuple[int, dict]:
+        path = resource.format(**params)
+        event = copy.deepcopy(self._template)
+        event.update(resource=resource, path=path, httpMethod=method, pathParameters=params,
+                     body=json.dumps(body) if body is not None else None, queryStringParameters=None)
+        event["requestContext"].update(resourcePath=resource, httpMethod=method, path=path, requestId=str(uuid.uuid4()))
+        response = self.app.lambda_handler(event, harness.LambdaContext())
+        return response["statusCode"], json.loads(response["body"] or "null")
+
+    def upload(self, user_id: str, dog_id: int, image: dict, data: bytes) -> List[Sample]:
+        key = f"users/{user_id}/dogs/{dog_id}/images/{image['image']['image_id']}.jpg"
+        start = time.perf_counter()
+        self._s3.put_object(Bucket=harness.BUCKET_NAME, Key=key, Body=data)
+        samples = [("upload.put", 200, (time.perf_counter() - start) * 1000)]
+        start = time.perf_counter()
+        try:
+            self.processor.lambda_handler(harness.s3_event("s3_put_image_ev.json", key, len(data)), harness.LambdaContext())
+            status = 200
+        except Exception:
+            status = 0
+        samples.append(("upload.process", status, (time.perf_counter() - start) * 1000))
+        return samples
+
+
+class HttpClient:
+    def __init__(self, base_url: str, lambda_endpoint: Optional[str], processor_function: str):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.prefix = url.path.rstrip("/")
+        self._conn = None
+        self.processor_function = processor_function
+        self._lambda = None
+        if lambda_endpoint:
+            import boto3
+            from botocore.config import Config
+            self._lambda = boto3.client("lambda", endpoint_url=lambda_endpoint, region_name=harness.TEST_ENV["AWS_DEFAULT_REGION"],
+                                        config=Config(read_timeout=120, retries={"max_attempts": 1}))
+
+    def request(self, method: str, resource: str, params: dict, body: Optional[dict] = None) -> Tuple[int, dict]:
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        path = self.prefix + resource.format(**params)
+        reused = self._conn is not None
+        try:
+            response, data = self._send(method, path, payload, headers)
+        except (ConnectionError, http.client.RemoteDisconnected):
+            # The server may close an idle keep-alive connection, retried once on a new one like HTTP clients do
+            if not reused:
+                raise
+            response, data = self._send(method, path, payload, headers)
+        try:
+            return response.status, json.loads(data or b"null")
+        except ValueError:
+            return response.status, None
+
+    def _send(self, method: str, path: str, payload: Optional[bytes], headers: dict):
+        if self._conn is None:
+            # One keep-alive connection per worker
+            self._conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            self._conn.request(method, path, body=payload, headers=headers)
+            response = self._conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._conn = None
+            raise
+        if response.will_close:
+            self._conn.close()
+            self._conn = None
+        return response, data
+
+    def upload(self, user_id: str, dog_id: int, image: dict, data: bytes) -> List[Sample]:
+        instructions = image["upload_instructions"]
+        request = urllib.request.Request(instructions["presigned_url"], data=data, method="PUT",
+                                         headers=instructions.get("headers") or {})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 0
+        samples = [("upload.put", status, (time.perf_counter() - start) * 1000)]
+        if self._lambda is None or status >= 300 or status == 0:
+            return samples
+
+        key = f"users/{user_id}/dogs/{dog_id}/images/{image['image']['image_id']}.jpg"
+        event = harness.s3_event("s3_put_image_ev.json", key, len(data))
+        start = time.perf_counter()
+        try:
+            response = self._lambda.invoke(FunctionName=self.processor_function, Payload=json.dumps(event).encode("utf-8"))
+            status = 500 if response.get("FunctionError") else 200
+        except Exception:
+            status = 0
+        samples.append(("upload.process", status, (time.perf_counter() - start) * 1000))
+        return samples
+
+
+def create_client(options: dict):
+    if options["target"] == "in-process":
+        return InProcessClient()
+    return HttpClient(options["target"], options["lambda_endpoint"], options["processor_function"])
+
+
+def seed_users(client, users: List[str], dogs_per_user: int):
+    # Through the API, so the same code seeds every target
+    for user_id in users:
+        for i in range(dogs_per_user):
+            status, _ = client.request("POST", DOGS_RESOURCE, {"user_id": user_id}, {"name": f"dog-{i + 1}", "age": i % 15})
+            if status >= 300:
+                raise RuntimeError(f"Seeding user {user_id} failed with status {status}")
+
+
+def run_operation(client, operation: str, user_id: str, dogs_per_user: int, rng: random.Random,
+                  image_data: bytes) -> List[Sample]:
+    dog_id = rng.randint(1, dogs_per_user)
+    start = time.perf_counter()
+    try:
+        if operation == "list_dogs":
+            status, _ = client.request("GET", DOGS_RESOURCE, {"user_id": user_id})
+        elif operation == "create_dog":
+            status, _ = client.request("POST", DOGS_RESOURCE, {"user_id": user_id}, {"name": "load", "age": 3})
+        elif operation in ("create_image", "upload"):
+            status, image = client.request("POST", IMAGES_RESOURCE, {"user_id": user_id, "dog_id": str(dog_id)},
+                                           {"image_extension": "jpg"})
+        else:
+            raise ValueError(f"Unknown operation {operation}")
+    except Exception:
+        status = 0
+    latency_ms = (time.perf_counter() - start) * 1000
+
+    if operation != "upload":
+        return [(operation, status, latency_ms)]
+    samples = [("upload.create_image", status, latency_ms)]
+    if 200 <= status < 300:
+        samples.extend(client.upload(user_id, dog_id, image, image_data))
+    return samples
+
+
+# Set in every pool worker by init_worker
+_client = None
+_options = None
+
+
+def init_worker(options: dict, ready):
+    global _client, _options
+    _options = options
+    _client = create_client(options)
+    if options["seed_per_worker"]:
+        seed_users(_client, options["users"], options["dogs_per_user"])
+    # The first request of a process pays for lazy imports and validators, not part of the measurement
+    _client.request("GET", DOGS_RESOURCE, {"user_id": options["users"][0]})
+    ready.wait()
+
+
+def seed_shared(options: dict):
+    seed_users(create_client(options), options["users"], options["dogs_per_user"])
+
+
+def run_schedule(args: Tuple[float, float, float, int]) -> Tuple[List[Tuple[str, int, float]], int]:
+    rate, duration, start_at, seed = args
+    rng = random.Random(seed)
+    mix = _options["mix"]
+    operations, weights = list(mix), list(mix.values())
+    users, hot_fraction = _options["users"], _options["hot_fraction"]
+    with open(harness.SAMPLE_IMAGE, "rb") as f:
+        image_data = f.read()
+
+    samples: List[Sample] = []
+    dropped = 0
+    interval = 1.0 / rate
+    # Workers are offset so their requests interleave instead of arriving in bursts
+    scheduled = start_at + rng.random() * interval
+    end_at = start_at + duration
+    while scheduled < end_at:
+        now = time.time()
+        if now < scheduled:
+            time.sleep(scheduled - now)
+        elif now >= end_at:
+            # Behind schedule past the end of the step: these requests were never sent
+            dropped += int((end_at - scheduled) / interval) + 1
+            break
+        # Queueing delay behind the previous request counts as latency of the first call of the operation
+        lag_ms = max(0.0, time.time() - scheduled) * 1000
+        user_id = users[0] if rng.random() < hot_fraction else rng.choice(users)
+        operation = rng.choices(operations, weights)[0]
+        op_samples = run_operation(_client, operation, user_id, _options["dogs_per_user"], rng, image_data)
+        name, status, latency_ms = op_samples[0]
+        op_samples[0] = (name, status, latency_ms + lag_ms)
+        samples.extend(op_samples)
+        scheduled += interval
+    return samples, dropped
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    return harness.percentile(samples, pct) if samples else 0.0
+
+
+def histogram(latencies: List[float]) -> List[int]:
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for latency in latencies:
+        index = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_MS) if latency <= bound), len(HISTOGRAM_BUCKETS_MS))
+        counts[index] += 1
+    return counts
+
+
+def summarize(samples: List[Sample], dropped: int, rate: float, duration: float) -> dict:
+    by_operation: Dict[str, List[Sample]] = defaultdict(list)
+    for sample in samples:
+        by_operation[sample[0]].append(sample)
+
+    operations = {}
+    for name, op_samples in sorted(by_operation.items()):
+        latencies = [latency for _, _, latency in op_samples]
+        statuses = Counter(status for _, status, _ in op_samples)
+        errors = sum(count for status, count in statuses.items() if status == 0 or status >= 500)
+        rejected = sum(count for status, count in statuses.items() if 400 <= status < 500)
+        operations[name] = {
+            "requests": len(op_samples),
+            "errors": errors,
+            "rejected": rejected,
+            "error_rate": errors / len(op_samples),
+            "statuses": {str(status): count for status, count in sorted(statuses.items())},
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p90_ms": round(percentile(latencies, 90), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(max(latencies), 2),
+            "histogram": histogram(latencies),
+        }
+
+    # Operations started (an upload counts once), compared with the offered rate
+    started = sum(1 for name, _, _ in samples if not name.startswith("upload.") or name == "upload.create_image")
+    latencies = [latency for _, _, latency in samples]
+    errors = sum(1 for _, status, _ in samples if status == 0 or status >= 500)
+    return {
+        "offered_rate": rate,
+        "duration_s": duration,
+        "throughput": round(started / duration, 2),
+        "requests": len(samples),
+        "dropped": dropped,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "histogram": histogram(latencies),
+        "operations": operations,
+    }
+
+
+def print_histogram(counts: List[int]):
+    total = sum(counts) or 1
+    peak = max(counts) or 1
+    lower = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS_MS + [math.inf], counts):
+        label = f"{lower}-{bound} ms" if bound != math.inf else f">{lower} ms"
+        print(f"  {label:>14} {count:>8} {count / total:>7.1%} {'#' * round(40 * count / peak)}")
+        lower = bound
+
+
+def print_step(result: dict):
+    print(f"\noffered {result['offered_rate']:g} ops/s, achieved {result['throughput']:g} ops/s, "
+          f"{result['requests']} requests, {result['dropped']} dropped, {result['error_rate']:.2%} errors")
+    print_histogram(result["histogram"])
+    print(f"  {'operation':<22} {'requests':>9} {'errors':>7} {'4xx':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, op in result["operations"].items():
+        print(f"  {name:<22} {op['requests']:>9} {op['errors']:>7} {op['rejected']:>6} "
+              f"{op['p50_ms']:>9.2f} {op['p90_ms']:>9.2f} {op['p99_ms']:>9.2f} {op['max_ms']:>9.2f}")
+
+
+def print_summary(results: List[dict]):
+    print(f"\n{'offered ops/s':>14} {'achieved':>10} {'dropped':>8} {'errors':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        print(f"{result['offered_rate']:>14g} {result['throughput']:>10g} {result['dropped']:>8} "
+              f"{result['error_rate']:>8.2%} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+    saturated = next((r for r in results if r["dropped"] or r["throughput"] < 0.9 * r["offered_rate"]), None)
+    if saturated:
+        print(f"Saturated at {saturated['offered_rate']:g} ops/s offered ({saturated['throughput']:g} ops/s achieved)")
+    else:
+        print("Not saturated at the highest rate")
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Drive the service at a target rate and report latency and throughput")
+    parser.add_argument("--target", default="in-process", help="in-process, or the base URL of the API")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--mix", type=parse_mix, help="operation weights, e.g. list_dogs=60,create_dog=20,upload=20")
+    parser.add_argument("--hot-fraction", type=float, help="fraction of requests sent to the hot user")
+    parser.add_argument("--rate", type=float, default=20, help="operations per second over all workers")
+    parser.add_argument("--rates", type=float, nargs="+", help="run one step per rate, to find where throughput saturates")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per step")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes, one request in flight each")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--dogs-per-user", type=int, default=3)
+    parser.add_argument("--storage", choices=["sqlite", "memory", "dynamodb"], default="sqlite",
+                        help="STORAGE_BACKEND of the in-process workers")
+    parser.add_argument("--lambda-endpoint", help="sam local start-lambda endpoint, to send S3 events to the processor")
+    parser.add_argument("--processor-function", default="DogsImageProcessorFunction")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    mix, hot_fraction = SCENARIOS[args.scenario]
+    mix = args.mix or mix
+    hot_fraction = args.hot_fraction if args.hot_fraction is not None else hot_fraction
+    in_process = args.target == "in-process"
+    rng = random.Random(args.seed)
+    options = {
+        "target": args.target,
+        "lambda_endpoint": args.lambda_endpoint,
+        "processor_function": args.processor_function,
+        "mix": mix,
+        "hot_fraction": hot_fraction,
+        "users": [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.users)],
+        "dogs_per_user": args.dogs_per_user,
+        # Stores private to a worker process are seeded by every worker
+        "seed_per_worker": in_process and args.storage != "sqlite",
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if in_process:
+            # Inherited by the workers, they import the app after the pool starts
+            os.environ["STORAGE_BACKEND"] = args.storage
+            os.environ["SQLITE_PATH"] = os.path.join(tmp, "load.sqlite3")
+        if not options["seed_per_worker"]:
+            # Shared store: seeded once, from a child process so the parent never imports the app
+            with multiprocessing.get_context("spawn").Pool(1) as seeder:
+                seeder.apply(seed_shared, (options,))
+
+        results = []
+        context = multiprocessing.get_context("spawn")
+        # Steps start once every worker is ready
+        ready = context.Barrier(args.workers + 1)
+        with context.Pool(args.workers, initializer=init_worker, initargs=(options, ready)) as pool:
+            ready.wait()
+            for step, rate in enumerate(args.rates or [args.rate]):
+                start_at = time.time() + 1
+                schedules = [(rate / args.workers, args.duration, start_at, args.seed * 1000 + step * 100 + i)
+                             for i in range(args.workers)]
+                samples, dropped = [], 0
+                for worker_samples, worker_dropped in pool.map(run_schedule, schedules, chunksize=1):
+                    samples.extend(worker_samples)
+                    dropped += worker_dropped
+                result = summarize(samples, dropped, rate, args.duration)
+                print_step(result)
+                results.append(result)
+
+    if len(results) > 1:
+        print_summary(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"scenario": args.scenario, "mix": mix, "hot_fraction": hot_fraction, "target": args.target,
+                       "workers": args.workers, "histogram_buckets_ms": HISTOGRAM_BUCKETS_MS, "steps": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import pytest
+
+from tests.unit.environment import BUCKET_NAME, TABLE_NAME, configure_environment, import_lambda_module, mocked_aws
+
+configure_environment()
+
+from dogs_common.config import AppConfig  # noqa: E402
+from dogs_common.storage import _memory_tables, create_item_store  # noqa: E402
+
+BACKENDS = ["dynamodb", "memory", "sqlite"]
+
+
+def backend_config(backend: str, tmp_path, **overrides) -> AppConfig:
+    return AppConfig(dogs_table_name=TABLE_NAME, dogs_images_bucket=BUCKET_NAME, storage_backend=backend,
+                     sqlite_path=str(tmp_path / "items.sqlite3"), **overrides)
+
+
+@pytest.fixture
+def aws():
+    # The table and bucket of the service on moto
+    with mocked_aws():
+        yield
+
+
+@pytest.fixture(params=BACKENDS)
+def store_config(request, tmp_path, aws):
+    # A config per storage backend, with an empty table. S3 is on moto for every backend
+    _memory_tables.pop(TABLE_NAME, None)
+    yield backend_config(request.param, tmp_path)
+    _memory_tables.pop(TABLE_NAME, None)
+
+
+@pytest.fixture
+def store(store_config):
+    return create_item_store(store_config, dedicated_resource=True)
+
+
+@pytest.fixture(scope="session")
+def service_handlers():
+    # handlers.py of the dogs service, the processor has its own
+    return import_lambda_module("dogs_service_lambda", "handlers")
+
+
+@pytest.fixture(scope="session")
+def processor_handlers():
+    return import_lambda_module("dogs_image_processor_lambda", "handlers")
+
+
+@pytest.fixture(scope="session")
+def api_module():
+    return import_lambda_module("dogs_service_lambda", "app")
+
+
+@pytest.fixture(scope="session")
+def server_module():
+    # server.py imports app.py as its own module
+    return import_lambda_module("dogs_service_lambda", "server")
+
+
+@pytest.fixture
+def api(api_module, aws):
+    # The API Lambda on moto, with the config of the environment and clients created for this test
+    api_module.reset_dogs_service()
+    yield api_module
+    api_module.reset_dogs_service()
@@ -0,0 +1,159 @@
+"""
+The AWS environment of the unit tests and the local benchmarks: moto with the table and bucket of
+the service, the environment the handlers read their config from and the sample events from
+events/*.json. Plain helpers, the pytest fixtures built on them are in conftest.py.
+"""
+
+import copy
+import importlib
+import json
+import os
+import sys
+import uuid
+
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Dict, Optional
+
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+EVENTS_DIR = os.path.join(SERVICE_ROOT, "events")
+SAMPLE_IMAGE = os.path.join(SERVICE_ROOT, "files", "test.jpg")
+# User id and dog id used in the sample events
+EVENTS_USER_ID = "53bea77a-f2bd-42a0-a445-6c7477fce1c9"
+
+TABLE_NAME = "test-dogs-db"
+BUCKET_NAME = "test-dogs-images"
+
+TEST_ENV = {
+    "AWS_DEFAULT_REGION": "eu-west-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "DOGS_TABLE_NAME": TABLE_NAME,
+    "DOGS_IMAGES_BUCKET": BUCKET_NAME,
+    "SUPPORTED_IMAGE_EXTENSIONS": '["jpg", "jpeg", "png", "webp"]',
+    "LOG_LEVEL": "ERROR",
+    "POWERTOOLS_TRACE_DISABLED": "true",
+    # Request metrics are still collected, only printing the EMF lines is skipped
+    "POWERTOOLS_METRICS_DISABLED": "true",
+    "POWERTOOLS_LOGGER_LOG_EVENT": "false",
+}
+
+
+class LambdaContext:
+    function_name = "test"
+    memory_limit_in_mb = 512
+    invoked_function_arn = "arn:aws:lambda:eu-west-1:123456789012:function:test"
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+
+def configure_environment(overrides: Optional[Dict[str, str]] = None):
+    for key, value in {**TEST_ENV, **(overrides or {})}.items():
+        os.environ.setdefault(key, value)
+    common_layer = os.path.join(SERVICE_ROOT, "layers", "common")
+    if common_layer not in sys.path:
+        sys.path.insert(0, common_layer)
+
+
+def import_lambda_module(function_dir: str, module_name: str):
+    # Both functions have a top level `handlers` module, so each one is imported from its own dir
+    # and the shared module names are dropped from sys.modules afterwards
+    path = os.path.join(SERVICE_ROOT, function_dir)
+    sys.path.insert(0, path)
+    try:
+        for name in ("handlers", "exception_handlers", module_name):
+            sys.modules.pop(name, None)
+        return importlib.import_module(module_name)
+    finally:
+        sys.path.remove(path)
+        for name in ("handlers", "exception_handlers", module_name):
+            sys.modules.pop(name, None)
+
+
+def create_resources():
+    import boto3
+
+    boto3.client("dynamodb").create_table(
+        TableName=TABLE_NAME,
+        AttributeDefinitions=[
+            {"AttributeName": "PK", "AttributeType": "S"},
+            {"AttributeName": "SK", "AttributeType": "S"},
+        ],
+        KeySchema=[
+            {"AttributeName": "PK", "KeyType": "HASH"},
+            {"AttributeName": "SK", "KeyType": "RANGE"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    boto3.client("s3").create_bucket(
+        Bucket=BUCKET_NAME,
+        CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_DEFAULT_REGION"]},
+    )
+
+
+@contextmanager
+def mocked_aws():
+    from moto import mock_aws
+
+    with mock_aws():
+        create_resources()
+        yield
+
+
+def seed_account(user_id: str, dogs: int, images_per_dog: int = 1):
+    import boto3
+
+    # Same item layout as dogs_common.db, written directly to keep seeding fast
+    from dogs_common.config import get_config
+    from dogs_common.keys import image_sk
+    from dogs_common.storage import create_item_store
+
+    config = get_config()
+    pk = f"USER#{user_id}"
+    now = "2025-01-01T00:00:00+00:00"
+    items = []
+    for dog_id in range(1, dogs + 1):
+        items.append({"PK": pk, "SK": f"DOG#{dog_id}", "name": f"dog-{dog_id}", "age": Decimal(dog_id % 15),
+                      "version": Decimal(1), "created_at": now, "updated_at": now})
+        for image_id in range(1, images_per_dog + 1):
+            items.append({"PK": pk, "SK": image_sk(dog_id, dog_id * images_per_dog + image_id),
+                          "status": "uploaded", "s3_key": f"users/{user_id}/dogs/{dog_id}/images/{image_id}.jpg",
+                          "version": Decimal(1), "created_at": now, "updated_at": now})
+    items.append({"PK": pk, "SK": "META#SEQUENCE", "dog_counter": Decimal(dogs),
+                  "image_counter": Decimal(dogs * images_per_dog + images_per_dog)})
+
+    if config.storage_backend != "dynamodb":
+        store = create_item_store(config)
+        for item in items:
+            store.put(item)
+        return
+    with boto3.resource("dynamodb").Table(TABLE_NAME).batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+def load_event(name: str, user_id: str = EVENTS_USER_ID) -> dict:
+    with open(os.path.join(EVENTS_DIR, name)) as f:
+        raw = f.read()
+    return json.loads(raw.replace(EVENTS_USER_ID, user_id))
+
+
+def s3_event(name: str, key: str, size: int) -> dict:
+    event = load_event(name)
+    record = event["Records"][0]
+    record["s3"]["bucket"]["name"] = BUCKET_NAME
+    record["s3"]["object"]["key"] = key
+    record["s3"]["object"]["size"] = size
+    return event
+
+
+def api_event(method: str, resource: str, params: dict, body: Optional[dict] = None,
+              query: Optional[dict] = None) -> dict:
+    # An API Gateway event for any route, built on the sample GET /users/{user_id}/dogs event
+    path = resource.format(**params)
+    event = copy.deepcopy(load_event("200_get_dogs_ev.json"))
+    event.update(resource=resource, path=path, httpMethod=method, pathParameters=params or None,
+                 body=json.dumps(body) if body is not None else None, queryStringParameters=query)
+    event["requestContext"].update(resourcePath=resource, httpMethod=method, path=path, requestId=str(uuid.uuid4()))
+    return event
@@ -0,0 +1,161 @@
+"""
+GET /dogs batch lookups: duplicate user ids, the BATCH_MAX_USERS limit, the per user rate limit every
+entry is charged on, and the errors of single lookups run on the fanout pool.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+import pytest
+
+from botocore.exceptions import ClientError
+from dogs_common.db import DogsDbClient
+from dogs_common.fanout import Fanout
+from dogs_common.rate_limit import get_rate_limiter
+from dogs_common.resilience import CircuitOpenError
+from tests.unit.environment import LambdaContext, api_event, seed_account
+
+
+def batch_get(api, user_ids: list) -> dict:
+    event = api_event("GET", "/dogs", {}, query={"user_id": user_ids[-1]})
+    event["multiValueQueryStringParameters"] = {"user_id": user_ids}
+    return api.lambda_handler(event, LambdaContext())
+
+
+@pytest.fixture
+def users():
+    # Users with 1, 2 and 3 dogs
+    user_ids = [str(uuid.uuid4()) for _ in range(3)]
+    for dogs, user_id in enumerate(user_ids, start=1):
+        seed_account(user_id, dogs=dogs)
+    return user_ids
+
+
+def test_batch_get(api, users):
+    response = batch_get(api, [users[2], users[0], users[1]])
+
+    assert response["statusCode"] == 200
+    entries = json.loads(response["body"])["users"]
+    assert [entry["user_id"] for entry in entries] == [users[2], users[0], users[1]]
+    assert [len(entry["dogs"]) for entry in entries] == [3, 1, 2]
+    assert [dog["dog_id"] for dog in entries[0]["dogs"]] == [1, 2, 3]
+
+
+def test_duplicate_users_are_looked_up_once(api, users, monkeypatch):
+    looked_up = []
+    lookup = DogsDbClient.batch_query_dogs_with_images
+    monkeypatch.setattr(DogsDbClient, "batch_query_dogs_with_images", lambda db, user_id: looked_up.append(user_id) or lookup(db, user_id))
+
+    response = batch_get(api, [users[1], users[0], users[1], users[0]])
+
+    entries = json.loads(response["body"])["users"]
+    assert [entry["user_id"] for entry in entries] == [users[1], users[0]]
+    assert sorted(looked_up) == sorted(users[:2])
+
+
+def test_too_many_users(api, users):
+    api.dogs_service = api.DogsService(api.app_config.model_copy(update={"batch_max_users": 2}))
+
+    response = batch_get(api, users)
+
+    assert response["statusCode"] == 400
+    assert json.loads(response["body"])["message"] == "Too many users: 3/2"
+    # Duplicates don't count
+    assert batch_get(api, users[:2] + users[:2])["statusCode"] == 200
+
+
+def test_users_are_charged_on_their_bucket(service_handlers, store_config, monkeypatch):
+    config = store_config.model_copy(update={"rate_limits": json.dumps({
+        service_handlers.USER_DOGS_ROUTE: {"rate": 1, "burst": 2}}), "rate_limit_lease_size": 1})
+    service = service_handlers.DogsService(config)
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+    # The second user spent their tokens on the single user route
+    limiter = get_rate_limiter(config)
+    limiter.acquire(second, service_handlers.USER_DOGS_ROUTE)
+    limiter.acquire(second, service_handlers.USER_DOGS_ROUTE)
+    looked_up = []
+    lookup = DogsDbClient.batch_query_dogs_with_images
+    monkeypatch.setattr(DogsDbClient, "batch_query_dogs_with_images", lambda db, user_id: looked_up.append(user_id) or lookup(db, user_id))
+
+    entries = service.handle_users_dogs_batch_get([first, second]).serialize_model()["users"]
+
+    assert entries[0] == {"user_id": first, "dogs": []}
+    assert entries[1] == {"user_id": second, "error": {"status": 429, "message": "Too many requests, retry later", "retry_after": 1}}
+    # Limited users are not looked up
+    assert looked_up == [first]
+
+    # The batch spent a token of the first user, the next one spends the last
+    assert "dogs" in service.handle_users_dogs_batch_get([first]).serialize_model()["users"][0]
+    assert service.handle_users_dogs_batch_get([first]).serialize_model()["users"][0]["error"]["status"] == 429
+    assert limiter.acquire(first, service_handlers.USER_DOGS_ROUTE) > 0
+
+
+def test_failed_lookups(api, users, monkeypatch):
+    errors = {
+        users[0]: CircuitOpenError("DynamoDB", 2.5),
+        users[1]: ClientError({"Error": {"Code": "InternalServerError", "Message": "unavailable"}}, "Query"),
+        users[2]: KeyError("dog"),
+    }
+    healthy = str(uuid.uuid4())
+    lookup = DogsDbClient.batch_query_dogs_with_images
+
+    def failing_lookup(db, user_id):
+        if user_id in errors:
+            raise errors[user_id]
+        return lookup(db, user_id)
+
+    monkeypatch.setattr(DogsDbClient, "batch_query_dogs_with_images", failing_lookup)
+
+    response = batch_get(api, users + [healthy])
+
+    # Each user gets the status of the single user route, the others still get their dogs
+    assert response["statusCode"] == 200
+    entries = json.loads(response["body"])["users"]
+    assert entries[0]["error"] == {"status": 503, "message": "DynamoDB is unavailable, retry after 3s", "retry_after": 3}
+    assert entries[1]["error"]["status"] == 503
+    assert "retry_after" not in entries[1]["error"]
+    assert entries[2]["error"] == {"status": 500, "message": "An unexpected error occurred"}
+    assert entries[3] == {"user_id": healthy, "dogs": []}
+
+
+def test_fanout_returns_results_and_errors_in_order(store_config):
+    fanout = Fanout(store_config.model_copy(update={"batch_max_concurrency": 3}))
+
+    def lookup(db, key):
+        # Later keys finish first
+        time.sleep(0.01 * (5 - key))
+        if key % 2:
+            raise ValueError(key)
+        return key * 10
+
+    results = fanout.map(lookup, list(range(5)))
+
+    assert results[0::2] == [0, 20, 40]
+    assert [type(result) for result in results[1::2]] == [ValueError, ValueError]
+    assert [result.args for result in results[1::2]] == [(1,), (3,)]
+
+
+def test_fanout_is_bounded(store_config):
+    fanout = Fanout(store_config.model_copy(update={"batch_max_concurrency": 3}))
+    lock = threading.Lock()
+    in_flight, max_in_flight, clients = [0], [0], {}
+
+    def lookup(db, key):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            clients.setdefault(threading.get_ident(), set()).add(id(db))
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return key
+
+    assert fanout.map(lookup, list(range(12))) == list(range(12))
+
+    assert max_in_flight[0] == 3
+    # Each thread keeps its own client
+    assert len(clients) == 3
+    assert all(len(ids) == 1 for ids in clients.values())
+    assert len(set.union(*clients.values())) == 3
@@ -0,0 +1,180 @@
+"""
+DELETE /users/{user_id}/dogs/{dog_id}: the synchronous cascade, the background task of large galleries
+and the objects S3 fails to delete.
+"""
+
+import json
+import uuid
+
+import boto3
+import pytest
+
+from dogs_common.models import (CreateDogRequestPayload, CreateMultipartImageRequestPayload, DeleteDogTask,
+                                DogDeletionStatus, ImageStatus, UpdateImageRequestPayload)
+from dogs_common.tasks import ImagesNotDeleted
+from tests.unit.environment import BUCKET_NAME, LambdaContext, api_event
+
+DOG_ROUTE = "/users/{user_id}/dogs/{dog_id}"
+
+
+@pytest.fixture
+def user_id():
+    return str(uuid.uuid4())
+
+
+@pytest.fixture
+def service(service_handlers, store_config):
+    return service_handlers.DogsService(store_config)
+
+
+def add_image(service, user_id: str, dog_id: int) -> str:
+    # An uploaded image, row and object
+    image_id = service.db.create_image_id(user_id)
+    s3_key = f"users/{user_id}/dogs/{dog_id}/images/{image_id}.jpg"
+    service.db.create_image(user_id, dog_id, image_id)
+    boto3.client("s3").put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=b"image")
+    service.db.update_image(user_id, dog_id, image_id, UpdateImageRequestPayload(
+        s3_key=s3_key, status=ImageStatus.UPLOADED, clear_ttl=True))
+    return s3_key
+
+
+def image_sks(service, user_id: str, dog_id: int) -> list:
+    return [image.SK for images in service.db.iter_image_pages_by_dog(user_id, dog_id) for image in images]
+
+
+def object_keys() -> list:
+    return [obj["Key"] for obj in boto3.client("s3").list_objects_v2(Bucket=BUCKET_NAME).get("Contents", [])]
+
+
+def test_delete_dog_with_images(service, user_id):
+    dog = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="rex", age=3))
+    other = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="max", age=2))
+    for _ in range(3):
+        add_image(service, user_id, dog.dog_id)
+    kept = add_image(service, user_id, other.dog_id)
+
+    deleted = service.handle_user_dog_delete(user_id, dog.dog_id)
+
+    assert (deleted.status, deleted.images_count) == (DogDeletionStatus.DELETED, 3)
+    with pytest.raises(ValueError):
+        service.db.get_dog(user_id, dog.dog_id)
+    assert image_sks(service, user_id, dog.dog_id) == []
+    assert object_keys() == [kept]
+
+
+def test_missing_dog_fails_before_images_are_deleted(service, user_id):
+    s3_key = add_image(service, user_id, 7)
+
+    with pytest.raises(ValueError, match="not found"):
+        service.handle_user_dog_delete(user_id, 7)
+
+    assert len(image_sks(service, user_id, 7)) == 1
+    assert object_keys() == [s3_key]
+
+
+def test_image_created_during_delete_is_removed(service, user_id, monkeypatch):
+    dog = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="rex", age=3))
+    add_image(service, user_id, dog.dog_id)
+    delete_dog = service.db.delete_dog
+
+    def upload_then_delete_dog(*args):
+        # An upload that lands after the images were cleaned up, before the dog is gone
+        add_image(service, user_id, dog.dog_id)
+        delete_dog(*args)
+
+    monkeypatch.setattr(service.db, "delete_dog", upload_then_delete_dog)
+    deleted = service.handle_user_dog_delete(user_id, dog.dog_id)
+
+    assert deleted.images_count == 2
+    assert image_sks(service, user_id, dog.dog_id) == []
+    assert object_keys() == []
+
+
+def test_pending_multipart_uploads_are_aborted(service, user_id):
+    dog = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="rex", age=3))
+    service.handle_create_multipart_image(user_id, dog.dog_id, CreateMultipartImageRequestPayload(
+        image_extension="jpg", size=6 * 1024 * 1024))
+    assert len(boto3.client("s3").list_multipart_uploads(Bucket=BUCKET_NAME).get("Uploads", [])) == 1
+
+    deleted = service.handle_user_dog_delete(user_id, dog.dog_id)
+
+    assert deleted.images_count == 1
+    assert boto3.client("s3").list_multipart_uploads(Bucket=BUCKET_NAME).get("Uploads", []) == []
+    assert image_sks(service, user_id, dog.dog_id) == []
+
+
+def test_objects_not_deleted_keep_the_dog(service, user_id, monkeypatch):
+    dog = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="rex", age=3))
+    failed = add_image(service, user_id, dog.dog_id)
+    add_image(service, user_id, dog.dog_id)
+    monkeypatch.setattr(service.s3, "delete_objects", lambda s3_keys: [{"Key": failed, "Code": "InternalError"}])
+
+    with pytest.raises(ImagesNotDeleted) as error:
+        service.handle_user_dog_delete(user_id, dog.dog_id)
+
+    assert error.value.s3_keys == [failed]
+    assert service.db.get_dog(user_id, dog.dog_id).name == "rex"
+    assert [image.s3_key for images in service.db.iter_image_pages_by_dog(user_id, dog.dog_id) for image in images] == [failed]
+
+    # Deleting the dog again retries the object left
+    monkeypatch.undo()
+    assert service.handle_user_dog_delete(user_id, dog.dog_id).images_count == 1
+
+
+def test_large_gallery_is_deleted_in_background(service_handlers, processor_handlers, store_config, user_id, monkeypatch):
+    config = store_config.model_copy(update={"background_tasks_function_name": "dogs-tasks",
+                                             "dog_delete_sync_max_images": 2})
+    service = service_handlers.DogsService(config)
+    submitted = []
+    monkeypatch.setattr(service.tasks, "submit", submitted.append)
+    dog = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="rex", age=3))
+    for _ in range(4):
+        add_image(service, user_id, dog.dog_id)
+
+    deleted = service.handle_user_dog_delete(user_id, dog.dog_id)
+
+    # The dog is gone right away, its images only once the task ran
+    assert (deleted.status, deleted.images_count) == (DogDeletionStatus.DELETING, 3)
+    assert submitted == [DeleteDogTask(user_id=user_id, dog_id=dog.dog_id)]
+    with pytest.raises(ValueError):
+        service.db.get_dog(user_id, dog.dog_id)
+    assert len(image_sks(service, user_id, dog.dog_id)) == 4
+
+    result = processor_handlers.DogsImageProcessor(config).process_delete_dog_task(submitted[0])
+
+    assert result["images_count"] == 4
+    assert image_sks(service, user_id, dog.dog_id) == []
+    assert object_keys() == []
+
+
+def test_large_gallery_of_missing_dog_submits_nothing(service_handlers, store_config, user_id, monkeypatch):
+    config = store_config.model_copy(update={"background_tasks_function_name": "dogs-tasks",
+                                             "dog_delete_sync_max_images": 1})
+    service = service_handlers.DogsService(config)
+    submitted = []
+    monkeypatch.setattr(service.tasks, "submit", submitted.append)
+    for _ in range(2):
+        add_image(service, user_id, 7)
+
+    with pytest.raises(ValueError, match="not found"):
+        service.handle_user_dog_delete(user_id, 7)
+    assert submitted == []
+
+
+def test_objects_not_deleted_answer_503(api, monkeypatch):
+    user_id = str(uuid.uuid4())
+    service = api.get_dogs_service()
+    dog = service.handle_user_dogs_post(user_id, CreateDogRequestPayload(name="rex", age=3))
+    failed = add_image(service, user_id, dog.dog_id)
+    monkeypatch.setattr(service.s3, "delete_objects", lambda s3_keys: [{"Key": failed, "Code": "InternalError"}])
+    event = api_event("DELETE", DOG_ROUTE, {"user_id": user_id, "dog_id": str(dog.dog_id)})
+
+    response = api.lambda_handler(event, LambdaContext())
+
+    assert response["statusCode"] == 503
+    assert "retry the request" in json.loads(response["body"])["message"]
+
+    monkeypatch.undo()
+    response = api.lambda_handler(event, LambdaContext())
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"]) == {"dog_id": dog.dog_id, "status": "deleted", "images_count": 1}
@@ -0,0 +1,168 @@
+"""
+GET /users/{user_id}/dogs/export through the API Lambda on moto: dogs merged with their images as
+NDJSON, the 413 of exports over a Lambda response, and the chunked response of server mode.
+"""
+
+import io
+import json
+import time
+import types
+import uuid
+
+import boto3
+import pytest
+
+from dogs_common.keys import legacy_image_sk
+from tests.unit.environment import TABLE_NAME, LambdaContext, api_event, seed_account
+
+RESOURCE = "/users/{user_id}/dogs/export"
+
+
+@pytest.fixture
+def user_id():
+    return str(uuid.uuid4())
+
+
+@pytest.fixture
+def service(api):
+    # Small pages, the merge crosses page boundaries of both the dogs and the images
+    api.dogs_service = api.DogsService(api.app_config.model_copy(update={"export_page_size": 2}))
+    return api.dogs_service
+
+
+@pytest.fixture
+def account(user_id):
+    # 7 dogs with 2 images each, dog 3 deleted but not its images, and a legacy image row of dog 5
+    seed_account(user_id, dogs=7, images_per_dog=2)
+    table = boto3.resource("dynamodb").Table(TABLE_NAME)
+    pk = f"USER#{user_id}"
+    table.delete_item(Key={"PK": pk, "SK": "DOG#3"})
+    table.put_item(Item={"PK": pk, "SK": legacy_image_sk(5, 1), "status": "uploaded", "s3_key": "legacy.jpg", "version": 1,
+                         "created_at": "2025-01-01T00:00:00+00:00", "updated_at": "2025-01-01T00:00:00+00:00"})
+    return user_id
+
+
+def export(api, user_id: str, context=None) -> dict:
+    return api.lambda_handler(api_event("GET", RESOURCE, {"user_id": user_id}), context or LambdaContext())
+
+
+def image_ids(dog: dict) -> list:
+    return sorted(int(image["image_id"]) for image in dog["images"])
+
+
+def test_export(api, service, account):
+    response = export(api, account)
+
+    assert response["statusCode"] == 200
+    assert response["multiValueHeaders"]["Content-Type"] == ["application/x-ndjson"]
+    assert response["body"].endswith("\n")
+    dogs = [json.loads(line) for line in response["body"].splitlines()]
+    assert [dog["dog_id"] for dog in dogs] == [1, 2, 4, 5, 6, 7]
+    # Images of seed_account have the ids 2 * dog_id + 1 and 2 * dog_id + 2
+    for dog in dogs:
+        expected = [2 * dog["dog_id"] + 1, 2 * dog["dog_id"] + 2] + ([1] if dog["dog_id"] == 5 else [])
+        assert image_ids(dog) == sorted(expected)
+    assert dogs[0]["name"] == "dog-1"
+
+
+def test_export_of_user_without_dogs(api, service, user_id):
+    response = export(api, user_id)
+
+    assert response["statusCode"] == 200
+    assert response["body"] == ""
+
+
+def test_export_over_lambda_response(api, service, account, monkeypatch):
+    reads = []
+    batch_get_dogs = service.db.batch_get_dogs
+    monkeypatch.setattr(service.db, "batch_get_dogs", lambda user_id, dog_ids: reads.append(dog_ids) or batch_get_dogs(user_id, dog_ids))
+    # Room for about two lines
+    line_size = len(json.dumps(next(service.handle_user_dogs_export(account)))) - 2
+    monkeypatch.setattr(api, "LAMBDA_EXPORT_MAX_BYTES", 2 * line_size + 10)
+    reads.clear()
+
+    response = export(api, account)
+
+    assert response["statusCode"] == 413
+    assert "export it from server mode" in json.loads(response["body"])["message"]
+    # Reading stopped at the line over the limit, the last pages of dogs were never read
+    assert reads == [[1, 2], [3, 4]]
+
+
+class StreamHandler:
+    # What ChunkedResponseStream uses of the request handler of the server
+    def __init__(self):
+        self.wfile = io.BytesIO()
+        self.server = types.SimpleNamespace(shutting_down=False)
+        self.status = None
+        self.headers = {}
+
+    def send_response(self, status: int):
+        self.status = status
+
+    def send_header(self, key: str, value: str):
+        self.headers[key] = value
+
+    def end_headers(self):
+        pass
+
+
+def read_chunks(data: bytes) -> list:
+    chunks = []
+    while True:
+        size_line, data = data.split(b"\r\n", 1)
+        size = int(size_line, 16)
+        if size == 0:
+            assert data == b"\r\n"
+            return chunks
+        chunks.append(data[:size])
+        assert data[size:size + 2] == b"\r\n"
+        data = data[size + 2:]
+
+
+@pytest.fixture
+def stream(server_module, monkeypatch):
+    # Chunks of at least 500 bytes, a few lines each
+    monkeypatch.setattr(server_module.ChunkedResponseStream, "chunk_size", 500)
+    return server_module.ChunkedResponseStream(StreamHandler())
+
+
+def server_context(server_module, stream):
+    return server_module.ServerContext(str(uuid.uuid4()), time.monotonic() + 30, stream)
+
+
+def test_chunked_export(api, service, account, server_module, stream):
+    response = export(api, account, server_context(server_module, stream))
+
+    # The response was sent through the stream, the one returned is not written
+    assert response["statusCode"] == 200
+    assert response["body"] == ""
+    assert stream.completed
+    assert stream.handler.status == 200
+    assert stream.handler.headers == {"Content-Type": "application/x-ndjson", "Transfer-Encoding": "chunked"}
+    chunks = read_chunks(stream.handler.wfile.getvalue())
+    assert len(chunks) > 1
+    # Chunks end with a complete line
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+    assert export(api, account)["body"].encode("utf-8") == b"".join(chunks)
+
+
+def test_chunked_export_fails_midway(api, service, account, server_module, stream, monkeypatch):
+    batch_get_dogs = service.db.batch_get_dogs
+
+    def failing_batch_get_dogs(user_id, dog_ids):
+        if dog_ids[0] > 4:
+            raise ConnectionError("table unavailable")
+        return batch_get_dogs(user_id, dog_ids)
+
+    monkeypatch.setattr(service.db, "batch_get_dogs", failing_batch_get_dogs)
+
+    export(api, account, server_context(server_module, stream))
+
+    # The status was already sent, the response is cut short without its last chunk
+    assert stream.started
+    assert not stream.completed
+    data = stream.handler.wfile.getvalue()
+    assert not data.endswith(b"0\r\n\r\n")
+    with pytest.raises(ValueError):
+        read_chunks(data)
@@ -0,0 +1,240 @@
+"""
+Deduplication of uploads by the image processor: exact and near duplicates linked through the band
+index of perceptual hashes, originals deleted while a duplicate links to them, and hash references
+released by tasks.delete_images.
+"""
+
+import importlib.util
+import io
+import os
+import random
+import uuid
+
+import boto3
+import pytest
+
+from PIL import Image
+from aws_lambda_powertools.utilities.data_classes import S3Event
+from dogs_common.keys import image_sk, phash_band_sks
+from dogs_common.tasks import delete_images
+from tests.unit.environment import BUCKET_NAME, SERVICE_ROOT, TABLE_NAME, s3_event
+
+DOG_ID = 1
+
+
+def jpeg(seed: int, quality: int = 90) -> bytes:
+    # Random 9x8 grid scaled up: a difference hash with as many 1 as 0 bits. Another quality gives
+    # other bytes with the same difference hash
+    rnd = random.Random(seed)
+    grid = Image.new("L", (9, 8))
+    grid.putdata([rnd.randrange(256) for _ in range(72)])
+    buffer = io.BytesIO()
+    grid.resize((90, 80), Image.BILINEAR).convert("RGB").save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def flip_bits(phash: str, bits) -> str:
+    value = int(phash, 16)
+    for bit in bits:
+        value ^= 1 << bit
+    return f"{value:016x}"
+
+
+@pytest.fixture
+def user_id():
+    return str(uuid.uuid4())
+
+
+@pytest.fixture
+def processor(processor_handlers, store_config):
+    return processor_handlers.DogsImageProcessor(store_config)
+
+
+@pytest.fixture
+def upload(processor, user_id):
+    # Creates the image row, puts the object and processes its S3 event, returns the image row
+    def upload(body: bytes):
+        image_id = processor.db.create_image_id(user_id)
+        processor.db.create_image(user_id, DOG_ID, image_id)
+        key = f"users/{user_id}/dogs/{DOG_ID}/images/{image_id}.jpg"
+        boto3.client("s3").put_object(Bucket=BUCKET_NAME, Key=key, Body=body)
+        record = next(iter(S3Event(s3_event("s3_put_image_ev.json", key, len(body))).records))
+        processor.process_record(record)
+        return processor.db.get_image(user_id, DOG_ID, image_id)
+    return upload
+
+
+def object_keys() -> list:
+    return [obj["Key"] for obj in boto3.client("s3").list_objects_v2(Bucket=BUCKET_NAME).get("Contents", [])]
+
+
+def test_exact_duplicate(processor, upload, user_id):
+    original = upload(jpeg(1))
+    duplicate = upload(jpeg(1))
+
+    assert duplicate.duplicate_of == original.SK
+    assert duplicate.s3_key == original.s3_key
+    assert object_keys() == [original.s3_key]
+    image_hash = processor.db.get_image_hash(user_id, original.content_hash)
+    assert image_hash.image_sks == sorted([original.SK, duplicate.SK])
+
+
+def test_near_duplicate(processor, upload, user_id):
+    original = upload(jpeg(1))
+    duplicate = upload(jpeg(1, quality=50))
+
+    # Other bytes, same picture
+    assert duplicate.phash == original.phash
+    assert duplicate.duplicate_of == original.SK
+    assert duplicate.s3_key == original.s3_key
+    assert object_keys() == [original.s3_key]
+    assert processor.db.get_image_hash(user_id, original.content_hash).image_sks == sorted([original.SK, duplicate.SK])
+
+
+def test_distinct_images(processor, upload, user_id):
+    first = upload(jpeg(1))
+    second = upload(jpeg(2))
+
+    assert second.duplicate_of is None
+    assert second.content_hash != first.content_hash
+    assert sorted(object_keys()) == sorted([first.s3_key, second.s3_key])
+    # Each hash has its band items
+    store = processor.db._store
+    for image in (first, second):
+        for sk in phash_band_sks(image.phash, image.content_hash):
+            assert store.get({"PK": image.PK, "SK": sk})["content_hash"] == image.content_hash
+
+
+@pytest.mark.parametrize("bits, linked", [
+    ([0, 17, 63], True),
+    # Four bands differ, four are shared
+    ([0, 9, 18, 27], True),
+    ([0, 9, 18, 27, 36], False),
+])
+def test_near_duplicate_distance(processor, upload, user_id, bits, linked):
+    # The perceptual hash of the picture, the image is then deleted
+    first = upload(jpeg(1))
+    delete_images(processor.db, processor.s3, [first])
+    phash = first.phash
+    # A registered image whose perceptual hash is len(bits) bits away from the upload
+    boto3.client("s3").put_object(Bucket=BUCKET_NAME, Key="original.jpg", Body=b"original")
+    processor.db.create_image_hash(user_id, "f" * 64, flip_bits(phash, bits), "original.jpg", image_sk(DOG_ID, 999))
+
+    duplicate = upload(jpeg(1, quality=50))
+
+    assert (duplicate.s3_key == "original.jpg") is linked
+
+
+def test_lookup_reads_band_items_only(processor, user_id, monkeypatch):
+    phash = "0b4b5a34b41a96d3"
+    # Hashes sharing only band 0 (the first two digits), band 1... band 7, and one sharing no band
+    for band in range(8):
+        processor.db.create_image_hash(user_id, f"{band:064x}", flip_bits(phash, [b for b in range(64) if b // 8 != 7 - band]),
+                                       f"{band}.jpg", image_sk(DOG_ID, band))
+    processor.db.create_image_hash(user_id, "e" * 64, flip_bits(phash, range(64)), "far.jpg", image_sk(DOG_ID, 50))
+    # More hashes in band 0 than read per band
+    for i in range(5):
+        processor.db.create_image_hash(user_id, f"{100 + i:064x}", flip_bits(phash, range(56)),
+                                       f"band0-{i}.jpg", image_sk(DOG_ID, 100 + i))
+    queried = []
+    query = processor.db._store.query
+
+    def recording_query(pk, sk_prefix, **kwargs):
+        queried.append(sk_prefix)
+        return query(pk, sk_prefix, **kwargs)
+
+    monkeypatch.setattr(processor.db._store, "query", recording_query)
+    candidates = processor.db.query_similar_image_hashes(user_id, phash, limit=3)
+
+    assert queried == [f"PHASH#{band}#{phash[band * 2:band * 2 + 2]}#" for band in range(8)]
+    # 3 of the 6 hashes of band 0, and the hash of each other band
+    assert set(candidates) == {f"{band:064x}" for band in range(8)} | {f"{100 + i:064x}" for i in range(2)}
+
+
+def test_original_deleted_before_link(processor, upload, user_id, monkeypatch):
+    original = upload(jpeg(1))
+    add_image_hash_ref = processor.db.add_image_hash_ref
+
+    def delete_original_then_link(*args):
+        # The original is deleted after the lookup found it, before the reference is added
+        delete_images(processor.db, processor.s3, [original])
+        return add_image_hash_ref(*args)
+
+    monkeypatch.setattr(processor.db, "add_image_hash_ref", delete_original_then_link)
+    duplicate = upload(jpeg(1))
+
+    # The duplicate keeps its own object, without a hash to share it
+    assert duplicate.duplicate_of is None
+    assert duplicate.content_hash is None
+    assert object_keys() == [duplicate.s3_key]
+    assert processor.db.get_image_hash(user_id, original.content_hash) is None
+
+
+def test_band_item_of_deleted_hash_is_skipped(processor, upload, user_id):
+    original = upload(jpeg(1))
+    # A hash deleted without its band items, as while delete_image_hash runs
+    processor.db._store.delete({"PK": original.PK, "SK": f"HASH#{original.content_hash}"})
+
+    duplicate = upload(jpeg(1, quality=50))
+
+    assert duplicate.duplicate_of is None
+    assert duplicate.s3_key != original.s3_key
+
+
+def test_release_hash_references(processor, upload, user_id):
+    original = upload(jpeg(1))
+    duplicate = upload(jpeg(1, quality=50))
+    band_keys = [{"PK": original.PK, "SK": sk} for sk in phash_band_sks(original.phash, original.content_hash)]
+
+    # The original goes first, the object stays for the duplicate
+    delete_images(processor.db, processor.s3, [original])
+    assert processor.db.get_image_hash(user_id, original.content_hash).image_sks == [duplicate.SK]
+    assert object_keys() == [original.s3_key]
+
+    # The last reference deletes the hash, its band items and the object
+    delete_images(processor.db, processor.s3, [duplicate])
+    assert processor.db.get_image_hash(user_id, original.content_hash) is None
+    assert processor.db._store.batch_get(band_keys) == []
+    assert object_keys() == []
+
+
+def test_release_retries_concurrent_changes(processor, upload, user_id, monkeypatch):
+    original = upload(jpeg(1))
+    late = image_sk(DOG_ID, 999)
+    delete_image_hash = processor.db.delete_image_hash
+
+    def link_then_delete(image_hash):
+        # A duplicate links to the hash after it was read, the version check fails and the hash is read again
+        monkeypatch.setattr(processor.db, "delete_image_hash", delete_image_hash)
+        processor.db.add_image_hash_ref(user_id, original.content_hash, late)
+        return delete_image_hash(image_hash)
+
+    monkeypatch.setattr(processor.db, "delete_image_hash", link_then_delete)
+    delete_images(processor.db, processor.s3, [original])
+
+    # The hash now only references the late duplicate and keeps the object
+    assert processor.db.get_image_hash(user_id, original.content_hash).image_sks == [late]
+    assert object_keys() == [original.s3_key]
+
+
+def test_index_script(aws):
+    path = os.path.join(SERVICE_ROOT, "scripts", "index_image_phashes.py")
+    spec = importlib.util.spec_from_file_location("index_image_phashes", path)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    table = boto3.resource("dynamodb").Table(TABLE_NAME)
+    # Hashes registered before the band items, one of them without a perceptual hash
+    table.put_item(Item={"PK": "USER#a", "SK": "HASH#" + "a" * 64, "content_hash": "a" * 64, "phash": "0b4b5a34b41a96d3",
+                         "s3_key": "a.jpg", "image_sk": image_sk(DOG_ID, 1), "image_sks": {image_sk(DOG_ID, 1)}})
+    table.put_item(Item={"PK": "USER#b", "SK": "HASH#" + "b" * 64, "content_hash": "b" * 64,
+                         "s3_key": "b.jpg", "image_sk": image_sk(DOG_ID, 2), "image_sks": {image_sk(DOG_ID, 2)}})
+
+    assert sum(script.index_segment(table, segment, 3, dry_run=True) for segment in range(3)) == 1
+    assert len(table.scan()["Items"]) == 2
+    assert sum(script.index_segment(table, segment, 3, dry_run=False) for segment in range(3)) == 1
+    # Re-running rewrites the same items
+    assert script.index_segment(table, 0, 1, dry_run=False) == 1
+
+    band_items = [item for item in table.scan()["Items"] if item["SK"].startswith("PHASH#")]
+    assert sorted(item["SK"] for item in band_items) == sorted(phash_band_sks("0b4b5a34b41a96d3", "a" * 64))
+    assert all(item["PK"] == "USER#a" and item["content_hash"] == "a" * 64 for item in band_items)
@@ -0,0 +1,139 @@
+"""
+Galleries with both legacy (IMAGE#<dog_id>#<image_id>) and zero padded image rows, paged with small
+limits, and scripts/migrate_image_sort_keys.py that rewrites the legacy rows.
+"""
+
+import importlib.util
+import os
+import sys
+
+import boto3
+import pytest
+
+from dogs_common.keys import image_sk, legacy_image_sk
+from tests.unit.environment import SERVICE_ROOT, TABLE_NAME
+
+USER_ID = "53bea77a-f2bd-42a0-a445-6c7477fce1c9"
+PK = f"USER#{USER_ID}"
+DOG_ID = 1
+# Image ids of the dog, rows written before the padding have the lower ids
+LEGACY_IDS = [1, 2, 9, 10, 11]
+PADDED_IDS = [12, 13, 20, 100, 101, 102]
+
+
+def image_item(sk: str) -> dict:
+    return {"PK": PK, "SK": sk, "status": "uploaded", "s3_key": f"users/{USER_ID}/{sk}.jpg", "version": 1,
+            "created_at": "2025-01-01T00:00:00+00:00", "updated_at": "2025-01-01T00:00:00+00:00"}
+
+
+def seed_gallery(put):
+    for image_id in LEGACY_IDS:
+        put(image_item(legacy_image_sk(DOG_ID, image_id)))
+    for image_id in PADDED_IDS:
+        put(image_item(image_sk(DOG_ID, image_id)))
+    # Dogs whose keys share a prefix with dog 1 in either format
+    put(image_item(legacy_image_sk(10, 3)))
+    put(image_item(legacy_image_sk(11, 4)))
+    put(image_item(image_sk(10, 5)))
+    put({"PK": PK, "SK": f"DOG#{DOG_ID}", "name": "rex", "age": 3, "version": 1})
+
+
+@pytest.fixture
+def service(service_handlers, store_config):
+    return service_handlers.DogsService(store_config)
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 5, 6, 7, 11, 12])
+def test_pages_of_mixed_gallery(service, limit):
+    seed_gallery(service.db._store.put)
+
+    image_ids, page_sizes, next_token = [], [], None
+    while True:
+        page = service.handle_dog_images_get(USER_ID, DOG_ID, limit, next_token)
+        image_ids.extend(int(image.image_id) for image in page.images)
+        page_sizes.append(len(page.images))
+        next_token = page.next_token
+        if next_token is None:
+            break
+
+    # Padded rows newest first, then the legacy rows, each image once
+    assert image_ids[:len(PADDED_IDS)] == sorted(PADDED_IDS, reverse=True)
+    assert sorted(image_ids[len(PADDED_IDS):]) == LEGACY_IDS
+    assert len(image_ids) == len(set(image_ids))
+    # Full pages, then what is left. Like DynamoDB, a gallery that ends right at the limit ends with an empty page
+    full_pages, rest = divmod(len(image_ids), limit)
+    assert page_sizes[:full_pages] == [limit] * full_pages
+    assert page_sizes[full_pages:] in ([[rest]] if rest else [[], [0]])
+
+
+def test_legacy_rows_are_skipped_once_migrated(service_handlers, store_config):
+    service = service_handlers.DogsService(store_config.model_copy(update={"image_sk_legacy_reads": False}))
+    seed_gallery(service.db._store.put)
+
+    page = service.handle_dog_images_get(USER_ID, DOG_ID, 20)
+
+    assert [int(image.image_id) for image in page.images] == sorted(PADDED_IDS, reverse=True)
+    assert page.next_token is None
+
+
+def test_page_token_of_another_gallery(service):
+    seed_gallery(service.db._store.put)
+
+    with pytest.raises(ValueError, match="Invalid pagination token"):
+        service.db.query_images_page_by_dog(USER_ID, 2, 2, {"PK": PK, "SK": image_sk(DOG_ID, 20)})
+    with pytest.raises(ValueError, match="Invalid pagination token"):
+        service.db.query_images_page_by_dog("someone-else", DOG_ID, 2, {"PK": PK, "SK": image_sk(DOG_ID, 20)})
+
+
+@pytest.fixture(scope="module")
+def migrate_script():
+    path = os.path.join(SERVICE_ROOT, "scripts", "migrate_image_sort_keys.py")
+    spec = importlib.util.spec_from_file_location("migrate_image_sort_keys", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def table(aws):
+    # The script only runs against DynamoDB
+    table = boto3.resource("dynamodb").Table(TABLE_NAME)
+    seed_gallery(lambda item: table.put_item(Item=item))
+    return table
+
+
+def table_sks(table) -> list:
+    return sorted(item["SK"] for item in table.scan()["Items"])
+
+
+def test_migrate_dry_run(migrate_script, table):
+    before = table_sks(table)
+
+    assert sum(migrate_script.migrate_segment(table, segment, 3, dry_run=True) for segment in range(3)) == 7
+    assert table_sks(table) == before
+
+
+def test_migrate(migrate_script, table):
+    legacy_item = table.get_item(Key={"PK": PK, "SK": legacy_image_sk(DOG_ID, 9)})["Item"]
+
+    assert sum(migrate_script.migrate_segment(table, segment, 3, dry_run=False) for segment in range(3)) == 7
+
+    expected = sorted([image_sk(DOG_ID, image_id) for image_id in LEGACY_IDS + PADDED_IDS]
+                      + [image_sk(10, 3), image_sk(11, 4), image_sk(10, 5), f"DOG#{DOG_ID}"])
+    assert table_sks(table) == expected
+    # Attributes are kept, only the key changes
+    migrated = table.get_item(Key={"PK": PK, "SK": image_sk(DOG_ID, 9)})["Item"]
+    assert migrated == {**legacy_item, "SK": image_sk(DOG_ID, 9)}
+
+    # Running it again finds nothing left
+    assert migrate_script.migrate_segment(table, 0, 1, dry_run=False) == 0
+    assert table_sks(table) == expected
+
+
+def test_migrate_main(migrate_script, table, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["migrate_image_sort_keys.py", "--table", TABLE_NAME, "--segments", "4"])
+
+    assert migrate_script.main() == 0
+
+    assert f"Migrated 7 image rows in table '{TABLE_NAME}'" in capsys.readouterr().out
+    assert not any(sk.startswith(("IMAGE#1#", "IMAGE#10#", "IMAGE#11#")) for sk in table_sks(table))
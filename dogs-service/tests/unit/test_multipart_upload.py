@@ -0,0 +1,118 @@
+"""
+Multipart uploads of large images on moto: finalizing checks the parts against the instructions,
+aborting discards the upload.
+"""
+
+import uuid
+
+import boto3
+import pytest
+
+from dogs_common.models import CreateMultipartImageRequestPayload, ImageStatus
+from tests.unit.environment import BUCKET_NAME
+
+PART_SIZE = 5 * 1024 * 1024
+# Three parts, the last one a single byte
+IMAGE_SIZE = 2 * PART_SIZE + 1
+
+
+@pytest.fixture
+def service(service_handlers, store_config):
+    return service_handlers.DogsService(store_config.model_copy(update={"image_multipart_part_size": PART_SIZE}))
+
+
+@pytest.fixture
+def user_id():
+    return str(uuid.uuid4())
+
+
+def start_upload(service, user_id: str, size: int = IMAGE_SIZE):
+    return service.handle_create_multipart_image(user_id, 1, CreateMultipartImageRequestPayload(
+        image_extension="jpg", size=size))
+
+
+def upload_parts(created, user_id: str, part_numbers):
+    # Same requests as the presigned part URLs, made with the client
+    s3 = boto3.client("s3")
+    key = f"users/{user_id}/dogs/1/images/{created.image.image_id}.jpg"
+    for part_number in part_numbers:
+        body = b"x" * (1 if part_number == 3 else PART_SIZE)
+        s3.upload_part(Bucket=BUCKET_NAME, Key=key, UploadId=created.upload_instructions.upload_id,
+                       PartNumber=part_number, Body=body)
+    return key
+
+
+def open_uploads() -> list:
+    return boto3.client("s3").list_multipart_uploads(Bucket=BUCKET_NAME).get("Uploads", [])
+
+
+def test_instructions(service, user_id):
+    created = start_upload(service, user_id)
+
+    instructions = created.upload_instructions
+    assert [part.part_number for part in instructions.parts] == [1, 2, 3]
+    assert instructions.part_size == PART_SIZE
+    assert created.image.status == ImageStatus.PENDING
+    assert len(open_uploads()) == 1
+
+
+def test_complete(service, user_id):
+    created = start_upload(service, user_id)
+    key = upload_parts(created, user_id, [1, 2, 3])
+
+    image = service.handle_complete_multipart_image(user_id, 1, int(created.image.image_id))
+
+    # Uploaded once the processor handles the CompleteMultipartUpload event
+    assert image.status == ImageStatus.PENDING
+    assert boto3.client("s3").head_object(Bucket=BUCKET_NAME, Key=key)["ContentLength"] == IMAGE_SIZE
+    assert open_uploads() == []
+
+
+def test_missing_parts(service, user_id):
+    created = start_upload(service, user_id)
+    image_id = int(created.image.image_id)
+
+    with pytest.raises(ValueError, match=r"missing parts: \[1, 2, 3\]"):
+        service.handle_complete_multipart_image(user_id, 1, image_id)
+
+    upload_parts(created, user_id, [1, 3])
+    with pytest.raises(ValueError, match=r"missing parts: \[2\]"):
+        service.handle_complete_multipart_image(user_id, 1, image_id)
+
+    # The upload stays open, the missing part can still be uploaded
+    assert len(open_uploads()) == 1
+    upload_parts(created, user_id, [2])
+    service.handle_complete_multipart_image(user_id, 1, image_id)
+    assert open_uploads() == []
+
+
+def test_extra_parts(service, user_id):
+    created = start_upload(service, user_id)
+    upload_parts(created, user_id, [1, 2, 3, 4])
+
+    with pytest.raises(ValueError, match=r"parts past its 3 parts: \[4\]"):
+        service.handle_complete_multipart_image(user_id, 1, int(created.image.image_id))
+    assert len(open_uploads()) == 1
+
+
+def test_abort(service, user_id):
+    created = start_upload(service, user_id)
+    image_id = int(created.image.image_id)
+    upload_parts(created, user_id, [1])
+
+    image = service.handle_abort_multipart_image(user_id, 1, image_id)
+
+    assert image.status == ImageStatus.DELETED
+    assert open_uploads() == []
+    assert service.db.get_image(user_id, 1, image_id).status_reason == "Multipart upload aborted"
+    # Neither can be done twice
+    with pytest.raises(ValueError, match="no multipart upload in progress"):
+        service.handle_complete_multipart_image(user_id, 1, image_id)
+    with pytest.raises(ValueError, match="no multipart upload in progress"):
+        service.handle_abort_multipart_image(user_id, 1, image_id)
+
+
+def test_too_large(service, user_id):
+    with pytest.raises(ValueError, match="Image size exceeds limit"):
+        start_upload(service, user_id, size=service.app_config.image_multipart_upload_max_size + 1)
+    assert open_uploads() == []
@@ -0,0 +1,195 @@
+"""
+Rate limiting on every storage backend: tokens leased from the shared bucket, version checked updates
+of containers sharing a bucket, the container's own bucket when the store fails, and the 429 of the API.
+"""
+
+import json
+import time
+import uuid
+
+import pytest
+
+from botocore.exceptions import ClientError
+from dogs_common import rate_limit
+from dogs_common.db import get_dogs_db_client
+from dogs_common.rate_limit import RateLimiter
+from dogs_common.storage import StorageError
+from tests.unit.environment import LambdaContext, api_event
+
+ROUTE = "POST /users/{user_id}/dogs"
+
+
+class Clock:
+    def __init__(self):
+        # From the current time, the local backends expire items by their expires_at
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def config(store_config):
+    # Burst of 10 refilled at 1 token/s, leased 3 at a time
+    return store_config.model_copy(update={
+        "rate_limits": json.dumps({"*": {"rate": 1, "burst": 10}}), "rate_limit_lease_size": 3, "rate_limit_lease_secs": 5.0})
+
+
+@pytest.fixture
+def db(config):
+    return get_dogs_db_client(config)
+
+
+@pytest.fixture
+def user_id():
+    return str(uuid.uuid4())
+
+
+def test_tokens_are_leased(clock, config, db, user_id):
+    limiter = RateLimiter(config)
+
+    assert limiter.acquire(user_id, ROUTE) == 0
+    shared = db.get_rate_limit_bucket(user_id, "*")
+    assert (shared.tokens, shared.version) == (7, 1)
+
+    # The rest of the lease is spent without touching the table
+    assert limiter.acquire(user_id, ROUTE) == 0
+    assert limiter.acquire(user_id, ROUTE) == 0
+    assert db.get_rate_limit_bucket(user_id, "*").version == 1
+
+    assert limiter.acquire(user_id, ROUTE) == 0
+    shared = db.get_rate_limit_bucket(user_id, "*")
+    assert (shared.tokens, shared.version) == (4, 2)
+
+
+def test_unused_lease_expires(clock, config, db, user_id):
+    limiter = RateLimiter(config)
+    limiter.acquire(user_id, ROUTE)
+
+    # 2 leased tokens are dropped, 5s refilled 5 of the 7 left
+    clock.now += 5
+    assert limiter.acquire(user_id, ROUTE) == 0
+    shared = db.get_rate_limit_bucket(user_id, "*")
+    assert (shared.tokens, shared.version) == (7, 2)
+
+
+def test_containers_share_the_burst(clock, config, db, user_id):
+    containers = [RateLimiter(config), RateLimiter(config)]
+
+    allowed = 0
+    for _ in range(10):
+        for limiter in containers:
+            if limiter.acquire(user_id, ROUTE) == 0:
+                allowed += 1
+
+    # Each container's own bucket would allow 10, the shared one allows 10 in all
+    assert allowed == 10
+    assert db.get_rate_limit_bucket(user_id, "*").tokens == 0
+    assert containers[0].acquire(user_id, ROUTE) == pytest.approx(1.0)
+
+
+def test_stale_bucket_is_read_again(clock, config, db, user_id, monkeypatch):
+    first, second = RateLimiter(config), RateLimiter(config)
+    first.acquire(user_id, ROUTE)
+    second.acquire(user_id, ROUTE)
+    versions = []
+    update = db.update_rate_limit_bucket
+
+    def recording_update(*args):
+        versions.append(args[-1])
+        return update(*args)
+
+    monkeypatch.setattr(db, "update_rate_limit_bucket", recording_update)
+    # The first container spent its lease, its last state of the bucket is from before the second one's update
+    first.acquire(user_id, ROUTE)
+    first.acquire(user_id, ROUTE)
+    assert first.acquire(user_id, ROUTE) == 0
+
+    assert versions == [1, 2]
+    shared = db.get_rate_limit_bucket(user_id, "*")
+    assert (shared.tokens, shared.version) == (1, 3)
+
+
+def test_concurrent_updates_give_up(clock, config, db, user_id, monkeypatch):
+    RateLimiter(config).acquire(user_id, ROUTE)
+    limiter = RateLimiter(config)
+    update = db.update_rate_limit_bucket
+    attempts = []
+
+    def conflicting_update(user_id, bucket, tokens, refilled_at, expires_at, version):
+        # Another container updates the bucket right before every attempt
+        attempts.append(version)
+        shared = db.get_rate_limit_bucket(user_id, bucket)
+        update(user_id, bucket, shared.tokens, refilled_at, expires_at, shared.version)
+        return update(user_id, bucket, tokens, refilled_at, expires_at, version)
+
+    monkeypatch.setattr(db, "update_rate_limit_bucket", conflicting_update)
+
+    # Limited after a few attempts, retried once a token is refilled
+    assert limiter.acquire(user_id, ROUTE) == pytest.approx(1.0)
+    assert len(attempts) == rate_limit._SHARED_BUCKET_ATTEMPTS
+
+
+def store_error(config) -> Exception:
+    if config.storage_backend == "dynamodb":
+        return ClientError({"Error": {"Code": "InternalServerError", "Message": "unavailable"}}, "GetItem")
+    return StorageError("database is locked")
+
+
+def test_store_failure_falls_back_to_local_bucket(clock, config, db, user_id, monkeypatch):
+    outage = [True]
+
+    def failing(call):
+        def wrapper(*args, **kwargs):
+            if outage[0]:
+                raise store_error(config)
+            return call(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(db._store, "get", failing(db._store.get))
+    monkeypatch.setattr(db._store, "update", failing(db._store.update))
+    limiter = RateLimiter(config)
+
+    # The container's own bucket still limits the user
+    assert [limiter.acquire(user_id, ROUTE) for _ in range(11)] == [0] * 10 + [pytest.approx(1.0)]
+
+    # Leases are taken again once the store is back
+    outage[0] = False
+    clock.now += 1
+    assert limiter.acquire(user_id, ROUTE) == 0
+    assert db.get_rate_limit_bucket(user_id, "*").tokens == 7
+
+
+def test_not_shared(clock, config, db, user_id):
+    limiter = RateLimiter(config.model_copy(update={"rate_limit_shared": False}))
+
+    assert [limiter.acquire(user_id, ROUTE) for _ in range(11)] == [0] * 10 + [pytest.approx(1.0)]
+    assert db.get_rate_limit_bucket(user_id, "*") is None
+
+
+def test_too_many_requests_response(clock, config, user_id):
+    @rate_limit.rate_limit(config, route_fn=lambda event: ROUTE, user_fn=lambda event: user_id,
+                           cors=rate_limit.CORSConfig(allow_origin="https://dogs.example.com"))
+    def handler(event, context):
+        return {"statusCode": 200}
+
+    event = api_event("POST", "/users/{user_id}/dogs", {"user_id": user_id}, body={"name": "rex", "age": 3})
+    event["headers"]["origin"] = "https://dogs.example.com"
+    for _ in range(10):
+        assert handler(event, LambdaContext()) == {"statusCode": 200}
+
+    response = handler(event, LambdaContext())
+    assert response["statusCode"] == 429
+    assert response["headers"]["Retry-After"] == "1"
+    assert response["headers"]["Access-Control-Allow-Origin"] == "https://dogs.example.com"
+
+    # Other origins get no CORS headers, as from the resolver
+    event["headers"]["origin"] = "https://elsewhere.example.com"
+    assert "Access-Control-Allow-Origin" not in handler(event, LambdaContext())["headers"]
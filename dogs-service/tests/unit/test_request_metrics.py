@@ -0,0 +1,75 @@
+"""
+Request metrics of instrumented clients: one EMF line per invocation whose size doesn't grow with the
+number of AWS calls.
+"""
+
+import boto3
+import pytest
+
+from dogs_common.aws import get_client
+from dogs_common.config import get_config
+from dogs_common.observability import metrics
+from dogs_common.request_metrics import flush_request_metrics, request_metrics
+from tests.unit.environment import TABLE_NAME
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    # EMF blobs of the flushed invocations, printing is disabled in the tests
+    blobs = []
+    monkeypatch.setattr(metrics, "flush_metrics", lambda: blobs.append(metrics.serialize_metric_set()))
+    request_metrics.reset()
+    yield blobs
+    request_metrics.reset()
+
+
+def metric_values(blob: dict) -> dict:
+    # Values of the metrics of the blob, each must be a single value
+    names = [metric["Name"] for metric in blob["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+    assert all(len(blob[name]) == 1 for name in names)
+    return {name: blob[name][0] for name in names}
+
+
+def test_latency_is_aggregated_per_invocation(emitted):
+    for latency_ms in (5.0, 20.0, 10.0):
+        request_metrics.record("DynamoDB", "GetItem", latency_ms, rcu=0.5, items=1)
+    request_metrics.record("DynamoDB", "Query", 15.0, error=True)
+
+    flush_request_metrics("GET /users/{user_id}/dogs", {"user_id": "u1"})
+
+    blob = emitted[0]
+    values = metric_values(blob)
+    assert values["DynamoDBCalls"] == 4
+    assert values["DynamoDBErrors"] == 1
+    assert values["DynamoDBLatency"] == 50.0
+    assert values["DynamoDBMaxLatency"] == 20.0
+    assert values["ConsumedRCU"] == 1.5
+    assert blob["route"] == "GET /users/{user_id}/dogs"
+    assert blob["DynamoDBOperations"] == {"GetItem": 3, "Query": 1}
+
+
+def test_many_calls_keep_one_value_per_metric(aws, emitted):
+    client = get_client(get_config(), "dynamodb")
+    for i in range(150):
+        client.get_item(TableName=TABLE_NAME, Key={"PK": {"S": "USER#u1"}, "SK": {"S": f"DOG#{i}"}})
+    boto3.client("s3")  # not instrumented, not counted
+
+    flush_request_metrics("GET /users/{user_id}/dogs")
+
+    # One value per metric, not one per call
+    values = metric_values(emitted[0])
+    assert values["DynamoDBCalls"] == 150
+    assert 0 < values["DynamoDBMaxLatency"] <= values["DynamoDBLatency"]
+    assert "S3Calls" not in values
+
+
+def test_server_timing(emitted):
+    request_metrics.record("DynamoDB", "GetItem", 2.5, rcu=0.5, items=1, payload_bytes=100)
+    request_metrics.record("DynamoDB", "GetItem", 1.0, rcu=0.5, items=0, payload_bytes=50)
+
+    assert request_metrics.server_timing() == 'DynamoDB;dur=3.5;desc="calls=2 rcu=1 wcu=0 items=1 bytes=150"'
+
+
+def test_nothing_recorded_flushes_nothing(emitted):
+    flush_request_metrics("GET /health")
+    assert emitted == []
@@ -0,0 +1,220 @@
+"""
+Circuit breakers (open, half open probe, backoff), load shedding of the API by route dependencies and
+concurrency limits, and the concurrency slots of a dead server worker.
+"""
+
+import json
+import os
+
+import pytest
+
+from aws_lambda_powertools.event_handler import CORSConfig
+from dogs_common import resilience
+from dogs_common.config import get_config
+from dogs_common.resilience import CircuitBreaker, CircuitOpenError, ConcurrencyLimiter, get_breaker, shed_load
+from tests.unit.environment import api_event
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    # No jitter, open times are exact
+    monkeypatch.setattr(resilience.random, "uniform", lambda a, b: 1.0)
+    return clock
+
+
+@pytest.fixture
+def breakers():
+    resilience._breakers.clear()
+    yield resilience._breakers
+    resilience._breakers.clear()
+
+
+@pytest.fixture
+def config():
+    return get_config().model_copy(update={
+        "circuit_window_size": 4, "circuit_min_calls": 4, "circuit_failure_ratio": 0.5, "shed_writes_failure_ratio": 0.25,
+        "circuit_open_secs": 1.0, "circuit_max_open_secs": 5.0, "shed_retry_after_secs": 7})
+
+
+def trip(breaker: CircuitBreaker):
+    for success in (True, True, False, False):
+        breaker.record(success)
+
+
+def test_opens_at_failure_ratio(clock, config):
+    breaker = CircuitBreaker("DynamoDB", config)
+    for success in (True, False, True):
+        breaker.record(success)
+    # Not enough calls yet to open
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.before_call() is False
+
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError, match="DynamoDB is unavailable, retry after 1s") as e:
+        breaker.before_call()
+    assert e.value.retry_after == pytest.approx(1.0)
+
+
+def test_half_open_probe(clock, config):
+    breaker = CircuitBreaker("DynamoDB", config)
+    trip(breaker)
+
+    clock.now += 1.0
+    assert breaker.before_call() is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # One probe at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record(True, probe=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.before_call() is False
+    assert not breaker.degraded
+
+
+def test_failed_probes_back_off(clock, config):
+    breaker = CircuitBreaker("DynamoDB", config)
+    trip(breaker)
+
+    # Open for 1s, then twice as long after every failed probe, up to circuit_max_open_secs
+    for open_secs in (2.0, 4.0, 5.0, 5.0):
+        clock.now += breaker.retry_after
+        assert breaker.before_call() is True
+        breaker.record(False, probe=True)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.retry_after == pytest.approx(open_secs)
+        clock.now += open_secs - 0.1
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        clock.now += 0.1
+
+    # A successful probe resets the backoff
+    assert breaker.before_call() is True
+    breaker.record(True, probe=True)
+    trip(breaker)
+    assert breaker.retry_after == pytest.approx(1.0)
+
+
+def test_lost_probe(clock, config):
+    breaker = CircuitBreaker("DynamoDB", config)
+    trip(breaker)
+    clock.now += 1.0
+    assert breaker.before_call() is True
+
+    # The probe never reported back, another one is let through after circuit_max_open_secs
+    clock.now += 4.9
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 0.1
+    assert breaker.before_call() is True
+
+
+def test_degraded_before_open(clock, config):
+    breaker = CircuitBreaker("DynamoDB", config)
+    for success in (True, True, True, False):
+        breaker.record(success)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.degraded
+    assert breaker.before_call() is False
+
+
+@pytest.fixture
+def handler(config):
+    # A handler behind shed_load, records the events it gets
+    calls = []
+    dependencies = {"POST /users/{user_id}/dogs": ["DynamoDB"], "DELETE /users/{user_id}/dogs/{dog_id}": ["DynamoDB", "S3"]}
+
+    @shed_load(config, dependencies=dependencies, cors=CORSConfig())
+    def handler(event, context):
+        calls.append(event)
+        return {"statusCode": 200}
+
+    handler.calls = calls
+    return handler
+
+
+POST_DOG = ("POST", "/users/{user_id}/dogs", {"user_id": "u1"})
+DELETE_DOG = ("DELETE", "/users/{user_id}/dogs/{dog_id}", {"user_id": "u1", "dog_id": "1"})
+GET_DOGS = ("GET", "/users/{user_id}/dogs", {"user_id": "u1"})
+# Not in the dependencies of the handler
+POST_IMAGE = ("POST", "/users/{user_id}/dogs/{dog_id}/images", {"user_id": "u1", "dog_id": "1"})
+
+
+@pytest.mark.parametrize("route, shed", [(POST_DOG, False), (DELETE_DOG, True), (GET_DOGS, False), (POST_IMAGE, True)])
+def test_writes_shed_by_dependency(clock, breakers, config, handler, route, shed):
+    trip(get_breaker("S3", config))
+    get_breaker("DynamoDB", config)
+
+    event = api_event(*route)
+    event["headers"]["Origin"] = "https://dogs.example.com"
+    response = handler(event, None)
+
+    if shed:
+        assert response["statusCode"] == 503
+        assert json.loads(response["body"]) == {"message": "S3 is degraded, retry after 1s"}
+        assert response["headers"]["Retry-After"] == "1"
+        assert response["headers"]["Access-Control-Allow-Origin"] == "*"
+        assert handler.calls == []
+    else:
+        assert response == {"statusCode": 200}
+
+
+def test_concurrency_limit_retry_after(breakers, config):
+    config = config.model_copy(update={"max_concurrent_writes": 1})
+    responses = []
+
+    @shed_load(config)
+    def handler(event, context):
+        if not responses:
+            # A second write while this one is in flight
+            responses.append(handler(event, context))
+        return {"statusCode": 200}
+
+    assert handler(api_event(*POST_DOG), None) == {"statusCode": 200}
+    assert responses[0]["statusCode"] == 503
+    assert responses[0]["headers"]["Retry-After"] == "7"
+    assert json.loads(responses[0]["body"]) == {"message": "write is at its concurrency limit, retry after 7s"}
+    # The slot was given back
+    assert handler(api_event(*POST_DOG), None) == {"statusCode": 200}
+
+
+def test_dead_worker_slots_are_given_back():
+    limiter = ConcurrencyLimiter({"write": 2, "POST /users/{user_id}/dogs": 1})
+    limiter.share(2)
+
+    # A worker takes both its slots and dies without releasing them
+    pid = os.fork()
+    if pid == 0:
+        limiter.bind(1)
+        os._exit(0 if limiter.try_acquire(["write", "POST /users/{user_id}/dogs"]) is None else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    limiter.bind(0)
+    assert limiter.try_acquire(["write", "POST /users/{user_id}/dogs"]) == "POST /users/{user_id}/dogs"
+    assert limiter.try_acquire(["write"]) is None
+    assert limiter.try_acquire(["write"]) == "write"
+    limiter.release(["write"])
+
+    # The server resets the row before starting the replacement, which counts in the same row
+    limiter.reset(1)
+    limiter.bind(1)
+    assert limiter.try_acquire(["write", "POST /users/{user_id}/dogs"]) is None
+    assert limiter.try_acquire(["write", "POST /users/{user_id}/dogs"]) == "POST /users/{user_id}/dogs"
+
+
+def test_app_write_routes_have_dependencies(api_module):
+    write_routes = {f"{method.upper()} {path}" for path, item in api_module.app.get_openapi_schema().paths.items()
+                    for method in ("post", "put", "patch", "delete") if getattr(item, method) is not None}
+    assert write_routes == set(api_module.WRITE_ROUTE_DEPENDENCIES)
@@ -0,0 +1,88 @@
+"""
+Server mode smoke tests: a worker serving keep-alive connections and chunked exports on moto, and
+the resource templates its events are built with.
+"""
+
+import http.client
+import json
+import socket
+import threading
+import uuid
+
+import pytest
+
+from tests.unit.environment import seed_account
+
+
+@pytest.fixture
+def address(server_module, aws):
+    # One worker on a free port, in a thread of the test process
+    app_module = server_module.app_module
+    app_module.reset_dogs_service()
+    sock = socket.create_server(("127.0.0.1", 0))
+    sock.setblocking(False)
+    server = server_module.WorkerHTTPServer(sock, request_timeout=30, keepalive_timeout=5, max_connections=10)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.start()
+    yield sock.getsockname()
+    server.begin_shutdown()
+    thread.join()
+    sock.close()
+    app_module.reset_dogs_service()
+
+
+@pytest.mark.parametrize("method, path, resource, params", [
+    ("GET", "/users/u1/dogs/export", "/users/{user_id}/dogs/export", {"user_id": "u1"}),
+    ("DELETE", "/users/u1/dogs/3", "/users/{user_id}/dogs/{dog_id}", {"user_id": "u1", "dog_id": "3"}),
+    ("POST", "/users/u1/dogs/3/images/7/multipart/complete",
+     "/users/{user_id}/dogs/{dog_id}/images/{image_id}/multipart/complete", {"user_id": "u1", "dog_id": "3", "image_id": "7"}),
+    ("GET", "/health", "/health", None),
+    # No route: the raw path, the app answers 404
+    ("GET", "/users/u1/cats", "/users/u1/cats", None),
+    ("PUT", "/health", "/health", None),
+])
+def test_match_route(server_module, method, path, resource, params):
+    assert server_module.match_route(method, path) == (resource, params)
+
+
+def test_keep_alive(address):
+    user_id = str(uuid.uuid4())
+    conn = http.client.HTTPConnection(*address, timeout=10)
+
+    conn.request("POST", f"/users/{user_id}/dogs", body=json.dumps({"name": "rex", "age": 3}),
+                 headers={"Content-Type": "application/json"})
+    created = conn.getresponse()
+    assert created.status == 200
+    assert json.loads(created.read())["name"] == "rex"
+    sock = conn.sock
+
+    conn.request("GET", f"/users/{user_id}/dogs")
+    listed = conn.getresponse()
+    assert listed.status == 200
+    assert [dog["name"] for dog in json.loads(listed.read())] == ["rex"]
+    # Both requests went over the same connection
+    assert conn.sock is sock
+    conn.close()
+
+
+def test_chunked_export(address, server_module, monkeypatch):
+    # Small chunks, the export is sent in several
+    monkeypatch.setattr(server_module.ChunkedResponseStream, "chunk_size", 64)
+    user_id = str(uuid.uuid4())
+    seed_account(user_id, dogs=5, images_per_dog=2)
+    conn = http.client.HTTPConnection(*address, timeout=10)
+
+    conn.request("GET", f"/users/{user_id}/dogs/export")
+    response = conn.getresponse()
+
+    assert response.status == 200
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    assert response.getheader("Content-Type").startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.read().decode("utf-8").splitlines()]
+    assert [dog["dog_id"] for dog in lines] == [1, 2, 3, 4, 5]
+    assert all(len(dog["images"]) == 2 for dog in lines)
+
+    # The connection is still usable after the last chunk
+    conn.request("GET", "/health")
+    assert conn.getresponse().status in (200, 503)
+    conn.close()
@@ -0,0 +1,219 @@
+"""
+The same cases against every ItemStore backend: DynamoDB (on moto), in memory and SQLite.
+"""
+
+import time
+
+import pytest
+
+from dogs_common.storage import ConditionalCheckFailed, _plain
+
+PK = "USER#test"
+
+
+def key(sk: str, pk: str = PK) -> dict:
+    return {"PK": pk, "SK": sk}
+
+
+def get(store, sk: str):
+    # Items as the service sees them once normalized, DynamoDB returns Decimals and sets
+    item = store.get(key(sk))
+    return _plain(item) if item is not None else None
+
+
+def query_all(store, prefix: str, descending: bool = False, limit: int = None) -> list:
+    items, start_key = [], None
+    while True:
+        page, start_key = store.query(PK, prefix, descending=descending, limit=limit, start_key=start_key)
+        items.extend(item["SK"] for item in page)
+        if start_key is None:
+            return items
+
+
+def test_put_get(store):
+    store.put({**key("DOG#1"), "name": "rex", "age": 3, "tags": {"a", "b"}})
+
+    assert get(store, "DOG#1") == {**key("DOG#1"), "name": "rex", "age": 3, "tags": ["a", "b"]}
+    assert store.get(key("DOG#2")) is None
+    assert store.get(key("DOG#1", pk="USER#other")) is None
+
+
+def test_put_if_not_exists(store):
+    store.put({**key("DOG#1"), "name": "rex"}, if_not_exists=True)
+
+    with pytest.raises(ConditionalCheckFailed):
+        store.put({**key("DOG#1"), "name": "max"}, if_not_exists=True)
+    assert get(store, "DOG#1")["name"] == "rex"
+
+    store.put({**key("DOG#1"), "name": "max"})
+    assert get(store, "DOG#1")["name"] == "max"
+
+
+def test_delete(store):
+    store.put({**key("DOG#1"), "version": 2})
+    store.put(key("DOG#2"))
+
+    with pytest.raises(ConditionalCheckFailed):
+        store.delete(key("DOG#3"), if_exists=True)
+    store.delete(key("DOG#3"))
+
+    with pytest.raises(ConditionalCheckFailed):
+        store.delete(key("DOG#1"), expected_version=1)
+    store.delete(key("DOG#1"), if_exists=True, expected_version=2)
+    assert store.get(key("DOG#1")) is None
+
+    # No version yet passes the version check, a missing item passes it too unless if_exists
+    store.delete(key("DOG#2"), expected_version=5)
+    assert store.get(key("DOG#2")) is None
+    store.delete(key("DOG#2"), expected_version=5)
+    with pytest.raises(ConditionalCheckFailed):
+        store.delete(key("DOG#2"), if_exists=True, expected_version=5)
+
+
+def test_update_creates_missing_item(store):
+    updated = store.update(key("META#SEQUENCE"), set_values={"name": "counters"}, add={"dog_counter": 1})
+
+    assert _plain(updated) == {**key("META#SEQUENCE"), "name": "counters", "dog_counter": 1}
+    assert get(store, "META#SEQUENCE") == _plain(updated)
+
+    with pytest.raises(ConditionalCheckFailed):
+        store.update(key("DOG#1"), set_values={"name": "rex"}, if_exists=True)
+    assert store.get(key("DOG#1")) is None
+
+
+def test_update_attributes(store):
+    store.put({**key("DOG#1"), "name": "rex", "age": 3, "breed": "pug"})
+
+    updated = store.update(key("DOG#1"), set_values={"name": "max"}, remove=["breed"], add={"age": 2, "visits": 1},
+                           if_exists=True)
+
+    assert _plain(updated) == {**key("DOG#1"), "name": "max", "age": 5, "visits": 1}
+    assert get(store, "DOG#1") == _plain(updated)
+
+
+def test_update_version_check(store):
+    store.put({**key("DOG#1"), "name": "rex"})
+
+    # No version yet passes, then only the current one does
+    store.update(key("DOG#1"), set_values={"name": "max"}, add={"version": 1}, expected_version=0)
+    with pytest.raises(ConditionalCheckFailed):
+        store.update(key("DOG#1"), set_values={"name": "bob"}, add={"version": 1}, expected_version=0)
+    updated = store.update(key("DOG#1"), set_values={"name": "bob"}, add={"version": 1}, expected_version=1)
+
+    assert _plain(updated)["version"] == 2
+    assert get(store, "DOG#1")["name"] == "bob"
+
+
+def test_update_string_sets(store):
+    store.update(key("HASH#abc"), add_to_set={"refs": ["IMAGE#1", "IMAGE#2"]})
+    updated = store.update(key("HASH#abc"), add_to_set={"refs": ["IMAGE#2", "IMAGE#3"]},
+                           delete_from_set={"other": ["IMAGE#9"]})
+    assert sorted(_plain(updated)["refs"]) == ["IMAGE#1", "IMAGE#2", "IMAGE#3"]
+
+    updated = store.update(key("HASH#abc"), delete_from_set={"refs": ["IMAGE#1", "IMAGE#4"]})
+    assert sorted(_plain(updated)["refs"]) == ["IMAGE#2", "IMAGE#3"]
+
+    # Like DynamoDB, deleting the last element removes the attribute
+    updated = store.update(key("HASH#abc"), delete_from_set={"refs": ["IMAGE#2", "IMAGE#3"]})
+    assert "refs" not in updated
+    assert "refs" not in get(store, "HASH#abc")
+
+
+def test_query_prefix_and_order(store):
+    for sk in ("DOG#1", "DOG#10", "DOG#2", "IMAGE#1#1", "IMAGE#10#1", "IMAGE#1#2", "META#SEQUENCE"):
+        store.put(key(sk))
+    store.put(key("DOG#5", pk="USER#other"))
+
+    assert query_all(store, "DOG#") == ["DOG#1", "DOG#10", "DOG#2"]
+    assert query_all(store, "DOG#", descending=True) == ["DOG#2", "DOG#10", "DOG#1"]
+    assert query_all(store, "IMAGE#1#") == ["IMAGE#1#1", "IMAGE#1#2"]
+    assert query_all(store, "HASH#") == []
+    assert store.query("USER#missing", "DOG#") == ([], None)
+
+
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("limit", [1, 3, 7, 10])
+def test_query_pagination(store, descending, limit):
+    sks = [f"IMAGE#{i:02d}" for i in range(7)]
+    for sk in sks + ["IMAGF#00", "IMAGD#99"]:
+        store.put(key(sk))
+
+    assert query_all(store, "IMAGE#", descending=descending, limit=limit) == sorted(sks, reverse=descending)
+
+    page, start_key = store.query(PK, "IMAGE#", descending=descending, limit=limit)
+    assert len(page) == min(limit, len(sks))
+    if limit < len(sks):
+        assert start_key == key(page[-1]["SK"])
+
+
+def test_query_start_key_of_deleted_item(store):
+    for i in range(4):
+        store.put(key(f"DOG#{i}"))
+
+    page, start_key = store.query(PK, "DOG#", limit=2)
+    store.delete(start_key)
+
+    page, _ = store.query(PK, "DOG#", start_key=start_key)
+    assert [item["SK"] for item in page] == ["DOG#2", "DOG#3"]
+
+
+def test_batch_get(store):
+    # More keys than one BatchGetItem request takes
+    for i in range(150):
+        store.put({**key(f"DOG#{i:03d}"), "name": f"dog-{i}"})
+
+    items = store.batch_get([key(f"DOG#{i:03d}") for i in range(0, 160, 2)])
+
+    assert sorted(item["SK"] for item in items) == [f"DOG#{i:03d}" for i in range(0, 150, 2)]
+    assert store.batch_get([]) == []
+
+
+def test_batch_put(store):
+    # More items than one BatchWriteItem request takes, existing ones are replaced
+    store.put({**key("DOG#00"), "name": "old", "age": 1})
+    store.batch_put([{**key(f"DOG#{i:02d}"), "name": f"dog-{i}"} for i in range(30)])
+
+    assert query_all(store, "DOG#") == [f"DOG#{i:02d}" for i in range(30)]
+    assert get(store, "DOG#00") == {**key("DOG#00"), "name": "dog-0"}
+    store.batch_put([])
+
+
+def test_batch_delete(store):
+    # More keys than one BatchWriteItem request takes, missing ones included
+    for i in range(60):
+        store.put(key(f"DOG#{i:02d}"))
+
+    store.batch_delete([key(f"DOG#{i:02d}") for i in range(0, 70, 2)])
+
+    assert query_all(store, "DOG#") == [f"DOG#{i:02d}" for i in range(1, 60, 2)]
+
+
+def test_expired_items_are_absent_locally(store):
+    if store.__class__.__name__ == "DynamoDBStore":
+        pytest.skip("DynamoDB returns expired items until its background TTL deletion")
+    expired = int(time.time()) - 60
+    store.put({**key("BUCKET#a"), "version": 3, "expires_at": expired})
+    store.put({**key("BUCKET#b"), "expires_at": int(time.time()) + 3600})
+
+    assert store.get(key("BUCKET#a")) is None
+    assert query_all(store, "BUCKET#") == ["BUCKET#b"]
+    assert [item["SK"] for item in store.batch_get([key("BUCKET#a"), key("BUCKET#b")])] == ["BUCKET#b"]
+
+    # Conditions see it as absent too, unlike DynamoDB, so a read followed by a write agrees with the read
+    with pytest.raises(ConditionalCheckFailed):
+        store.delete(key("BUCKET#a"), if_exists=True)
+    updated = store.update(key("BUCKET#a"), set_values={"tokens": 1}, add={"version": 1}, expected_version=0)
+    assert _plain(updated) == {**key("BUCKET#a"), "tokens": 1, "version": 1}
+
+
+def test_expired_items_remain_in_dynamodb(store):
+    if store.__class__.__name__ != "DynamoDBStore":
+        pytest.skip("Local stores treat expired items as absent")
+    expired = int(time.time()) - 60
+    store.put({**key("BUCKET#a"), "version": 3, "expires_at": expired})
+
+    assert get(store, "BUCKET#a")["version"] == 3
+    with pytest.raises(ConditionalCheckFailed):
+        store.put(key("BUCKET#a"), if_not_exists=True)
+    with pytest.raises(ConditionalCheckFailed):
+        store.update(key("BUCKET#a"), set_values={"tokens": 1}, expected_version=0)